@@ -1,5 +1,25 @@
-from llmx import TextGenerationConfig, llm, TextGenerator
-from .components.manager import Manager
+import importlib
+
+# attributes are imported on first access (PEP 562), so `import lida` and the cli do not pay
+# for llmx, pandas and the plotting libraries until they are used
+_LAZY_ATTRIBUTES = {
+    "TextGenerationConfig": "llmx",
+    "llm": "llmx",
+    "TextGenerator": "llmx",
+    "Manager": "lida.components.manager",
+}
 
 
 __all__ = ["TextGenerationConfig", "llm", "TextGenerator", "Manager"]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
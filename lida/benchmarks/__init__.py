@@ -0,0 +1,7 @@
+"""Offline benchmarks for lida. LLM calls are replayed by a deterministic fake text generator."""
+
+from .textgen import FakeTextGenerator, get_component
+from .datasets import make_datasets, write_datasets
+from .runner import (canned_responses, compare_reports, format_report, load_report,
+                     run_benchmark, save_report)
+from .startup import STARTUP_STATEMENTS, run_startup_benchmark, time_startup
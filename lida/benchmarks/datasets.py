@@ -0,0 +1,79 @@
+import os
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+COUNTRIES = ["Kenya", "Brazil", "India", "Canada", "France", "Japan", "Mexico", "Nigeria"]
+WORDS = ["fast", "reliable", "cheap", "broken", "great", "slow", "excellent", "average",
+         "delivery", "support", "product", "price", "quality", "refund", "service", "package"]
+
+
+def make_wide_dataset(n_rows: int = 1000, n_columns: int = 200, seed: int = 0) -> pd.DataFrame:
+    """Numeric and categorical columns, many more columns than a typical chart uses"""
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for i in range(n_columns):
+        if i % 4 == 3:
+            columns[f"category_{i}"] = rng.choice(COUNTRIES, n_rows)
+        else:
+            columns[f"metric_{i}"] = rng.normal(loc=i, scale=1 + i % 7, size=n_rows).round(3)
+    return pd.DataFrame(columns)
+
+
+def make_tall_dataset(n_rows: int = 200000, seed: int = 0) -> pd.DataFrame:
+    """Few columns, many rows"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "customer_id": rng.integers(0, 50000, n_rows),
+        "country": rng.choice(COUNTRIES, n_rows),
+        "amount": rng.gamma(2.0, 50.0, n_rows).round(2),
+        "quantity": rng.integers(1, 20, n_rows),
+    })
+
+
+def make_text_dataset(n_rows: int = 5000, seed: int = 0) -> pd.DataFrame:
+    """Free text columns with high cardinality"""
+    rng = np.random.default_rng(seed)
+    reviews = [" ".join(rng.choice(WORDS, rng.integers(5, 30))) for _ in range(n_rows)]
+    titles = [" ".join(rng.choice(WORDS, 3)).title() for _ in range(n_rows)]
+    return pd.DataFrame({
+        "title": titles,
+        "review": reviews,
+        "country": rng.choice(COUNTRIES, n_rows),
+        "rating": rng.integers(1, 6, n_rows),
+    })
+
+
+def make_date_dataset(n_rows: int = 5000, seed: int = 0) -> pd.DataFrame:
+    """Several date columns stored as strings, as they are in most csv files"""
+    rng = np.random.default_rng(seed)
+    created = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1000, n_rows), unit="D")
+    shipped = created + pd.to_timedelta(rng.integers(0, 10, n_rows), unit="D")
+    return pd.DataFrame({
+        "created_at": created.strftime("%Y-%m-%d"),
+        "shipped_at": shipped.strftime("%Y-%m-%d"),
+        "updated_at": (shipped + pd.to_timedelta(rng.integers(0, 24, n_rows), unit="h")).strftime(
+            "%Y-%m-%d %H:%M:%S"),
+        "value": rng.normal(100, 20, n_rows).round(2),
+    })
+
+
+def make_datasets(scale: float = 1.0, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """Return the synthetic benchmark datasets. scale shrinks or grows the number of rows"""
+    return {
+        "wide": make_wide_dataset(n_rows=max(10, int(1000 * scale)), seed=seed),
+        "tall": make_tall_dataset(n_rows=max(10, int(200000 * scale)), seed=seed),
+        "text": make_text_dataset(n_rows=max(10, int(5000 * scale)), seed=seed),
+        "dates": make_date_dataset(n_rows=max(10, int(5000 * scale)), seed=seed),
+    }
+
+
+def write_datasets(datasets: Dict[str, pd.DataFrame], directory: str) -> Dict[str, str]:
+    """Write datasets as csv files and return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for name, df in datasets.items():
+        paths[name] = os.path.join(directory, f"{name}.csv")
+        df.to_csv(paths[name], index=False)
+    return paths
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Tuple
+
+import pandas as pd
+from llmx import TextGenerationConfig
+
+from lida.components.manager import Manager
+from lida.version import VERSION
+from .datasets import make_datasets, write_datasets
+from .textgen import FakeTextGenerator
+
+logger = logging.getLogger("lida")
+
+LIBRARIES = ["seaborn", "matplotlib", "altair", "plotly", "ggplot"]
+
+# code for a histogram of {field} in each library, in the form returned by the llm
+CHART_CODE = {
+    "seaborn": """
+import seaborn as sns
+import pandas as pd
+import matplotlib.pyplot as plt
+def plot(data: pd.DataFrame):
+    sns.histplot(data=data, x='{field}')
+    plt.title('Distribution of {field}', wrap=True)
+    return plt;
+
+chart = plot(data)""",
+    "matplotlib": """
+import matplotlib.pyplot as plt
+import pandas as pd
+def plot(data: pd.DataFrame):
+    plt.hist(data['{field}'].dropna(), bins=20)
+    plt.title('Distribution of {field}', wrap=True)
+    return plt;
+
+chart = plot(data)""",
+    "altair": """
+import altair as alt
+import pandas as pd
+def plot(data: pd.DataFrame):
+    chart = alt.Chart(data).mark_bar().encode(x=alt.X('{field}:Q', bin=True), y='count()')
+    return chart
+chart = plot(data)""",
+    "plotly": """
+import plotly.express as px
+import pandas as pd
+def plot(data: pd.DataFrame):
+    fig = px.histogram(data, x='{field}')
+    return fig
+chart = plot(data)""",
+    "ggplot": """
+import plotnine as p9
+import pandas as pd
+def plot(data: pd.DataFrame):
+    chart = p9.ggplot(data, p9.aes(x='{field}')) + p9.geom_histogram(bins=20)
+    return chart;
+
+chart = plot(data)""",
+}
+
+
+def get_chart_code(df: pd.DataFrame, library: str) -> str:
+    """Return histogram code for the first numeric column of the dataset"""
+    numeric_columns = df.select_dtypes("number").columns.tolist()
+    field = numeric_columns[0] if numeric_columns else df.columns[0]
+    return CHART_CODE[library].format(field=field)
+
+
+def canned_responses(df: pd.DataFrame, library: str = "seaborn", n: int = 3) -> Dict[str, Any]:
+    """Build the canned completion of every component for a dataset and library"""
+    code = f"```python\n{get_chart_code(df, library)}\n```"
+    fields = [{"column": column, "properties": {"semantic_type": "value",
+                                                "description": f"The {column} of the record"}}
+              for column in df.columns]
+    summary = {"name": "benchmark", "dataset_description": "A synthetic benchmark dataset",
+               "fields": fields}
+    goals = [{"index": i, "question": f"What is the distribution of {column}?",
+              "visualization": f"histogram of {column}",
+              "rationale": f"This tells about the spread of {column}"}
+             for i, column in enumerate(df.columns[:n])]
+    explanation = [{"section": section, "code": "None", "explanation": f"The {section} section"}
+                   for section in ["accessibility", "transformation", "visualization"]]
+    evaluation = [{"dimension": dimension, "score": 8, "rationale": "ok"}
+                  for dimension in ["bugs", "transformation", "compliance", "type", "encoding",
+                                    "aesthetics"]]
+    return {
+        "summarizer": f"```{json.dumps(summary)}```",
+        "goal": f"```{json.dumps(goals)}```",
+        "vizgen": code,
+        "editor": code,
+        "repairer": code,
+        "recommender": "\n*****\n".join([code] * n),
+        "explainer": f"```{json.dumps(explanation)}```",
+        "evaluator": f"```{json.dumps(evaluation)}```",
+    }
+
+
+def time_call(func: Callable, repeat: int) -> Tuple[List[float], Any]:
+    """Call func repeat times, returning the duration of each call and the last result"""
+    timings, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def _result(dataset: str, library: str, stage: str, timings: List[float], **extra) -> dict:
+    return {
+        "dataset": dataset,
+        "library": library,
+        "stage": stage,
+        "runs": timings,
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        **extra,
+    }
+
+
+def run_benchmark(
+        datasets: Dict[str, pd.DataFrame] = None, libraries: List[str] = None,
+        repeat: int = 3, scale: float = 1.0, directory: str = None) -> dict:
+    """Time summarize, goals, visualize, execute and recommend on synthetic datasets.
+
+    All llm calls are served by a FakeTextGenerator, so the timings only measure lida itself.
+
+    Returns:
+        dict: A report that can be saved as json and compared with compare_reports.
+    """
+    datasets = datasets if datasets is not None else make_datasets(scale=scale)
+    libraries = libraries or LIBRARIES
+    directory = directory or tempfile.mkdtemp(prefix="lida-benchmark-")
+    paths = write_datasets(datasets, directory)
+    textgen_config = TextGenerationConfig(n=1, temperature=0, use_cache=False)
+
+    results = []
+    for name, df in datasets.items():
+        text_gen = FakeTextGenerator(responses=canned_responses(df))
+        manager = Manager(text_gen=text_gen)
+        # keep the column annotation cache out of the user cache directory
+        manager.summarizer.cache_dir = os.path.join(directory, "enrichment")
+
+        timings, summary = time_call(lambda: manager.summarize(
+            paths[name], summary_method="llm", textgen_config=textgen_config), repeat)
+        results.append(_result(name, None, "summarize", timings))
+        timings, goals = time_call(lambda: manager.goals(
+            summary, n=3, textgen_config=textgen_config), repeat)
+        results.append(_result(name, None, "goals", timings))
+
+        for library in libraries:
+            text_gen.responses = canned_responses(df, library)
+            code = get_chart_code(df, library)
+
+            timings, charts = time_call(lambda: manager.visualize(
+                summary=summary, goal=goals[0], textgen_config=textgen_config,
+                library=library), repeat)
+            results.append(_result(name, library, "visualize", timings, charts=len(charts)))
+            timings, charts = time_call(lambda: manager.execute(
+                code_specs=[code], data=manager.data, summary=summary, library=library), repeat)
+            results.append(_result(name, library, "execute", timings, charts=len(charts)))
+            timings, charts = time_call(lambda: manager.recommend(
+                code=code, summary=summary, n=3, textgen_config=textgen_config,
+                library=library), repeat)
+            results.append(_result(name, library, "recommend", timings, charts=len(charts)))
+
+    return {
+        "lida_version": VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pandas": pd.__version__,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "repeat": repeat,
+        "scale": scale,
+        "results": results,
+    }
+
+
+def save_report(report: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare_reports(
+        baseline: dict, current: dict, tolerance: float = 0.25,
+        min_seconds: float = 0.005) -> List[dict]:
+    """Return the stages whose median time regressed by more than tolerance.
+
+    Differences below min_seconds are ignored to avoid flagging noise on very fast stages.
+    Stages that produced fewer charts than in the baseline are also reported.
+    """
+    def key(result):
+        return result["dataset"], result["library"], result["stage"]
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        previous = baseline_results.get(key(result))
+        if previous is None:
+            continue
+        slower = result["median"] > previous["median"] * (1 + tolerance) and \
+            result["median"] - previous["median"] > min_seconds
+        fewer_charts = result.get("charts", 0) < previous.get("charts", 0)
+        if slower or fewer_charts:
+            regressions.append({
+                "dataset": result["dataset"],
+                "library": result["library"],
+                "stage": result["stage"],
+                "baseline": previous["median"],
+                "current": result["median"],
+                "ratio": result["median"] / previous["median"] if previous["median"] else float("inf"),
+                "baseline_charts": previous.get("charts"),
+                "current_charts": result.get("charts"),
+            })
+    return regressions
+
+
+def format_report(report: dict) -> str:
+    """Format a report as a text table"""
+    lines = [f"{'dataset':<8} {'library':<11} {'stage':<10} {'median (s)':>11} {'min (s)':>9} {'charts':>6}"]
+    for result in report["results"]:
+        lines.append(
+            f"{result['dataset']:<8} {result['library'] or '-':<11} {result['stage']:<10} "
+            f"{result['median']:>11.4f} {result['min']:>9.4f} {result.get('charts', '-'):>6}")
+    return os.linesep.join(lines)
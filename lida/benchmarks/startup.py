@@ -0,0 +1,48 @@
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+# statements timed in a fresh interpreter, i.e. the cold start of cli commands and workers
+STARTUP_STATEMENTS = {
+    "import": "import lida",
+    "cli": "import lida.cli",
+    "manager": "from lida import Manager; Manager()",
+    "web": "import lida.web.app",
+}
+
+_TIMER = """
+import time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+"""
+
+
+def time_startup(statement: str, repeat: int = 3) -> List[float]:
+    """Time a statement in a new python process, repeat times"""
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _TIMER.format(statement=statement)],
+            capture_output=True, text=True, check=True)
+        timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def run_startup_benchmark(statements: Dict[str, str] = None, repeat: int = 3) -> List[dict]:
+    """Time the import of lida entry points. Results use the format of run_benchmark reports"""
+    results = []
+    for stage, statement in (statements or STARTUP_STATEMENTS).items():
+        timings = time_startup(statement, repeat)
+        results.append({
+            "dataset": "startup",
+            "library": None,
+            "stage": stage,
+            "runs": timings,
+            "mean": statistics.mean(timings),
+            "median": statistics.median(timings),
+            "min": min(timings),
+            "max": max(timings),
+        })
+    return results
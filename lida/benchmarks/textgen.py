@@ -0,0 +1,109 @@
+import time
+from typing import Callable, Dict, Iterator, List, Union
+
+from llmx import TextGenerator, TextGenerationConfig
+from llmx.datamodel import Message, TextGenerationResponse
+
+from lida.components.goal import SYSTEM_INSTRUCTIONS as goal_prompt
+from lida.components.persona import system_prompt as persona_prompt
+from lida.components.summarizer import system_prompt as summarizer_prompt
+from lida.components.viz.vizanalyzer import system_prompt as analyzer_prompt
+from lida.components.viz.vizeditor import system_prompt as editor_prompt
+from lida.components.viz.vizevaluator import system_prompt as evaluator_prompt
+from lida.components.viz.vizexplainer import system_prompt as explainer_prompt
+from lida.components.viz.vizgenerator import system_prompt as vizgen_prompt
+from lida.components.viz.vizrecommender import system_prompt as recommender_prompt
+from lida.components.viz.vizrepairer import system_prompt as repairer_prompt
+
+# system prompt of each component, used to tell which component is calling the generator
+COMPONENT_PROMPTS = {
+    "summarizer": summarizer_prompt,
+    "goal": goal_prompt,
+    "persona": persona_prompt,
+    "vizgen": vizgen_prompt,
+    "editor": editor_prompt,
+    "explainer": explainer_prompt,
+    "evaluator": evaluator_prompt,
+    "analyzer": analyzer_prompt,
+    "repairer": repairer_prompt,
+    "recommender": recommender_prompt,
+}
+
+CannedResponse = Union[str, List[str], Callable[[List[Dict]], str]]
+
+
+def get_component(messages: Union[List[Dict], str]) -> str:
+    """Return the name of the lida component that built the messages"""
+    if isinstance(messages, str) or not messages:
+        return "unknown"
+    system_content = messages[0]["content"]
+    for component, prompt in COMPONENT_PROMPTS.items():
+        if system_content == prompt:
+            return component
+    return "unknown"
+
+
+class FakeTextGenerator(TextGenerator):
+    """A deterministic text generator that replays canned completions without network calls.
+
+    Responses are keyed by component name (see COMPONENT_PROMPTS). A response can be a string,
+    a list of strings replayed in turn (the last one repeats), or a callable that receives the
+    messages and returns the completion text.
+    """
+
+    def __init__(self, responses: Dict[str, CannedResponse] = None,
+                 latency: float = 0.0, provider: str = "openai",
+                 model_name: str = "fake", chunk_size: int = 16) -> None:
+        # does not call TextGenerator.__init__, there is no provider cache to set up
+        self.provider = provider
+        self.model_name = model_name
+        self.responses = responses or {}
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls: List[str] = []
+        self._replay_index: Dict[str, int] = {}
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        component = get_component(messages)
+        self.calls.append(component)
+        if component not in self.responses:
+            raise ValueError(f"No canned response for component '{component}'")
+        if self.latency:
+            time.sleep(self.latency)
+
+        response = self.responses[component]
+        if callable(response):
+            content = response(messages)
+        elif isinstance(response, list):
+            index = self._replay_index.get(component, 0)
+            content = response[min(index, len(response) - 1)]
+            self._replay_index[component] = index + 1
+        else:
+            content = response
+
+        prompt_tokens = self.count_tokens(messages)
+        completion_tokens = len(content) // 4
+        return TextGenerationResponse(
+            text=[Message(role="assistant", content=content) for _ in range(config.n or 1)],
+            config=config,
+            usage={"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                   "total_tokens": prompt_tokens + completion_tokens},
+        )
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        """Replay the canned completion in chunks of chunk_size characters"""
+        content = self.generate(messages=messages, config=config, **kwargs).text[0]["content"]
+        for i in range(0, len(content), self.chunk_size):
+            yield content[i:i + self.chunk_size]
+
+    def count_tokens(self, text) -> int:
+        # rough estimate of 4 characters per token, good enough for a replay generator
+        if isinstance(text, list):
+            return sum(len(str(message["content"])) for message in text) // 4
+        return len(str(text)) // 4
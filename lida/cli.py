@@ -1,8 +1,7 @@
-import typer
-import uvicorn
+import importlib.util
 import os
+import typer
 from typing_extensions import Annotated
-from llmx import providers
 
 # from lida.web.backend.app import launch
 
@@ -19,7 +18,14 @@ def ui(host: str = "127.0.0.1",
     Launch the lida .Pass in parameters host, port, workers, and reload to override the default values.
     """
 
+    import uvicorn
+
     os.environ["LIDA_API_DOCS"] = str(docs)
+    if workers > 1 and reload:
+        # uvicorn ignores workers when reloading. Workers share state through the store, see
+        # LIDA_STORE
+        print("Reload is disabled when running several workers")
+        reload = False
 
     uvicorn.run(
         "lida.web.app:app",
@@ -30,8 +36,25 @@ def ui(host: str = "127.0.0.1",
     )
 
 
+def load_providers() -> dict:
+    """Read the llmx provider config without importing llmx and its provider clients"""
+    try:
+        import yaml
+
+        config_path = os.environ.get("LLMX_CONFIG_PATH", None)
+        if config_path is None or not os.path.exists(config_path):
+            package_dir = os.path.dirname(importlib.util.find_spec("llmx").origin)
+            config_path = os.path.join(package_dir, "configs", "config.default.yml")
+        with open(config_path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)["providers"]
+    except Exception:
+        from llmx import providers
+        return providers
+
+
 @app.command()
 def models():
+    providers = load_providers()
     print("A list of supported providers:")
     for provider in providers.items():
         print(f"Provider: {provider[1]['name']}")
@@ -39,6 +62,37 @@ def models():
             print(f"  - {model['name']}")
 
 
+@app.command()
+def benchmark(output: str = "benchmark.json",
+              baseline: str = None,
+              repeat: int = 3,
+              scale: float = 1.0,
+              libraries: str = "seaborn,matplotlib,altair,plotly,ggplot",
+              tolerance: float = 0.25,
+              startup: bool = True):
+    """
+    Run the offline benchmark suite and save a json report. If a baseline report is given, exit with an error on regressions.
+    """
+    from lida.benchmarks import (compare_reports, format_report, load_report, run_benchmark,
+                                 run_startup_benchmark, save_report)
+
+    report = run_benchmark(libraries=libraries.split(","), repeat=repeat, scale=scale)
+    if startup:
+        report["results"].extend(run_startup_benchmark(repeat=repeat))
+    save_report(report, output)
+    print(format_report(report))
+    print(f"Saved benchmark report to {output}")
+
+    if baseline:
+        regressions = compare_reports(load_report(baseline), report, tolerance=tolerance)
+        for regression in regressions:
+            print(
+                f"Regression: {regression['dataset']} {regression['library'] or '-'} {regression['stage']} "
+                f"{regression['baseline']:.4f}s -> {regression['current']:.4f}s")
+        if regressions:
+            raise typer.Exit(code=1)
+
+
 def run():
     app()
 
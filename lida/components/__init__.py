@@ -1,7 +1,50 @@
-from .summarizer import Summarizer
-from .viz import *
-from .goal import *
-from .scaffold import *
-from .executor import *
-from .manager import *
-from .persona import *
+import importlib
+
+# components are imported on first access (PEP 562). Importing the package no longer loads
+# pandas, llmx and the plotting libraries used by the executor
+_LAZY_ATTRIBUTES = {
+    "Summarizer": ".summarizer",
+    "GoalExplorer": ".goal",
+    "ChartScaffold": ".scaffold",
+    "ChartExecutor": ".executor",
+    "ChartCache": ".chartcache",
+    "TableCollection": ".tables",
+    "DuckDBBackend": ".sqlbackend",
+    "CubeBuilder": ".cubes",
+    "preprocess_code": ".executor",
+    "get_globals_dict": ".executor",
+    "Manager": ".manager",
+    "PersonaExplorer": ".persona",
+    "VizGenerator": ".viz",
+    "VizEditor": ".viz",
+    "VizExplainer": ".viz",
+    "VizEvaluator": ".viz",
+    "VizAnalyzer": ".viz",
+    "VizRepairer": ".viz",
+    "VizRecommender": ".viz",
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+# modules previously star imported by the package, in import order. Other names they define
+# are still found, the module imported last wins as with the star imports
+_STAR_MODULES = [".summarizer", ".viz", ".goal", ".scaffold", ".executor", ".manager", ".persona"]
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    if not name.startswith("_"):
+        for module_name in reversed(_STAR_MODULES):
+            module = importlib.import_module(module_name, __name__)
+            if hasattr(module, name):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
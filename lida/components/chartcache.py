@@ -0,0 +1,84 @@
+# Content addressed cache of executed charts. The same code is often executed again on
+# unchanged data (a session is reopened, an edit is undone, recommend returns a chart seen
+# before), so rendered charts are stored on disk under a hash of the data, the code and the
+# library and returned without running the code again.
+
+import hashlib
+import json
+import os
+from typing import Any, Optional, Union
+
+import pandas as pd
+from diskcache import Cache
+
+from lida.datamodel import ChartExecutorResponse
+from .store import Store
+
+
+def data_fingerprint(data: Any) -> Optional[str]:
+    """
+    Fingerprint of the data charts are executed on.
+
+    DataFrames are hashed by their columns, dtypes and values, files by their path, size and
+    modification time, and table collections by the fingerprints of their tables.
+
+    :param data: A DataFrame, the path of a data file or a TableCollection.
+    :return: A hex digest, or None for data that cannot be fingerprinted.
+    """
+    digest = hashlib.md5()
+    if isinstance(data, pd.DataFrame):
+        digest.update(json.dumps([[str(x), str(y)] for x, y in data.dtypes.items()]).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    elif hasattr(data, "fingerprint"):
+        # e.g. a TableCollection
+        return data.fingerprint()
+    elif isinstance(data, str) and os.path.isfile(data):
+        stat = os.stat(data)
+        digest.update(json.dumps([os.path.abspath(data), stat.st_size, stat.st_mtime_ns]).encode("utf-8"))
+    else:
+        return None
+    return digest.hexdigest()
+
+
+class ChartCache:
+    """Disk backed cache of successfully executed charts, evicting least recently used charts"""
+
+    def __init__(self, cache_dir: str = None, size_limit: int = 2 ** 30,
+                 store: Store = None) -> None:
+        """
+        :param cache_dir: Directory of the cache, defaults to the lida user cache directory.
+        :param size_limit: Size in bytes above which least recently used charts are evicted.
+        :param store: Store shared with other processes, used instead of the cache directory.
+        """
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.store = store
+        self._cache = None
+
+    @property
+    def cache(self) -> Union[Cache, Store]:
+        """The underlying store, or a disk cache created on first use"""
+        if self.store is not None:
+            return self.store
+        if self._cache is None:
+            from llmx.utils import get_user_cache_dir
+            self._cache = Cache(
+                self.cache_dir or os.path.join(get_user_cache_dir("lida"), "charts"),
+                size_limit=self.size_limit, eviction_policy="least-recently-used")
+        return self._cache
+
+    def make_key(self, fingerprint: str, code: str, library: str, file_name: str = "") -> str:
+        """Key of a chart. file_name is part of the key as altair specs link to the data file"""
+        params = {"data": fingerprint, "code": hashlib.md5(code.encode("utf-8")).hexdigest(),
+                  "library": library, "file_name": file_name}
+        return hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[ChartExecutorResponse]:
+        return self.cache.get(key)
+
+    def set(self, key: str, chart: ChartExecutorResponse) -> None:
+        if chart.status:
+            self.cache.set(key, chart)
+
+    def clear(self) -> None:
+        self.cache.clear()
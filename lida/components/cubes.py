@@ -0,0 +1,230 @@
+# Pre-aggregation of the full dataset. Charts are generated over a sample of the rows (see
+# read_dataframe), so sums and counts computed in chart code are wrong for large files. During
+# summarization, group by cubes of the category and binned numeric fields are computed over every
+# row, in chunks, and exposed to chart code as `cubes`, so typical aggregate charts plot exact
+# values. Cubes are cached on disk by data fingerprint and merged when rows are appended.
+
+import hashlib
+import itertools
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from diskcache import Cache
+
+from lida.utils import iter_dataframe
+from .chartcache import data_fingerprint
+from .store import Store
+
+# added to the summary in prompts, so generated code uses the cubes for aggregates
+CUBES_INSTRUCTION = (
+    "The variable cubes holds exact aggregates over ALL the rows of the dataset, while data only "
+    "holds a sample of them. cubes.get('<dimension>', ...) returns a pandas DataFrame with one row "
+    "per group of the given dimensions (listed in cubes.cubes of this summary), a count column "
+    "(rows per group) and <measure>_sum, <measure>_count (non null values), <measure>_mean, "
+    "<measure>_min and <measure>_max columns for each measure. Binned numeric dimensions hold "
+    "pandas Intervals. ALWAYS use cubes for counts, sums, means, minimums and maximums grouped by "
+    "these dimensions.")
+
+AGGREGATES = ["sum", "count", "min", "max"]
+
+
+class CubeSet:
+    """Group by cubes of a dataset, with exact aggregates over all its rows"""
+
+    def __init__(self, cubes: Dict[Tuple[str, ...], pd.DataFrame], dimensions: List[dict],
+                 measures: List[str], rows: int, fingerprint: Optional[str] = None) -> None:
+        self.cubes = cubes
+        self.dimensions = dimensions
+        self.measures = measures
+        self.rows = rows
+        self.fingerprint = fingerprint
+
+    def get(self, *dimensions: str) -> pd.DataFrame:
+        """
+        The cube of the given dimensions, in any order.
+
+        :param dimensions: Names of the grouped fields.
+        :return: A DataFrame with a column per dimension, count, and the aggregates of each measure.
+        """
+        for key, cube in self.cubes.items():
+            if sorted(key) == sorted(dimensions):
+                cube = cube.reset_index()
+                for measure in self.measures:
+                    cube[f"{measure}_mean"] = cube[f"{measure}_sum"] / cube[f"{measure}_count"].replace(0, np.nan)
+                return cube[list(dimensions) + [x for x in cube.columns if x not in dimensions]]
+        raise KeyError(f"No cube for {', '.join(dimensions)}. Cubes are "
+                       f"{'; '.join(', '.join(x) for x in self.cubes)}")
+
+    def describe(self) -> dict:
+        """Description of the cubes for the summary"""
+        return {
+            "rows": self.rows,
+            "dimensions": self.dimensions,
+            "measures": self.measures,
+            "cubes": [list(x) for x in self.cubes],
+        }
+
+    def __repr__(self) -> str:
+        return f"CubeSet({'; '.join(', '.join(x) for x in self.cubes)})"
+
+
+def _aggregate(chunk: pd.DataFrame, keys: Dict[str, pd.Series], measures: List[str]) -> pd.DataFrame:
+    grouped = chunk[measures].groupby([keys[x] for x in keys], observed=True, dropna=False)
+    if measures:
+        cube = grouped.agg(AGGREGATES)
+        cube.columns = [f"{measure}_{aggregate}" for measure, aggregate in cube.columns]
+    else:
+        cube = pd.DataFrame(index=grouped.size().index)
+    cube.insert(0, "count", grouped.size())
+    cube.index.names = list(keys)
+    return cube
+
+
+def merge_cubes(*cubes: pd.DataFrame) -> pd.DataFrame:
+    """Merge cubes of the same dimensions computed over different rows"""
+    combined = pd.concat(cubes)
+    aggregates = {}
+    for column in combined.columns:
+        aggregate = column.rsplit("_", 1)[-1]
+        aggregates[column] = aggregate if aggregate in ["min", "max"] else "sum"
+    return combined.groupby(level=list(range(combined.index.nlevels)), observed=True,
+                            dropna=False).agg(aggregates)
+
+
+class CubeBuilder:
+    """Compute group by cubes over the full data of a summary"""
+
+    def __init__(self, max_dimensions: int = 2, bins: int = 10, max_categories: int = 50,
+                 max_cubes: int = 50, max_measures: int = 20, chunksize: int = 100000,
+                 cache_dir: str = None, store: Store = None) -> None:
+        """
+        :param max_dimensions: Maximum number of dimensions of a cube.
+        :param bins: Number of equal width bins of numeric dimensions.
+        :param max_categories: Category fields with more distinct values are not dimensions.
+        :param max_cubes: Maximum number of cubes.
+        :param max_measures: Maximum number of aggregated numeric fields.
+        :param chunksize: Rows read at a time from files.
+        :param cache_dir: Directory of the cube cache, defaults to the lida user cache directory.
+        :param store: Store shared with other processes, used instead of the cache directory.
+        """
+        self.max_dimensions = max_dimensions
+        self.bins = bins
+        self.max_categories = max_categories
+        self.max_cubes = max_cubes
+        self.max_measures = max_measures
+        self.chunksize = chunksize
+        self.cache_dir = cache_dir
+        self.store = store
+        self._cache = None
+
+    @property
+    def cache(self) -> Union[Cache, Store]:
+        """Cache of computed cubes, the store or a disk cache created on first use"""
+        if self.store is not None:
+            return self.store
+        if self._cache is None:
+            from llmx.utils import get_user_cache_dir
+            self._cache = Cache(self.cache_dir or os.path.join(get_user_cache_dir("lida"), "cubes"))
+        return self._cache
+
+    def plan(self, fields: List[dict]) -> Tuple[List[dict], List[str]]:
+        """Dimensions and measures for the fields of a summary.
+
+        Category and boolean fields with few values are dimensions, numeric fields are measures
+        and are also dimensions, binned between the min and max of the summary.
+        """
+        dimensions = []
+        measures = []
+        for field in fields:
+            column, properties = str(field["column"]), field["properties"]
+            dtype = properties.get("dtype")
+            if dtype in ["category", "boolean"] and \
+                    properties.get("num_unique_values", 0) <= self.max_categories:
+                dimensions.append({"column": column, "type": "category"})
+            elif dtype == "number":
+                if len(measures) < self.max_measures:
+                    measures.append(column)
+                low, high = properties.get("min"), properties.get("max")
+                if low is not None and high is not None:
+                    edges = np.linspace(float(low), float(high), self.bins + 1)[1:-1]
+                    # values out of the summarized range fall in the first or last bin
+                    dimensions.append({"column": column, "type": "bin",
+                                       "edges": sorted(set(float(x) for x in edges))})
+        return dimensions, measures
+
+    def _keys(self, chunk: pd.DataFrame, dimensions: List[dict]) -> Dict[str, pd.Series]:
+        keys = {}
+        for dimension in dimensions:
+            column = dimension["column"]
+            if dimension["type"] == "bin":
+                edges = [-np.inf] + dimension["edges"] + [np.inf]
+                keys[column] = pd.cut(pd.to_numeric(chunk[column], errors="coerce"), edges, right=False)
+            else:
+                keys[column] = chunk[column].astype(object)
+        return keys
+
+    def _cube_dimensions(self, dimensions: List[dict]) -> List[Tuple[dict, ...]]:
+        combinations = []
+        for size in range(1, self.max_dimensions + 1):
+            for combination in itertools.combinations(dimensions, size):
+                # pairs of binned numbers are rarely charted, keep the budget for categories
+                if size > 1 and all(x["type"] == "bin" for x in combination):
+                    continue
+                combinations.append(combination)
+        return combinations[:self.max_cubes]
+
+    def aggregate(self, chunks: Iterator[pd.DataFrame], dimensions: List[dict],
+                  measures: List[str]) -> Tuple[Dict[Tuple[str, ...], pd.DataFrame], int]:
+        """Compute the cubes of the planned dimensions over chunks of rows"""
+        combinations = self._cube_dimensions(dimensions)
+        partials = {tuple(x["column"] for x in combination): [] for combination in combinations}
+        rows = 0
+        for chunk in chunks:
+            rows += len(chunk)
+            keys = self._keys(chunk, dimensions)
+            numeric = chunk[measures].apply(pd.to_numeric, errors="coerce")
+            for key in partials:
+                partials[key].append(_aggregate(numeric, {x: keys[x] for x in key}, measures))
+        return {key: merge_cubes(*parts) for key, parts in partials.items() if parts}, rows
+
+    def build(self, source: Union[str, pd.DataFrame], fields: List[dict],
+              encoding: str = "utf-8") -> CubeSet:
+        """
+        Compute (or load from the cache) the cubes of a dataset.
+
+        :param source: The path of the data file, read in chunks, or a DataFrame.
+        :param fields: Fields of the summary of the data.
+        :param encoding: Encoding of the data file.
+        :return: The cubes of the data.
+        """
+        dimensions, measures = self.plan(fields)
+        fingerprint = data_fingerprint(source)
+        key = None
+        if fingerprint is not None:
+            params = {"data": fingerprint, "dimensions": dimensions, "measures": measures,
+                      "max_dimensions": self.max_dimensions, "max_cubes": self.max_cubes}
+            key = hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+            cubes = self.cache.get(key)
+            if cubes is not None:
+                return cubes
+
+        chunks = iter_dataframe(source, encoding=encoding, chunksize=self.chunksize) \
+            if isinstance(source, str) else [source]
+        cubes, rows = self.aggregate(chunks, dimensions, measures)
+        cube_set = CubeSet(cubes, dimensions, measures, rows, fingerprint=key)
+        if key is not None:
+            self.cache.set(key, cube_set)
+        return cube_set
+
+    def update(self, cube_set: CubeSet, data: pd.DataFrame) -> CubeSet:
+        """Merge the aggregates of rows appended to the data into its cubes"""
+        cubes, rows = self.aggregate([data], cube_set.dimensions, cube_set.measures)
+        merged = {key: merge_cubes(cube, cubes[key]) if key in cubes else cube
+                  for key, cube in cube_set.cubes.items()}
+        fingerprint = hashlib.md5(
+            f"{cube_set.fingerprint}:{data_fingerprint(data)}".encode("utf-8")).hexdigest()
+        return CubeSet(merged, cube_set.dimensions, cube_set.measures, cube_set.rows + rows,
+                       fingerprint=fingerprint)
@@ -2,16 +2,31 @@ import ast
 import base64
 import importlib
 import io
+import logging
 import os
 import re
+import threading
 import traceback
+from contextlib import nullcontext
 from typing import Any, List
 
-import matplotlib.pyplot as plt
 import pandas as pd
-import plotly.io as pio
 
 from lida.datamodel import ChartExecutorResponse, Summary
+from lida.instrumentation import record_cache, track
+from lida.utils import read_dataframe
+from .chartcache import ChartCache, data_fingerprint
+from .cubes import CubeSet
+from .projection import pushdown_filters, referenced_columns
+from .sqlbackend import DuckDBBackend
+
+logger = logging.getLogger("lida")
+
+# libraries that render through the global pyplot state and cannot be executed concurrently
+PYPLOT_LIBRARIES = ["matplotlib", "seaborn", "ggplot"]
+_pyplot_lock = threading.RLock()
+# file types from which single columns (and parquet row groups) can be read
+COLUMNAR_EXTENSIONS = ["parquet", "feather"]
 
 
 def preprocess_code(code: str) -> str:
@@ -48,7 +63,7 @@ def preprocess_code(code: str) -> str:
     return code
 
 
-def get_globals_dict(code_string, data):
+def get_globals_dict(code_string, data, query=None, cubes=None):
     # Parse the code string into an AST
     tree = ast.parse(code_string)
     # Extract the names of the imported modules and their aliases
@@ -74,16 +89,64 @@ def get_globals_dict(code_string, data):
         else:
             globals_dict[module_name.split(".")[-1]] = obj
 
-    ex_dicts = {"pd": pd, "data": data, "plt": plt}
+    ex_dicts = {"pd": pd, "data": data}
+    if query is not None:
+        # runs sql over the full dataset, see the duckdb backend
+        ex_dicts["query"] = query
+    if cubes is not None:
+        # exact aggregates over the full dataset, see CubeBuilder
+        ex_dicts["cubes"] = cubes
+    if "plt" in code_string:
+        # imported on demand, matplotlib is slow to import and not needed by altair or plotly
+        import matplotlib.pyplot as plt
+        ex_dicts["plt"] = plt
     globals_dict.update(ex_dicts)
     return globals_dict
 
 
+class DataLoader:
+    """Load the data of each chart from a file, reading only the columns and rows a chart uses
+    from columnar files"""
+
+    def __init__(self, file_location: str, summary: Summary) -> None:
+        self.file_location = file_location
+        self.columns = [x["column"] for x in summary.fields] if summary.fields else [
+            str(x) for x in summary.field_names]
+        self.columnar = file_location.split(".")[-1] in COLUMNAR_EXTENSIONS
+        self._data = None
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """All the data, read once"""
+        if self._data is None:
+            self._data = read_dataframe(self.file_location)
+        return self._data
+
+    def load(self, code: str) -> pd.DataFrame:
+        if not self.columnar or self._data is not None:
+            return self.data
+        columns = referenced_columns(code, self.columns)
+        filters = pushdown_filters(code, self.columns)
+        if columns is None and filters is None:
+            return self.data
+        try:
+            with track("load"):
+                return read_dataframe(self.file_location, columns=columns, filters=filters)
+        except Exception as exception_error:
+            logger.warning("Reading all columns of %s. %s", self.file_location, exception_error)
+            return self.data
+
+    def projected(self, data: pd.DataFrame) -> bool:
+        """Check if data, as returned by load, holds only some of the columns or rows"""
+        return data is not self._data
+
+
 class ChartExecutor:
     """Execute code and return chart object"""
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, cache: ChartCache = None) -> None:
+        # executed charts are returned from the cache when the same code runs on the same data
+        self.cache = cache
 
     def execute(
         self,
@@ -92,6 +155,56 @@ class ChartExecutor:
         summary: Summary,
         library="altair",
         return_error: bool = False,
+        sql: DuckDBBackend = None,
+        cubes: CubeSet = None,
+    ) -> Any:
+        """Validate and convert code. Safe to call from multiple threads.
+
+        data is a DataFrame or the path of a data file. Charts of parquet and feather files are
+        executed on the columns (and the rows of simple filters) their code references.
+        With a sql backend, code can aggregate the full dataset with query(sql), and with
+        cubes it can read pre-computed aggregates of the full dataset.
+        """
+
+        lock = _pyplot_lock if library in PYPLOT_LIBRARIES else nullcontext()
+        fingerprint = data_fingerprint(data) if self.cache is not None else None
+        if fingerprint is not None and sql is not None:
+            fingerprint = f"{fingerprint}:{sql.fingerprint()}"
+        if fingerprint is not None and cubes is not None:
+            fingerprint = f"{fingerprint}:{cubes.fingerprint}"
+        if fingerprint is None:
+            with lock:
+                return self._execute(
+                    code_specs=code_specs, data=data, summary=summary, library=library,
+                    return_error=return_error, sql=sql, cubes=cubes)
+
+        file_name = summary.get("file_name", "") if isinstance(summary, dict) else summary.file_name
+        charts = []
+        for code in code_specs:
+            key = self.cache.make_key(fingerprint, preprocess_code(code), library, file_name)
+            chart = self.cache.get(key)
+            record_cache("chart", hit=chart is not None)
+            if chart is not None:
+                charts.append(chart)
+                continue
+            with lock:
+                executed = self._execute(
+                    code_specs=[code], data=data, summary=summary, library=library,
+                    return_error=return_error, sql=sql, cubes=cubes)
+            for chart in executed:
+                self.cache.set(key, chart)
+            charts.extend(executed)
+        return charts
+
+    def _execute(
+        self,
+        code_specs: List[str],
+        data: Any,
+        summary: Summary,
+        library="altair",
+        return_error: bool = False,
+        sql: DuckDBBackend = None,
+        cubes: CubeSet = None,
     ) -> Any:
         """Validate and convert code"""
 
@@ -104,16 +217,38 @@ class ChartExecutor:
         if isinstance(summary, dict):
             summary = Summary(**summary)
 
+        query = sql.query if sql is not None else None
+        loader = DataLoader(data, summary) if isinstance(data, str) else None
+
+        def run(code):
+            """Execute code on the data it needs and return its variables"""
+            if loader is None:
+                ex_locals = get_globals_dict(code, data, query, cubes)
+                exec(code, ex_locals)
+                return ex_locals
+            loaded = loader.load(code)
+            ex_locals = get_globals_dict(code, loaded, query, cubes)
+            try:
+                exec(code, ex_locals)
+            except KeyError as exception_error:
+                # a column the analysis missed, e.g. one named in an f-string
+                if not loader.projected(loaded):
+                    raise
+                logger.warning("Executing on all columns of %s. Missing %s", data, exception_error)
+                ex_locals = get_globals_dict(code, loader.data, query, cubes)
+                exec(code, ex_locals)
+            return ex_locals
+
         charts = []
         code_spec_copy = code_specs.copy()
         code_specs = [preprocess_code(code) for code in code_specs]
         if library == "altair":
             for code in code_specs:
                 try:
-                    ex_locals = get_globals_dict(code, data)
-                    exec(code, ex_locals)
+                    ex_locals = run(code)
                     chart = ex_locals["chart"]
-                    vega_spec = chart.to_dict()
+                    with track("encode"):
+                        vega_spec = chart.to_dict()
                     del vega_spec["data"]
                     if "datasets" in vega_spec:
                         del vega_spec["datasets"]
@@ -148,12 +283,12 @@ class ChartExecutor:
                         )
             return charts
         elif library == "matplotlib" or library == "seaborn":
+            import matplotlib.pyplot as plt
             # print colum dtypes
             for code in code_specs:
                 try:
-                    ex_locals = get_globals_dict(code, data)
+                    ex_locals = run(code)
                     # print(ex_locals)
-                    exec(code, ex_locals)
                     chart = ex_locals["chart"]
                     if plt:
                         buf = io.BytesIO()
@@ -166,9 +301,10 @@ class ChartExecutor:
                         #     print("Warning: tight_layout encountered an error. The layout may not be optimal.")
                         #     pass
 
-                        plt.savefig(buf, format="png", dpi=100, pad_inches=0.2)
-                        buf.seek(0)
-                        plot_data = base64.b64encode(buf.read()).decode("ascii")
+                        with track("encode"):
+                            plt.savefig(buf, format="png", dpi=100, pad_inches=0.2)
+                            buf.seek(0)
+                            plot_data = base64.b64encode(buf.read()).decode("ascii")
                         plt.close()
                     charts.append(
                         ChartExecutorResponse(
@@ -199,16 +335,17 @@ class ChartExecutor:
                         )
             return charts
         elif library == "ggplot":
+            import matplotlib.pyplot as plt
             # print colum dtypes
             for code in code_specs:
                 try:
-                    ex_locals = get_globals_dict(code, data)
-                    exec(code, ex_locals)
+                    ex_locals = run(code)
                     chart = ex_locals["chart"]
                     if plt:
                         buf = io.BytesIO()
-                        chart.save(buf, format="png")
-                        plot_data = base64.b64encode(buf.getvalue()).decode("utf-8")
+                        with track("encode"):
+                            chart.save(buf, format="png")
+                            plot_data = base64.b64encode(buf.getvalue()).decode("utf-8")
                     charts.append(
                         ChartExecutorResponse(
                             spec=None,
@@ -238,15 +375,16 @@ class ChartExecutor:
             return charts
 
         elif library == "plotly":
+            import plotly.io as pio
             for code in code_specs:
                 try:
-                    ex_locals = get_globals_dict(code, data)
-                    exec(code, ex_locals)
+                    ex_locals = run(code)
                     chart = ex_locals["chart"]
 
                     if pio:
-                        chart_bytes = pio.to_image(chart, 'png')
-                        plot_data = base64.b64encode(chart_bytes).decode('utf-8')
+                        with track("encode"):
+                            chart_bytes = pio.to_image(chart, 'png')
+                            plot_data = base64.b64encode(chart_bytes).decode('utf-8')
 
                         charts.append(
                             ChartExecutorResponse(
@@ -1,8 +1,11 @@
 import json
 import logging
-from lida.utils import clean_code_snippet
+import re
+from typing import Any, FrozenSet, List, Optional, Set
+from lida.utils import clean_code_snippet, prompt_summary
 from llmx import TextGenerator
 from lida.datamodel import Goal, TextGenerationConfig, Persona
+from lida.instrumentation import instrumented
 
 
 SYSTEM_INSTRUCTIONS = """
@@ -21,6 +24,120 @@ THE OUTPUT SHOULD ONLY USE THE JSON FORMAT ABOVE.
 
 logger = logging.getLogger("lida")
 
+# chart types by the words goals use for them, checked in order
+CHART_TYPES = [
+    ("histogram", ["histogram", "distribution plot"]),
+    ("box", ["box plot", "boxplot", "box-plot", "violin"]),
+    ("heatmap", ["heatmap", "heat map", "correlation matrix"]),
+    ("scatter", ["scatter", "scatterplot", "bubble"]),
+    ("line", ["line chart", "line plot", "lineplot", "line graph", "time series", "trend"]),
+    ("area", ["area chart", "area plot"]),
+    ("pie", ["pie", "donut"]),
+    ("map", ["map", "choropleth", "geographic"]),
+    ("bar", ["bar", "barplot", "barchart", "column chart", "count plot", "countplot"]),
+]
+# keywords match whole words, optionally plural, so "embarked" is not a bar chart nor "mapping" a map
+_CHART_TYPE_PATTERNS = [
+    (chart_type, re.compile(r"\b(?:" + "|".join(re.escape(x) for x in keywords) + r")s?\b"))
+    for chart_type, keywords in CHART_TYPES]
+
+STOP_WORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "by", "and", "or", "to", "is", "are", "what",
+    "how", "does", "do", "which", "with", "across", "between", "vs", "versus", "each", "per",
+    "chart", "plot", "graph", "visualization", "show", "showing", "data", "dataset",
+}
+
+
+def _field_names(summary: Any) -> List[str]:
+    if isinstance(summary, dict):
+        names = summary.get("field_names") or [x["column"] for x in summary.get("fields") or []]
+    else:
+        names = getattr(summary, "field_names", None) or []
+    return [str(x) for x in names]
+
+
+def goal_fields(goal: Goal, field_names: List[str]) -> FrozenSet[str]:
+    """Fields of the summary a goal refers to in its question or visualization"""
+    text = f"{goal.question} {goal.visualization}".lower()
+    fields = set()
+    for name in field_names:
+        for variant in {name.lower(), name.lower().replace("_", " ")}:
+            if re.search(r"(?<![\w])" + re.escape(variant) + r"(?![\w])", text):
+                fields.add(name)
+    return frozenset(fields)
+
+
+def goal_chart_type(goal: Goal) -> Optional[str]:
+    """The chart type a goal asks for, e.g. bar or histogram, None when it names none"""
+    text = goal.visualization.lower()
+    for chart_type, pattern in _CHART_TYPE_PATTERNS:
+        if pattern.search(text):
+            return chart_type
+    return None
+
+
+def _words(goal: Goal) -> Set[str]:
+    words = re.findall(r"[a-z0-9]+", f"{goal.question} {goal.visualization}".lower())
+    return {x for x in words if x not in STOP_WORDS}
+
+
+def _jaccard(a: Set, b: Set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def rank_goals(goals: List[Goal], summary: Any, similarity_threshold: float = 0.8,
+               diversity: float = 0.5) -> List[Goal]:
+    """
+    Drop near duplicate goals and order the rest so that distinct goals come first, without llm calls.
+
+    Goals are compared by the fields they refer to, their chart type and the words of their
+    question and visualization. A goal is a duplicate of an earlier one when both chart the same
+    fields with the same chart type, or when their similarity reaches the threshold.
+
+    :param goals: Goals in the order the model returned them.
+    :param summary: Summary of the data, for its field names.
+    :param similarity_threshold: Similarity (0 to 1) from which a goal is a duplicate.
+    :param diversity: Weight (0 to 1) of the dissimilarity to goals ranked before, against the order of the model.
+    :return: The distinct goals, ranked and re-indexed.
+    """
+    field_names = _field_names(summary)
+    features = [(goal_fields(x, field_names), goal_chart_type(x), _words(x)) for x in goals]
+
+    def similarity(i: int, j: int) -> float:
+        (fields_i, type_i, words_i), (fields_j, type_j, words_j) = features[i], features[j]
+        if fields_i and fields_i == fields_j and type_i == type_j:
+            return 1.0
+        return 0.5 * _jaccard(fields_i, fields_j) + 0.2 * (type_i == type_j) + \
+            0.3 * _jaccard(words_i, words_j)
+
+    distinct = []
+    for i in range(len(goals)):
+        if all(similarity(i, j) < similarity_threshold for j in distinct):
+            distinct.append(i)
+
+    # maximal marginal relevance: the model's order, penalized by similarity to ranked goals
+    ranked = []
+
+    def score(i: int) -> float:
+        relevance = 1 - i / len(goals)
+        redundancy = max((similarity(i, j) for j in ranked), default=0.0)
+        return (1 - diversity) * relevance - diversity * redundancy
+
+    remaining = list(distinct)
+    while remaining:
+        best = max(remaining, key=score)
+        ranked.append(best)
+        remaining.remove(best)
+
+    result = []
+    for index, i in enumerate(ranked):
+        goal = goals[i]
+        result.append(Goal(question=goal.question, visualization=goal.visualization,
+                           rationale=goal.rationale, index=index))
+    if len(result) < len(goals):
+        logger.info("Dropped %d near duplicate goals", len(goals) - len(result))
+    return result
+
 
 class GoalExplorer():
     """Generate goals given a summary of data"""
@@ -28,12 +145,13 @@ class GoalExplorer():
     def __init__(self) -> None:
         pass
 
+    @instrumented("goal")
     def generate(self, summary: dict, textgen_config: TextGenerationConfig,
                  text_gen: TextGenerator, n=5, persona: Persona = None) -> list[Goal]:
         """Generate goals given a summary of data"""
 
         user_prompt = f"""The number of GOALS to generate is {n}. The goals should be based on the data summary below, \n\n .
-        {summary} \n\n"""
+        {prompt_summary(summary)} \n\n"""
 
         if not persona:
             persona = Persona(
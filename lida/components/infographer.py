@@ -1,53 +1,143 @@
 
+import hashlib
 import logging
-from typing import Any, List, Union
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Union
 import PIL
 from peacasso.generator import ImageGenerator
 from peacasso.datamodel import GeneratorConfig, ModelConfig
 from peacasso.utils import base64_to_pil, pil_to_base64
 import torch
 
+from lida.instrumentation import record_cache
+
 logger = logging.getLogger("lida")
 
 
+class InfographicBatch:
+    """Requests for the same visualization collected for a single diffusion pass"""
+
+    def __init__(self, visualization: Any) -> None:
+        self.visualization = visualization
+        self.prompts: List[str] = []
+        self.n = 0
+        self.future = Future()
+
+    def add(self, style_prompt: str, n: int) -> int:
+        """Add a request, returning the index of its prompt in the pass"""
+        if style_prompt not in self.prompts:
+            self.prompts.append(style_prompt)
+        self.n = max(self.n, n)
+        return self.prompts.index(style_prompt)
+
+
 class Infographer():
-    """Generate infographics given a visualization and a summary of data"""
+    """Generate infographics given a visualization and a summary of data
 
-    def __init__(self, model_config: ModelConfig = None) -> None:
+    The model is loaded on first use and kept in memory until it has been idle for idle_timeout
+    seconds. Concurrent requests for the same visualization are batched into one diffusion pass,
+    one prompt per distinct style. Without a GPU, the model runs on the CPU with fewer inference
+    steps.
+
+    Args:
+        model_config (ModelConfig, optional): Diffusion model, on the GPU when one is available.
+        idle_timeout (float, optional): Seconds after the last generation the model is unloaded. None keeps it loaded. Defaults to 600.
+        batch_window (float, optional): Seconds a generation waits for concurrent requests to batch with. Defaults to 0.05.
+        max_batch_size (int, optional): Maximum number of style prompts in a pass. Defaults to 4.
+        num_inference_steps (int, optional): Diffusion steps on a GPU. Defaults to 50.
+        cpu_inference_steps (int, optional): Diffusion steps on the CPU. Defaults to 20.
+    """
+
+    def __init__(self, model_config: ModelConfig = None, idle_timeout: float = 600,
+                 batch_window: float = 0.05, max_batch_size: int = 4,
+                 num_inference_steps: int = 50, cpu_inference_steps: int = 20) -> None:
         self.model = None
         self.model_config = model_config or ModelConfig(
-            device="cuda",
+            device="cuda" if torch.cuda.is_available() else "cpu",
             model="runwayml/stable-diffusion-v1-5",
             revision="main"
         )
+        self.idle_timeout = idle_timeout
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.num_inference_steps = num_inference_steps
+        self.cpu_inference_steps = cpu_inference_steps
+        self._model_lock = threading.Lock()
+        # diffusion passes run one at a time, the pipeline is not thread safe
+        self._generate_lock = threading.Lock()
+        self._batches: Dict[str, InfographicBatch] = {}
+        self._batches_lock = threading.Lock()
+        self._last_used = time.monotonic()
+        self._idle_timer = None
 
-    def load_model(self) -> None:
-        """Load image generator model from config"""
-        self.model = ImageGenerator(model_config=self.model_config)
+    @property
+    def cpu(self) -> bool:
+        return self.model_config.device == "cpu"
 
-    def generate(
-            self, visualization: Union[torch.FloatTensor, PIL.Image.Image, str],
-            n: int, style_prompt: Union[str, List[str]] = "line art pastel",
-            return_pil: bool = True
-    ) -> List[Any]:
-        """Generate a an infographic, given a visualization and style"""
+    def load_model(self) -> ImageGenerator:
+        """Load image generator model from config, unless it is loaded"""
+        with self._model_lock:
+            if self.model is None:
+                logger.info("Loading infographics model %s on %s",
+                            self.model_config.model, self.model_config.device)
+                self.model = ImageGenerator(model_config=self.model_config)
+            return self.model
+
+    def unload_model(self) -> None:
+        """Release the model and the GPU memory it holds"""
+        with self._generate_lock:
+            self._release_model()
+
+    def _release_model(self) -> None:
+        """Call with the generate lock held"""
+        with self._model_lock:
+            if self.model is None:
+                return
+            logger.info("Unloading idle infographics model")
+            self.model = None
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
 
+    def _schedule_unload(self) -> None:
+        self._last_used = time.monotonic()
+        if self.idle_timeout is None or self._idle_timer is not None:
+            return
+        self._idle_timer = threading.Timer(self.idle_timeout, self._unload_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _unload_if_idle(self) -> None:
+        # waits for a running pass, then checks the idle time it left behind
+        with self._generate_lock:
+            self._idle_timer = None
+            idle = time.monotonic() - self._last_used
+            if idle >= self.idle_timeout:
+                self._release_model()
+            else:
+                # used since the timer started, check again when the remaining time is up
+                self._idle_timer = threading.Timer(self.idle_timeout - idle, self._unload_if_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+
+    @staticmethod
+    def _batch_key(visualization: Union[torch.FloatTensor, PIL.Image.Image, str]) -> str:
         if isinstance(visualization, str):
-            try:
-                visualization, _ = base64_to_pil(visualization)
-            except Exception as pil_exception:
-                logger.error(pil_exception)
-                raise ValueError(
-                    f'Could not convert provided visualization to PIL image, {str(pil_exception)}') from pil_exception
-            self.load_model()
+            return hashlib.md5(visualization.encode("utf-8")).hexdigest()
+        if isinstance(visualization, PIL.Image.Image):
+            return hashlib.md5(visualization.tobytes()).hexdigest()
+        return None
 
+    def _run(self, visualization: Any, prompt: Union[str, List[str]], n: int) -> Dict[str, Any]:
+        """A diffusion pass of n images for each prompt"""
         gen_config = GeneratorConfig(
-            prompt=style_prompt,
+            prompt=prompt,
             num_images=n,
             width=512,
             height=512,
             guidance_scale=7.5,
-            num_inference_steps=50,
+            num_inference_steps=self.cpu_inference_steps if self.cpu else self.num_inference_steps,
             init_image=visualization,
             return_intermediates=False,
             seed=2147483647,
@@ -55,8 +145,58 @@ class Infographer():
             negative_prompt="text, background shapes or lines, title, words, characters, titles, letters",
             strength=0.6,
             filter_nsfw=False)
+        with self._generate_lock:
+            # loaded under the lock, so an idle unload cannot release the model before the pass
+            model = self.load_model()
+            try:
+                return model.generate(gen_config)
+            finally:
+                self._schedule_unload()
+
+    def generate(
+            self, visualization: Union[torch.FloatTensor, PIL.Image.Image, str],
+            n: int, style_prompt: Union[str, List[str]] = "line art pastel",
+            return_pil: bool = True
+    ) -> List[Any]:
+        """Generate a an infographic, given a visualization and style"""
+
+        key = self._batch_key(visualization)
+        if isinstance(visualization, str):
+            try:
+                visualization, _ = base64_to_pil(visualization)
+            except Exception as pil_exception:
+                logger.error(pil_exception)
+                raise ValueError(
+                    f'Could not convert provided visualization to PIL image, {str(pil_exception)}') from pil_exception
+
+        if key is None or not isinstance(style_prompt, str):
+            # tensors and lists of prompts are a pass of their own
+            result = self._run(visualization, style_prompt, n)
+        else:
+            with self._batches_lock:
+                batch = self._batches.get(key)
+                is_leader = batch is None or len(batch.prompts) >= self.max_batch_size
+                if is_leader:
+                    batch = InfographicBatch(visualization)
+                    self._batches[key] = batch
+                index = batch.add(style_prompt, n)
+            record_cache("infographics_batch", hit=not is_leader)
+            if is_leader:
+                # collect concurrent requests for the visualization, then close the batch
+                time.sleep(self.batch_window)
+                with self._batches_lock:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+                try:
+                    batch.future.set_result(self._run(batch.visualization, batch.prompts, batch.n))
+                except BaseException as exception_error:
+                    batch.future.set_exception(exception_error)
+                    raise
+            batched = batch.future.result()
+            # the pass returns batch.n images per prompt, in prompt order
+            images = batched["images"][index * batch.n:index * batch.n + n]
+            result = {**batched, "images": images}
 
-        result = self.model.generate(gen_config)
         if not return_pil:
             result["images"] = [pil_to_base64(img) for img in result["images"]]
         return result
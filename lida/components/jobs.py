@@ -0,0 +1,244 @@
+# Background jobs for long running operations (llm enriched summaries, recommendations,
+# infographics). A job is submitted to a bounded pool of workers and its id returned at once, so
+# clients poll or subscribe for its status instead of holding a connection open for the whole
+# operation. Finished jobs are kept for a ttl, and published to a store when one is given so any
+# process of the server can answer for them. The process running a job renews its lease in the
+# store, a job whose lease expires (its process died) is reported failed.
+
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from .store import Store
+
+logger = logging.getLogger("lida")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = [SUCCEEDED, FAILED, CANCELLED]
+
+
+class Job:
+    """An operation run in the background"""
+
+    def __init__(self, operation: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.heartbeat = self.created
+        self.future: Optional[Future] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "operation": self.operation,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "heartbeat": self.heartbeat,
+        }
+
+
+class JobQueue:
+    """Run jobs in a bounded pool of background workers.
+
+    Args:
+        max_workers (int, optional): Number of jobs run at the same time. Defaults to 4.
+        max_pending (int, optional): Number of queued and running jobs above which submissions are refused. Defaults to 100.
+        ttl (float, optional): Seconds finished jobs and their results are kept. Defaults to 3600.
+        store (Store, optional): Store jobs are published to, so other processes of the server can report and cancel them. Defaults to None.
+        lease (float, optional): Seconds an unfinished job of another process is reported without a heartbeat before it is marked failed. Heartbeats are sent every third of it. Defaults to 60.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 100, ttl: float = 3600,
+                 store: Store = None, lease: float = 60) -> None:
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.store = store
+        self.lease = lease
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="lida-job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._changed = threading.Condition()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+
+    def _expire(self) -> None:
+        """Drop finished jobs older than the ttl. Call with the lock held"""
+        now = time.time()
+        for job_id in [x for x, job in self._jobs.items()
+                       if job.done and now - job.finished > self.ttl]:
+            del self._jobs[job_id]
+
+    def _publish(self, job: Job) -> None:
+        """Record a status change. Call with the lock held"""
+        if self.store is not None:
+            # unfinished jobs are kept until they finish, plus the ttl
+            self.store.set(f"job:{job.id}", job.to_dict(),
+                           expire=self.ttl if job.done else None)
+        self._changed.notify_all()
+
+    def submit(self, operation: str, fn: Callable[..., Any], *args, **kwargs) -> str:
+        """
+        Run fn(*args, **kwargs) in the background, in a copy of the current context.
+
+        :param operation: Name of the operation, reported with the job.
+        :return: The id of the job.
+        :raises RuntimeError: When max_pending jobs are already queued or running.
+        """
+        job = Job(operation)
+        with self._changed:
+            self._expire()
+            pending = sum(1 for x in self._jobs.values() if not x.done)
+            if pending >= self.max_pending:
+                raise RuntimeError(f"Too many pending jobs ({pending}), please try again later")
+            self._jobs[job.id] = job
+            self._publish(job)
+            job.future = self._executor.submit(
+                contextvars.copy_context().run, self._run, job, fn, args, kwargs)
+            if self.store is not None and self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renew_leases, daemon=True,
+                                                   name="lida-job-heartbeat")
+                self._heartbeat.start()
+        return job.id
+
+    def _renew_leases(self) -> None:
+        """Publish a heartbeat for the unfinished jobs of this process every third of the lease"""
+        while not self._stopped.wait(self.lease / 3):
+            with self._changed:
+                now = time.time()
+                for job in self._jobs.values():
+                    if not job.done:
+                        job.heartbeat = now
+                        self._publish(job)
+
+    def _check_lease(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Mark a job of another process failed when its lease has expired"""
+        if job["status"] in FINISHED_STATUSES or \
+                time.time() - job.get("heartbeat", job["created"]) <= self.lease:
+            return job
+        logger.warning(f"Job {job['id']} ({job['operation']}) lost its worker")
+        job = {**job, "status": FAILED, "finished": time.time(),
+               "error": "The process running the job stopped, please submit it again"}
+        self.store.set(f"job:{job['id']}", job, expire=self.ttl)
+        return job
+
+    def _cancel_requested(self, job: Job) -> bool:
+        return self.store is not None and f"job_cancel:{job.id}" in self.store
+
+    def _run(self, job: Job, fn: Callable[..., Any], args: tuple, kwargs: dict) -> None:
+        with self._changed:
+            if job.done:
+                return
+            if self._cancel_requested(job):
+                return self._finish(job, CANCELLED)
+            job.status = RUNNING
+            job.started = time.time()
+            self._publish(job)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exception_error:
+            logger.error(f"Job {job.id} ({job.operation}) failed: {str(exception_error)}")
+            with self._changed:
+                if not job.done:
+                    self._finish(job, FAILED, error=str(exception_error))
+            return
+        with self._changed:
+            # a job cancelled while running finishes its work, its result is discarded
+            if job.done:
+                return
+            if self._cancel_requested(job):
+                self._finish(job, CANCELLED)
+            else:
+                self._finish(job, SUCCEEDED, result=result)
+
+    def _finish(self, job: Job, status: str, result: Any = None, error: str = None) -> None:
+        """Call with the lock held"""
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished = job.finished or time.time()
+        self._publish(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The status (and result, once succeeded) of a job, or None for unknown or expired jobs"""
+        with self._changed:
+            self._expire()
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        if self.store is None:
+            return None
+        job = self.store.get(f"job:{job_id}")
+        return self._check_lease(job) if job is not None else None
+
+    def wait(self, job_id: str, status: str = None,
+             timeout: float = None) -> Optional[Dict[str, Any]]:
+        """
+        Wait until a job leaves the given status (or finishes), at most timeout seconds.
+
+        :return: The job, as returned by get.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._changed:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    if job.done or job.status != status:
+                        return job.to_dict()
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return job.to_dict()
+                    self._changed.wait(remaining)
+                    continue
+            # a job of another process, polled through the store
+            job = self.get(job_id)
+            if job is None or job["status"] in FINISHED_STATUSES or job["status"] != status or \
+                    (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(0.5 if deadline is None else max(0.0, min(0.5, deadline - time.monotonic())))
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job. Queued jobs do not run, the results of running jobs are discarded.
+
+        :return: False for unknown or already finished jobs.
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job.done:
+                    return False
+                job.future.cancel()
+                self._finish(job, CANCELLED)
+                return True
+        job = self.get(job_id)
+        if job is None or job["status"] in FINISHED_STATUSES:
+            return False
+        # the process running the job checks for the request before and after running it
+        self.store.set(f"job_cancel:{job_id}", True, expire=self.ttl)
+        return True
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
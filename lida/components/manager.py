@@ -5,19 +5,33 @@
 # generate generate visualization specifications given a summary and a goal
 # execute the specification given some data
 
+import contextvars
 import os
-from typing import List, Union
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Union
 import logging
 
 import pandas as pd
 from llmx import llm, TextGenerator
-from lida.datamodel import Goal, Summary, TextGenerationConfig, Persona
+from lida.datamodel import ChartExecutorResponse, Goal, Summary, TextGenerationConfig, Persona
+from lida.instrumentation import Instrumentation, instrumented
 from lida.utils import read_dataframe
 from ..components.summarizer import Summarizer
-from ..components.goal import GoalExplorer
+from ..components.goal import GoalExplorer, rank_goals
 from ..components.persona import PersonaExplorer
-from ..components.executor import ChartExecutor
-from ..components.viz import VizGenerator, VizEditor, VizExplainer, VizEvaluator, VizRepairer, VizRecommender
+from ..components.chartcache import ChartCache
+from ..components.cubes import CubeBuilder, CubeSet
+from ..components.executor import COLUMNAR_EXTENSIONS, ChartExecutor
+from ..components.prefetcher import ChartPrefetcher
+from ..components.sqlbackend import DuckDBBackend
+from ..components.tables import TableCollection
+from ..components.scheduler import BACKGROUND_PRIORITY, LLMScheduler, ScheduledTextGenerator, llm_priority
+from ..components.textgen import (CoalescingTextGenerator, ContextCheckedTextGenerator,
+                                  InstrumentedTextGenerator, RoutingTextGenerator, TextGeneratorPool)
+from ..components.viz import VizAnalyzer, VizGenerator, VizEditor, VizExplainer, VizEvaluator, VizRepairer, VizRecommender
 
 import lida.web as lida
 
@@ -26,66 +40,209 @@ logger = logging.getLogger("lida")
 
 
 class Manager(object):
-    def __init__(self, text_gen: TextGenerator = None) -> None:
+    def __init__(self, text_gen: TextGenerator = None,
+                 instrumentation: Instrumentation = None,
+                 coalesce_requests: bool = False,
+                 fallback_providers: List[str] = None,
+                 routing: str = "priority",
+                 scheduler: LLMScheduler = None,
+                 prefetcher: ChartPrefetcher = None,
+                 chart_cache: ChartCache = None,
+                 backend: str = "pandas",
+                 cube_builder: CubeBuilder = None) -> None:
         """
         Initialize the Manager object.
 
         Args:
             text_gen (TextGenerator, optional): Text generator object. Defaults to None.
+            instrumentation (Instrumentation, optional): Records per-stage latency, token and cache metrics. Defaults to None.
+            coalesce_requests (bool, optional): Share one llm call between concurrent identical requests. Defaults to False.
+            fallback_providers (List[str], optional): Providers to fall back to on timeouts or rate limits. Defaults to None.
+            routing (str, optional): Order in which providers are tried, "priority" (the requested provider first) or "latency" (fastest first). Defaults to "priority".
+            scheduler (LLMScheduler, optional): Rate limits llm calls and retries transient errors. explain and evaluate calls wait behind interactive ones. Defaults to None.
+            prefetcher (ChartPrefetcher, optional): Generates charts for the top goals in the background as soon as goals are produced. Defaults to None.
+            chart_cache (ChartCache, optional): Returns executed charts for code that already ran on the same data, library and file. Defaults to None.
+            backend (str, optional): Where chart code transforms the data, "pandas" (a sample of the rows in memory) or "duckdb" (sql queries over the full dataset, requires duckdb). Defaults to "pandas".
+            cube_builder (CubeBuilder, optional): Computes group by cubes over the full data when summarizing, exposed to chart code as cubes. Defaults to None.
         """
 
-        self.text_gen = text_gen or llm()
+        self.instrumentation = instrumentation
+        self.coalesce_requests = coalesce_requests
+        self.fallback_providers = fallback_providers or []
+        self.routing = routing
+        self.scheduler = scheduler
+        self.prefetcher = prefetcher
+        self.pool = TextGeneratorPool()
+        self._text_gens = {}
+        self._text_gens_lock = threading.Lock()
+
+        # the default client is created on first use, so constructing a Manager (e.g. when the
+        # web app is imported) does not build an llm client
+        self._default_text_gen = text_gen
+        self._text_gen = None
+        self._default_text_gen_lock = threading.Lock()
+        if text_gen is not None:
+            self.pool.add(text_gen)
+
+        self.backend = backend
+        # sql backend of the summarized data, set by summarize when backend is "duckdb"
+        self.sql = None
+        self.cube_builder = cube_builder
+        # cubes of the summarized data, set by summarize when a cube builder is given
+        self.cubes = None
 
         self.summarizer = Summarizer()
         self.goal = GoalExplorer()
-        self.vizgen = VizGenerator()
-        self.vizeditor = VizEditor()
-        self.executor = ChartExecutor()
+        self.vizgen = VizGenerator(backend=backend)
+        self.vizeditor = VizEditor(backend=backend)
+        self.executor = ChartExecutor(cache=chart_cache)
         self.explainer = VizExplainer()
         self.evaluator = VizEvaluator()
-        self.repairer = VizRepairer()
-        self.recommender = VizRecommender()
+        self.analyzer = VizAnalyzer()
+        self.repairer = VizRepairer(backend=backend)
+        self.recommender = VizRecommender(backend=backend)
         self.data = None
+        # data of the current request, see use_data
+        self._request_data = contextvars.ContextVar(f"lida_request_data_{id(self)}", default=None)
         self.infographer = None
+        self._infographer_lock = threading.Lock()
         self.persona = PersonaExplorer()
 
-    def check_textgen(self, config: TextGenerationConfig):
+    @contextmanager
+    def use_data(self, data: Union[pd.DataFrame, str, TableCollection],
+                 sql: DuckDBBackend = None, cubes: CubeSet = None):
         """
-        Check if self.text_gen is the same as the config passed in. If not, update self.text_gen.
+        Generate and execute charts on the given data, sql backend and cubes instead of those of
+        the data last summarized by this manager, within the block.
+
+        The data is set for the current context only, so concurrent requests on different
+        datasets can share one manager, and a server can summarize a dataset in one process and
+        serve its charts from others. Prefetches started within the block use the data too.
+        """
+        token = self._request_data.set((data, sql, cubes))
+        try:
+            yield self
+        finally:
+            self._request_data.reset(token)
+
+    @property
+    def current_data(self) -> Union[pd.DataFrame, str, TableCollection, None]:
+        """The data of the current request, or the data last summarized"""
+        request_data = self._request_data.get()
+        return self.data if request_data is None else request_data[0]
+
+    @property
+    def current_sql(self) -> Optional[DuckDBBackend]:
+        if self.backend != "duckdb":
+            return None
+        request_data = self._request_data.get()
+        return self.sql if request_data is None else request_data[1]
+
+    @property
+    def current_cubes(self) -> Optional[CubeSet]:
+        request_data = self._request_data.get()
+        return self.cubes if request_data is None else request_data[2]
+
+    @property
+    def text_gen(self) -> TextGenerator:
+        """The text generator of the default provider"""
+        if self._text_gen is None:
+            with self._default_text_gen_lock:
+                if self._text_gen is None:
+                    default_text_gen = self.pool.add(self._default_text_gen or llm())
+                    self._text_gen = self._get_textgen(default_text_gen.provider)
+        return self._text_gen
+
+    @text_gen.setter
+    def text_gen(self, text_gen: TextGenerator) -> None:
+        """Use text_gen for every later call to its provider"""
+        with self._default_text_gen_lock:
+            self.pool.replace(text_gen)
+            with self._text_gens_lock:
+                # wrappers of the provider hold the previous client, as primary or as fallback
+                self._text_gens.clear()
+            self._default_text_gen = text_gen
+            self._text_gen = None
+
+    def _wrap_textgen(self, text_gen: TextGenerator) -> TextGenerator:
+        """Wrap a text generator with the behaviour configured on this manager"""
+        if self.instrumentation is not None:
+            text_gen = InstrumentedTextGenerator(text_gen)
+        if self.scheduler is not None:
+            # outside the instrumentation so llm stages measure the call, not the queueing
+            text_gen = ScheduledTextGenerator(text_gen, self.scheduler)
+        if self.coalesce_requests:
+            text_gen = CoalescingTextGenerator(text_gen)
+        # outermost, prompts that cannot fit fail before queueing or coalescing
+        return ContextCheckedTextGenerator(text_gen)
+
+    def _get_textgen(self, provider: str, model: str = None) -> TextGenerator:
+        """Return the wrapped text generator for a provider and model, created once and reused"""
+        key = (provider, model)
+        with self._text_gens_lock:
+            if key in self._text_gens:
+                return self._text_gens[key]
+
+        text_gens = [self.pool.get(provider, model)]
+        complete = True
+        for fallback_provider in self.fallback_providers:
+            try:
+                fallback = self.pool.get(fallback_provider)
+            except Exception as exception_error:
+                logger.error(f"Could not create fallback provider {fallback_provider}: {str(exception_error)}")
+                complete = False
+                continue
+            if all(fallback is not x for x in text_gens):
+                text_gens.append(fallback)
+        text_gen = text_gens[0] if len(text_gens) == 1 else \
+            RoutingTextGenerator(text_gens, routing=self.routing)
+        text_gen = self._wrap_textgen(text_gen)
+        if not complete:
+            # retry the missing fallbacks on the next request
+            return text_gen
+
+        with self._text_gens_lock:
+            return self._text_gens.setdefault(key, text_gen)
+
+    def check_textgen(self, config: TextGenerationConfig) -> TextGenerator:
+        """
+        Return the text generator for the provider and model in the config passed in.
+
+        Clients are created once per provider and model and reused, so requests that alternate
+        between providers do not rebuild clients or replace self.text_gen for each other.
 
         Args:
             config (TextGenerationConfig): Text generation configuration.
+
+        Returns:
+            TextGenerator: Text generator to use for the request.
         """
         if config.provider is None:
             config.provider = self.text_gen.provider or "openai"
             logger.info("Provider is not set, using default provider - %s", config.provider)
-            return
 
-        if self.text_gen.provider != config.provider:
-
-            logger.info(
-                "Switching Text Generator Provider from %s to %s",
-                self.text_gen.provider,
-                config.provider)
-            self.text_gen = llm(provider=config.provider)
+        return self._get_textgen(config.provider, config.model)
 
+    @instrumented()
     def summarize(
         self,
-        data: Union[pd.DataFrame, str],
+        data: Union[pd.DataFrame, str, TableCollection],
         file_name="",
         n_samples: int = 3,
         summary_method: str = "default",
         textgen_config: TextGenerationConfig = TextGenerationConfig(n=1, temperature=0),
+        optimize_dtypes: bool = False,
     ) -> Summary:
         """
         Summarize data given a DataFrame or file path.
 
         Args:
-            data (Union[pd.DataFrame, str]): Input data, either a DataFrame or file path.
+            data (Union[pd.DataFrame, str, TableCollection]): Input data, either a DataFrame, file path or a collection of related tables.
             file_name (str, optional): Name of the file if data is loaded from a file path. Defaults to "".
             n_samples (int, optional): Number of summary samples to generate. Defaults to 3.
             summary_method (str, optional): Summary method to use. Defaults to "default".
             textgen_config (TextGenerationConfig, optional): Text generation configuration. Defaults to TextGenerationConfig(n=1, temperature=0).
+            optimize_dtypes (bool, optional): Read files with the pyarrow csv engine (when installed) and store columns in compact dtypes. Defaults to False.
 
         Returns:
             Summary: Summary object containing the generated summary.
@@ -121,23 +278,83 @@ class Manager(object):
             }
 
         """
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
+        source = data
+        if self.backend == "duckdb":
+            # queries run over the file itself, which read_dataframe rewrites with clean column
+            # names and all its rows, not over the sampled rows read below
+            self.sql = DuckDBBackend(data)
         if isinstance(data, str):
             file_name = data.split("/")[-1]
-            data = read_dataframe(data)
+            data = read_dataframe(data, optimize=optimize_dtypes)
 
         self.data = data
-        return self.summarizer.summarize(
-            data=self.data, text_gen=self.text_gen, file_name=file_name, n_samples=n_samples,
+        if self.prefetcher is not None:
+            # prefetched charts were executed on the previous data
+            self.prefetcher.cancel()
+        self.cubes = None
+        if isinstance(data, TableCollection):
+            # charts receive the collection as data and load the tables they use
+            return self.summarizer.summarize_tables(
+                tables=data, text_gen=text_gen, n_samples=n_samples,
+                summary_method=summary_method, textgen_config=textgen_config)
+        summary = self.summarizer.summarize(
+            data=self.data, text_gen=text_gen, file_name=file_name, n_samples=n_samples,
             summary_method=summary_method, textgen_config=textgen_config)
+        if self.cube_builder is not None and summary.get("fields"):
+            # aggregated over every row of the file, not the sampled rows
+            self.cubes = self.cube_builder.build(source, summary["fields"])
+            summary["cubes"] = self.cubes.describe()
+        return summary
+
+    @instrumented()
+    def update_summary(
+        self,
+        summary: Summary,
+        data: pd.DataFrame,
+        n_samples: int = 3,
+        textgen_config: TextGenerationConfig = TextGenerationConfig(n=1, temperature=0),
+        drift_threshold: float = 0.5,
+    ) -> Summary:
+        """
+        Update a summary with rows appended to the dataset, without summarizing it again.
+
+        Args:
+            summary (Summary): Summary of the dataset before the rows were appended.
+            data (pd.DataFrame): The appended rows.
+            n_samples (int, optional): Number of summary samples. Defaults to 3.
+            textgen_config (TextGenerationConfig, optional): Text generation configuration for re-enriching changed columns.
+            drift_threshold (float, optional): Mean shift, in standard deviations, above which an enriched column is enriched again. Defaults to 0.5.
 
+        Returns:
+            Summary: The updated summary.
+        """
+        text_gen = self.check_textgen(config=textgen_config)
+        updated = self.summarizer.update(
+            summary, data, text_gen=text_gen, n_samples=n_samples,
+            textgen_config=textgen_config, drift_threshold=drift_threshold)
+
+        if self.data is not None:
+            self.data = pd.concat([self.data, data], ignore_index=True)
+            if self.sql is not None and isinstance(self.sql.source, pd.DataFrame):
+                self.sql = DuckDBBackend(self.data)
+        if self.cubes is not None:
+            self.cubes = self.cube_builder.update(self.cubes, data)
+            updated["cubes"] = self.cubes.describe()
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+        return updated
+
+    @instrumented()
     def goals(
         self,
         summary: Summary,
         textgen_config: TextGenerationConfig = TextGenerationConfig(),
         n: int = 5,
-        persona: Persona = None
+        persona: Persona = None,
+        session: str = None,
+        dedupe: bool = False,
     ) -> List[Goal]:
         """
         Generate goals based on a summary.
@@ -147,6 +364,8 @@ class Manager(object):
             textgen_config (TextGenerationConfig, optional): Text generation configuration. Defaults to TextGenerationConfig().
             n (int, optional): Number of goals to generate. Defaults to 5.
             persona (Persona, str, dict, optional): Persona information. Defaults to None.
+            session (str, optional): Session the prefetched charts of the top goals are cached for, when a prefetcher is set. Defaults to None.
+            dedupe (bool, optional): Drop near duplicate goals (same fields and chart type, or similar wording) and rank distinct goals first, so charts are only generated for distinct goals. May return fewer than n goals. Defaults to False.
 
         Returns:
             List[Goal]: List of generated goals.
@@ -167,24 +386,32 @@ class Manager(object):
 
             Rationale: This tells about the distribution of horsepower of cars in the dataset.
         """
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
         if isinstance(persona, dict):
             persona = Persona(**persona)
         if isinstance(persona, str):
             persona = Persona(persona=persona, rationale="")
 
-        return self.goal.generate(summary=summary, text_gen=self.text_gen,
-                                  textgen_config=textgen_config, n=n, persona=persona)
+        goals = self.goal.generate(summary=summary, text_gen=text_gen,
+                                   textgen_config=textgen_config, n=n, persona=persona)
+        if dedupe:
+            goals = rank_goals(goals, summary)
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(goals, summary=summary, textgen_config=textgen_config,
+                                     generate=self._generate_charts, session=session)
+        return goals
 
+    @instrumented()
     def personas(
             self, summary, textgen_config: TextGenerationConfig = TextGenerationConfig(),
             n=5):
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
-        return self.persona.generate(summary=summary, text_gen=self.text_gen,
+        return self.persona.generate(summary=summary, text_gen=text_gen,
                                      textgen_config=textgen_config, n=n)
 
+    @instrumented()
     def visualize(
         self,
         summary,
@@ -192,25 +419,65 @@ class Manager(object):
         textgen_config: TextGenerationConfig = TextGenerationConfig(),
         library="seaborn",
         return_error: bool = False,
+        max_repairs: int = 0,
+        repair_timeout: float = None,
+        session: str = None,
     ):
+        """Generate and execute visualization code for a goal
+
+        Args:
+            summary (Summary): Dataset summary.
+            goal (Union[Goal, dict, str]): Visualization goal.
+            textgen_config (TextGenerationConfig, optional): Text generation configuration.
+            library (str, optional): Visualization library. Defaults to "seaborn".
+            return_error (bool, optional): Return failed charts along with their errors. Defaults to False.
+            max_repairs (int, optional): Number of automatic repair rounds for charts that fail to execute. Defaults to 0 (no repair).
+            repair_timeout (float, optional): Overall latency budget in seconds for the repair rounds. Defaults to None (no budget).
+            session (str, optional): Session whose prefetched charts are used, when a prefetcher is set. Defaults to None.
+
+        Returns:
+            List[ChartExecutorResponse]: List of executed charts.
+        """
         if isinstance(goal, dict):
             goal = Goal(**goal)
         if isinstance(goal, str):
             goal = Goal(question=goal, visualization=goal, rationale="")
 
         self.check_textgen(config=textgen_config)
+        charts = None
+        if self.prefetcher is not None:
+            charts = self.prefetcher.get(goal, summary=summary, textgen_config=textgen_config,
+                                         library=library, session=session)
+        if charts is None:
+            charts = self._generate_charts(summary, goal, textgen_config, library)
+        if not (return_error or max_repairs > 0):
+            charts = [chart for chart in charts if chart.status]
+        if max_repairs > 0:
+            charts = self.repair_failed(
+                charts, goal=goal, summary=summary, textgen_config=textgen_config,
+                library=library, max_repairs=max_repairs, repair_timeout=repair_timeout,
+                return_error=return_error)
+        return charts
+
+    def _generate_charts(self, summary: Summary, goal: Goal,
+                         textgen_config: TextGenerationConfig, library: str,
+                         cancelled: threading.Event = None) -> Optional[List[ChartExecutorResponse]]:
+        """Generate and execute chart code for a goal, returning failed charts too"""
+        text_gen = self.check_textgen(config=textgen_config)
         code_specs = self.vizgen.generate(
-            summary=summary, goal=goal, textgen_config=textgen_config, text_gen=self.text_gen,
+            summary=summary, goal=goal, textgen_config=textgen_config, text_gen=text_gen,
             library=library)
-        charts = self.execute(
+        if cancelled is not None and cancelled.is_set():
+            return None
+        return self.execute(
             code_specs=code_specs,
-            data=self.data,
+            data=self.current_data,
             summary=summary,
             library=library,
-            return_error=return_error,
+            return_error=True,
         )
-        return charts
 
+    @instrumented()
     def execute(
         self,
         code_specs,
@@ -223,9 +490,10 @@ class Manager(object):
         if data is None:
             root_file_path = os.path.dirname(os.path.abspath(lida.__file__))
             print(root_file_path)
-            data = read_dataframe(
-                os.path.join(root_file_path, "files/data", summary.file_name)
-            )
+            data = os.path.join(root_file_path, "files/data", summary.file_name)
+            if data.split(".")[-1] not in COLUMNAR_EXTENSIONS:
+                data = read_dataframe(data)
+            # else the executor reads the columns each chart uses
 
         # col_properties = summary.properties
 
@@ -235,8 +503,11 @@ class Manager(object):
             summary=summary,
             library=library,
             return_error=return_error,
+            sql=self.current_sql,
+            cubes=self.current_cubes,
         )
 
+    @instrumented()
     def edit(
         self,
         code,
@@ -245,18 +516,22 @@ class Manager(object):
         textgen_config: TextGenerationConfig = TextGenerationConfig(),
         library: str = "seaborn",
         return_error: bool = False,
+        max_repairs: int = 0,
+        repair_timeout: float = None,
     ):
         """Edit a visualization code given a set of instructions
 
         Args:
             code (_type_): _description_
             instructions (List[Dict]): A list of instructions
+            max_repairs (int, optional): Number of automatic repair rounds for charts that fail to execute. Defaults to 0.
+            repair_timeout (float, optional): Overall latency budget in seconds for the repair rounds. Defaults to None.
 
         Returns:
             _type_: _description_
         """
 
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
         if isinstance(instructions, str):
             instructions = [instructions]
@@ -266,19 +541,26 @@ class Manager(object):
             summary=summary,
             instructions=instructions,
             textgen_config=textgen_config,
-            text_gen=self.text_gen,
+            text_gen=text_gen,
             library=library,
         )
 
         charts = self.execute(
             code_specs=code_specs,
-            data=self.data,
+            data=self.current_data,
             summary=summary,
             library=library,
-            return_error=return_error,
+            return_error=return_error or max_repairs > 0,
         )
+        if max_repairs > 0:
+            goal = Goal(question="; ".join(instructions), visualization="", rationale="")
+            charts = self.repair_failed(
+                charts, goal=goal, summary=summary, textgen_config=textgen_config,
+                library=library, max_repairs=max_repairs, repair_timeout=repair_timeout,
+                return_error=return_error)
         return charts
 
+    @instrumented()
     def repair(
         self,
         code,
@@ -290,25 +572,134 @@ class Manager(object):
         return_error: bool = False,
     ):
         """ Repair a visulization given some feedback"""
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
         code_specs = self.repairer.generate(
             code=code,
             feedback=feedback,
             goal=goal,
             summary=summary,
             textgen_config=textgen_config,
-            text_gen=self.text_gen,
+            text_gen=text_gen,
             library=library,
         )
         charts = self.execute(
             code_specs=code_specs,
-            data=self.data,
+            data=self.current_data,
             summary=summary,
             library=library,
             return_error=return_error,
         )
         return charts
 
+    @instrumented()
+    def repair_failed(
+        self,
+        charts: List[ChartExecutorResponse],
+        goal: Goal,
+        summary: Summary,
+        textgen_config: TextGenerationConfig = TextGenerationConfig(),
+        library: str = "seaborn",
+        max_repairs: int = 1,
+        repair_timeout: float = None,
+        return_error: bool = False,
+    ) -> List[ChartExecutorResponse]:
+        """Repair charts that failed to execute, re-executing only the repaired specs.
+
+        Failed charts are sent to the repairer in parallel together with their execution
+        errors. Each round only retries charts that are still failing, for at most
+        max_repairs rounds or until repair_timeout seconds have elapsed. Charts whose
+        repair does not finish within the budget are returned as they were. No repair starts an
+        llm call or executes code after the budget, but an llm call already in flight still runs
+        to completion in the background.
+
+        Args:
+            charts (List[ChartExecutorResponse]): Executed charts, including failed ones.
+            goal (Goal): The goal the charts were generated for.
+            summary (Summary): Dataset summary.
+            textgen_config (TextGenerationConfig, optional): Text generation configuration.
+            library (str, optional): Visualization library. Defaults to "seaborn".
+            max_repairs (int, optional): Maximum number of repair rounds. Defaults to 1.
+            repair_timeout (float, optional): Overall latency budget in seconds. Defaults to None.
+            return_error (bool, optional): Keep charts that are still failing in the result. Defaults to False.
+
+        Returns:
+            List[ChartExecutorResponse]: Charts with failed entries replaced by their repairs.
+        """
+        charts = list(charts)
+        deadline = time.monotonic() + repair_timeout if repair_timeout else None
+        # set once the result is returned, repairs still running then stop at their next step
+        cancelled = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=max(1, len(charts)))
+        try:
+            for attempt in range(max_repairs):
+                failed = [i for i, chart in enumerate(charts) if not chart.status]
+                if not failed:
+                    break
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    logger.info("Repair budget exhausted with %d failed charts", len(failed))
+                    break
+                logger.info("Repairing %d failed charts (round %d)", len(failed), attempt + 1)
+                futures = {
+                    pool.submit(
+                        contextvars.copy_context().run, self._repair_chart, charts[i], goal,
+                        summary, textgen_config, library, cancelled): i
+                    for i in failed}
+                done, _ = wait(futures, timeout=remaining)
+                for future in done:
+                    try:
+                        charts[futures[future]] = future.result()
+                    except Exception as exception_error:
+                        logger.error(f"Error repairing chart: {str(exception_error)}")
+        finally:
+            cancelled.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        if not return_error:
+            charts = [chart for chart in charts if chart.status]
+        return charts
+
+    def _repair_chart(
+        self,
+        chart: ChartExecutorResponse,
+        goal: Goal,
+        summary: Summary,
+        textgen_config: TextGenerationConfig,
+        library: str,
+        cancelled: threading.Event = None,
+    ) -> ChartExecutorResponse:
+        """Repair a single failed chart using its error as feedback, unless cancelled"""
+        if cancelled is not None and cancelled.is_set():
+            return chart
+        text_gen = self.check_textgen(config=textgen_config)
+        feedback = {
+            "message": chart.error["message"] if chart.error else "",
+            "traceback": chart.error["traceback"] if chart.error else "",
+        }
+        code_specs = self.repairer.generate(
+            code=chart.code,
+            feedback=feedback,
+            goal=goal,
+            summary=summary,
+            textgen_config=textgen_config,
+            text_gen=text_gen,
+            library=library,
+        )
+        if cancelled is not None and cancelled.is_set():
+            return chart
+        repaired = self.execute(
+            code_specs=code_specs,
+            data=self.current_data,
+            summary=summary,
+            library=library,
+            return_error=True,
+        )
+        successful = [x for x in repaired if x.status]
+        if successful:
+            return successful[0]
+        return repaired[-1] if repaired else chart
+
+    @instrumented()
     def explain(
         self,
         code,
@@ -324,14 +715,16 @@ class Manager(object):
         Returns:
             _type_: _description_
         """
-        self.check_textgen(config=textgen_config)
-        return self.explainer.generate(
-            code=code,
-            textgen_config=textgen_config,
-            text_gen=self.text_gen,
-            library=library,
-        )
+        text_gen = self.check_textgen(config=textgen_config)
+        with llm_priority(BACKGROUND_PRIORITY):
+            return self.explainer.generate(
+                code=code,
+                textgen_config=textgen_config,
+                text_gen=text_gen,
+                library=library,
+            )
 
+    @instrumented()
     def evaluate(
         self,
         code,
@@ -349,16 +742,50 @@ class Manager(object):
             _type_: _description_
         """
 
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
-        return self.evaluator.generate(
-            code=code,
-            goal=goal,
-            textgen_config=textgen_config,
-            text_gen=self.text_gen,
-            library=library,
-        )
+        with llm_priority(BACKGROUND_PRIORITY):
+            return self.evaluator.generate(
+                code=code,
+                goal=goal,
+                textgen_config=textgen_config,
+                text_gen=text_gen,
+                library=library,
+            )
+
+    @instrumented()
+    def analyze(
+        self,
+        code,
+        goal: Goal,
+        textgen_config: TextGenerationConfig = TextGenerationConfig(),
+        library: str = "seaborn",
+    ):
+        """Explain and evaluate a visualization code in a single llm call.
+
+        Costs about half as much as calling explain and evaluate on the same code.
+
+        Args:
+            code (str): Visualization code
+            goal (Goal): A visualization goal
+
+        Returns:
+            dict: "explanations" and "evaluations", one list of sections per completion, in the
+            formats returned by explain and evaluate
+        """
+
+        text_gen = self.check_textgen(config=textgen_config)
+
+        with llm_priority(BACKGROUND_PRIORITY):
+            return self.analyzer.generate(
+                code=code,
+                goal=goal,
+                textgen_config=textgen_config,
+                text_gen=text_gen,
+                library=library,
+            )
 
+    @instrumented()
     def recommend(
         self,
         code,
@@ -367,36 +794,82 @@ class Manager(object):
         textgen_config: TextGenerationConfig = TextGenerationConfig(),
         library: str = "seaborn",
         return_error: bool = False,
+        max_repairs: int = 0,
+        repair_timeout: float = None,
     ):
         """Edit a visualization code given a set of instructions
 
         Args:
             code (_type_): _description_
             instructions (List[Dict]): A list of instructions
+            max_repairs (int, optional): Number of automatic repair rounds for charts that fail to execute. Defaults to 0.
+            repair_timeout (float, optional): Overall latency budget in seconds for the repair rounds. Defaults to None.
 
         Returns:
             _type_: _description_
         """
 
-        self.check_textgen(config=textgen_config)
+        text_gen = self.check_textgen(config=textgen_config)
 
         code_specs = self.recommender.generate(
             code=code,
             summary=summary,
             n=n,
             textgen_config=textgen_config,
-            text_gen=self.text_gen,
+            text_gen=text_gen,
             library=library,
         )
         charts = self.execute(
             code_specs=code_specs,
-            data=self.data,
+            data=self.current_data,
             summary=summary,
             library=library,
-            return_error=return_error,
+            return_error=return_error or max_repairs > 0,
         )
+        if max_repairs > 0:
+            goal = Goal(question="", visualization="", rationale="")
+            charts = self.repair_failed(
+                charts, goal=goal, summary=summary, textgen_config=textgen_config,
+                library=library, max_repairs=max_repairs, repair_timeout=repair_timeout,
+                return_error=return_error)
         return charts
 
+    def recommend_stream(
+        self,
+        code,
+        summary: Summary,
+        n=4,
+        textgen_config: TextGenerationConfig = TextGenerationConfig(),
+        library: str = "seaborn",
+        return_error: bool = False,
+    ) -> Iterator[ChartExecutorResponse]:
+        """Recommend visualizations, executing each one as soon as its code has streamed in.
+
+        The first chart is available while the model is still writing the others.
+
+        Args:
+            code (str): An example visualization code
+            summary (Summary): Dataset summary.
+            n (int, optional): Number of recommendations. Defaults to 4.
+
+        Yields:
+            ChartExecutorResponse: Each executed chart, in the order the model wrote them.
+        """
+
+        text_gen = self.check_textgen(config=textgen_config)
+
+        for code_spec in self.recommender.generate_stream(
+                code=code, summary=summary, n=n, textgen_config=textgen_config,
+                text_gen=text_gen, library=library):
+            yield from self.execute(
+                code_specs=[code_spec],
+                data=self.current_data,
+                summary=summary,
+                library=library,
+                return_error=return_error,
+            )
+
+    @instrumented()
     def infographics(self, visualization: str, n: int = 1,
                      style_prompt: Union[str, List[str]] = "",
                      return_pil: bool = False
@@ -418,13 +891,16 @@ class Manager(object):
 
         except ImportError as exc:
             raise ImportError(
-                'Please install lida with infographics support. pip install lida[infographics]. You will also need a GPU runtime.'
+                'Please install lida with infographics support. pip install lida[infographics]. A GPU runtime is recommended.'
             ) from exc
 
         from ..components.infographer import Infographer
 
-        if self.infographer is None:
-            logger.info("Initializing Infographer")
-            self.infographer = Infographer()
+        with self._infographer_lock:
+            # one infographer, so concurrent requests are batched. Its model is loaded on
+            # first use and kept until it is idle
+            if self.infographer is None:
+                logger.info("Initializing Infographer")
+                self.infographer = Infographer()
         return self.infographer.generate(
             visualization=visualization, n=n, style_prompt=style_prompt, return_pil=return_pil)
@@ -1,8 +1,9 @@
 import json
 import logging
-from lida.utils import clean_code_snippet
+from lida.utils import clean_code_snippet, prompt_summary
 from llmx import TextGenerator
 from lida.datamodel import Persona, TextGenerationConfig
+from lida.instrumentation import instrumented
 
 
 system_prompt = """You are an experienced data analyst  who can take a dataset summary and generate a list of n personas (e.g., ceo or accountant for finance related data, economist for population or gdp related data, doctors for health data, or just users) that might be critical stakeholders in exploring some data and describe rationale for why they are critical. The personas should be prioritized based on their relevance to the data. Think step by step.
@@ -20,12 +21,13 @@ class PersonaExplorer():
     def __init__(self) -> None:
         pass
 
+    @instrumented("persona")
     def generate(self, summary: dict, textgen_config: TextGenerationConfig,
                  text_gen: TextGenerator, n=5) -> list[Persona]:
         """Generate personas given a summary of data"""
 
         user_prompt = f"""The number of PERSONAs to generate is {n}. Generate {n} personas in the right format given the data summary below,\n .
-        {summary} \n""" + """
+        {prompt_summary(summary)} \n""" + """
 
         .
         """
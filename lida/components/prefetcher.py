@@ -0,0 +1,172 @@
+# Speculative generation of charts for the top ranked goals. Users usually pick one of the
+# first few goals, so their charts are generated and executed in the background while the
+# goals are read, and a later visualize call for one of them returns the prefetched charts.
+
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional
+
+from lida.datamodel import ChartExecutorResponse, Goal, Summary, TextGenerationConfig
+from lida.instrumentation import record_cache, track
+from lida.utils import drop_stats
+from .scheduler import BACKGROUND_PRIORITY, llm_priority
+from .store import Store
+
+logger = logging.getLogger("lida")
+
+DEFAULT_SESSION = "default"
+
+# generate(summary, goal, textgen_config, library, cancelled) -> charts, including failed ones
+GenerateCharts = Callable[[Summary, Goal, TextGenerationConfig, str, threading.Event],
+                          Optional[List[ChartExecutorResponse]]]
+
+
+class PrefetchTask:
+    """A background generation for one goal"""
+
+    def __init__(self, future: Future, cancelled: threading.Event, cost: int) -> None:
+        self.future = future
+        self.cancelled = cancelled
+        self.cost = cost
+        self.created = time.monotonic()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        self.future.cancel()
+
+
+class ChartPrefetcher:
+    """Generate and execute charts for the top k goals in the background, cached per session.
+
+    Args:
+        top_k (int, optional): Number of goals to prefetch, from the top of the list. Defaults to 3.
+        library (str, optional): Visualization library of the prefetched charts. Defaults to "seaborn".
+        max_cost (int, optional): Maximum number of speculative completions per session within the ttl. Defaults to 10.
+        max_workers (int, optional): Number of background workers. Defaults to 2.
+        ttl (float, optional): Seconds after which prefetched charts are discarded. Defaults to 600.
+        max_sessions (int, optional): Number of sessions kept, least recently used are discarded first. Defaults to 100.
+        store (Store, optional): Store the prefetched charts are published to, so other processes serving the session can use them. Defaults to None.
+    """
+
+    def __init__(self, top_k: int = 3, library: str = "seaborn", max_cost: int = 10,
+                 max_workers: int = 2, ttl: float = 600, max_sessions: int = 100,
+                 store: Store = None) -> None:
+        self.top_k = top_k
+        self.library = library
+        self.max_cost = max_cost
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="lida-prefetch")
+        self._sessions: "OrderedDict[str, Dict[str, PrefetchTask]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(summary: Summary, goal: Goal, textgen_config: TextGenerationConfig,
+                 library: str) -> str:
+        params = {
+            "summary": drop_stats(summary),
+            "question": goal.question,
+            "visualization": goal.visualization,
+            "config": dict(textgen_config),
+            "library": library,
+        }
+        return hashlib.md5(json.dumps(
+            params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _session(self, session: str) -> Dict[str, PrefetchTask]:
+        """Return the live tasks of a session, dropping expired ones. Call with the lock held"""
+        tasks = self._sessions.setdefault(session, {})
+        self._sessions.move_to_end(session)
+        now = time.monotonic()
+        for key in [k for k, task in tasks.items() if now - task.created > self.ttl]:
+            tasks.pop(key).cancel()
+        while len(self._sessions) > self.max_sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            for task in evicted.values():
+                task.cancel()
+        return tasks
+
+    def prefetch(self, goals: List[Goal], summary: Summary,
+                 textgen_config: TextGenerationConfig, generate: GenerateCharts,
+                 session: str = None) -> int:
+        """Start generating charts for the top k goals. Returns the number of goals started"""
+        session = session or DEFAULT_SESSION
+        cost = textgen_config.n or 1
+        started = 0
+        with self._lock:
+            tasks = self._session(session)
+            spent = sum(task.cost for task in tasks.values())
+            for goal in goals[:self.top_k]:
+                key = self.make_key(summary, goal, textgen_config, self.library)
+                if key in tasks:
+                    continue
+                if spent + cost > self.max_cost:
+                    logger.info("Prefetch budget of session %s is spent, skipping remaining goals",
+                                session)
+                    break
+                cancelled = threading.Event()
+                future = self._executor.submit(
+                    contextvars.copy_context().run, self._run, generate, summary, goal,
+                    textgen_config, cancelled, f"prefetch:{session}:{key}")
+                tasks[key] = PrefetchTask(future, cancelled, cost)
+                spent += cost
+                started += 1
+        return started
+
+    def _run(self, generate: GenerateCharts, summary: Summary, goal: Goal,
+             textgen_config: TextGenerationConfig,
+             cancelled: threading.Event,
+             store_key: str = None) -> Optional[List[ChartExecutorResponse]]:
+        if cancelled.is_set():
+            return None
+        with track("prefetch"), llm_priority(BACKGROUND_PRIORITY):
+            charts = generate(summary, goal, textgen_config, self.library, cancelled)
+        if self.store is not None and charts is not None and not cancelled.is_set():
+            self.store.set(store_key, charts, expire=self.ttl)
+        return charts
+
+    def get(self, goal: Goal, summary: Summary, textgen_config: TextGenerationConfig,
+            library: str, session: str = None,
+            timeout: float = None) -> Optional[List[ChartExecutorResponse]]:
+        """Return the prefetched charts for a goal, waiting for a prefetch in progress.
+
+        Returns None when the goal was not prefetched, or its prefetch failed or was cancelled.
+        Goals prefetched by another process are looked up in the store.
+        """
+        session = session or DEFAULT_SESSION
+        key = self.make_key(summary, goal, textgen_config, library)
+        with self._lock:
+            task = self._session(session).get(key)
+        if task is None:
+            charts = self.store.get(f"prefetch:{session}:{key}") if self.store is not None else None
+            record_cache("prefetch", hit=charts is not None)
+            return charts
+        record_cache("prefetch", hit=True)
+        try:
+            return task.future.result(timeout=timeout)
+        except (CancelledError, FutureTimeoutError):
+            return None
+        except Exception as exception_error:
+            logger.error(f"Prefetch failed, generating charts again: {str(exception_error)}")
+            return None
+
+    def cancel(self, session: str = None) -> None:
+        """Cancel and drop the prefetches of a session, or of all sessions"""
+        with self._lock:
+            sessions = list(self._sessions) if session is None else [session]
+            for name in sessions:
+                for task in self._sessions.pop(name, {}).values():
+                    task.cancel()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
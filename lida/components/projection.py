@@ -0,0 +1,233 @@
+# Static analysis of generated chart code, used to read only the columns (and, for simple
+# filters, only the rows) a chart needs from columnar sources such as parquet and feather files.
+# The analysis is conservative: when the code may use columns it does not name, e.g. data.corr()
+# or sns.pairplot(data), no projection is returned and the full dataset is loaded.
+
+import ast
+import re
+from typing import Any, List, Optional, Set, Tuple
+
+# the name of the dataframe in generated code, see the plot(data) stub of the visualization prompts
+DATA_NAME = "data"
+# attributes that expose every column of a dataframe
+WHOLE_FRAME_ATTRIBUTES = {
+    "columns", "dtypes", "values", "shape", "iloc", "T", "keys", "items", "iterrows",
+    "itertuples", "iteritems", "to_numpy", "to_dict", "to_records", "info", "describe", "corr",
+    "cov", "select_dtypes", "melt", "stack", "unstack", "pivot", "pivot_table", "dropna",
+    "drop_duplicates", "duplicated", "isna", "isnull", "notna", "notnull", "drop", "plot", "hist",
+    "boxplot", "mean", "median", "sum", "min", "max", "std", "var", "count", "nunique", "agg",
+    "aggregate", "apply", "applymap", "map", "transform", "fillna", "memory_usage",
+}
+# functions that plot or transform every column of a dataframe argument
+WHOLE_FRAME_FUNCTIONS = {
+    "melt", "pairplot", "PairGrid", "heatmap", "clustermap", "scatter_matrix",
+    "parallel_coordinates", "andrews_curves", "radviz", "concat", "merge",
+}
+# methods that return the same columns as their receiver
+FRAME_METHODS = {"copy", "head", "tail", "sample", "reset_index", "sort_index", "size"}
+# comparison operators that can be pushed down to a parquet reader. != is left out, pandas keeps
+# missing values for it while parquet filters drop them
+PUSHDOWN_OPERATORS = {ast.Eq: "==", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+
+
+def _string_columns(node: ast.AST, columns: Set[str]) -> Set[str]:
+    """Columns named in the string constants below node, e.g. 'price', 'mean(price):Q' or 'price > 3'"""
+    found = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Constant) and isinstance(child.value, str):
+            if child.value in columns:
+                found.add(child.value)
+            found.update(x for x in re.findall(r"\w+", child.value) if x in columns)
+    return found
+
+
+def _is_column_selection(node: ast.AST, columns: Set[str]) -> bool:
+    """Check if node selects named columns, i.e. frame['a'], frame[['a', 'b']] or frame.a"""
+    if isinstance(node, ast.Attribute):
+        return node.attr in columns
+    if isinstance(node, ast.Subscript):
+        key = node.slice
+        if isinstance(key, ast.Constant):
+            return key.value in columns
+        if isinstance(key, (ast.List, ast.Tuple)):
+            return bool(key.elts) and all(
+                isinstance(x, ast.Constant) and x.value in columns for x in key.elts)
+    return False
+
+
+def _frame_root(node: ast.AST, columns: Set[str]) -> Tuple[Optional[str], bool]:
+    """Name at the root of an attribute, subscript or call chain, and whether the chain selects columns"""
+    selected = False
+    while True:
+        if _is_column_selection(node, columns):
+            selected = True
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        elif isinstance(node, ast.Call):
+            node = node.func
+        else:
+            break
+    return (node.id if isinstance(node, ast.Name) else None), selected
+
+
+def _is_frame(node: ast.AST, frames: Set[str], columns: Set[str]) -> bool:
+    """Check if node evaluates to a dataframe with all the columns of the data"""
+    root, selected = _frame_root(node, columns)
+    return root in frames and not selected
+
+
+def _frame_names(tree: ast.AST, columns: Set[str]) -> Set[str]:
+    """Names bound to the data or to row subsets of it, e.g. subset = data[data['a'] > 1]"""
+    frames = {DATA_NAME}
+    assignments = [x for x in ast.walk(tree) if isinstance(x, (ast.Assign, ast.AnnAssign))]
+    changed = True
+    while changed:
+        changed = False
+        for node in assignments:
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if node.value is None or not _is_frame(node.value, frames, columns):
+                continue
+            for target in targets:
+                if isinstance(target, ast.Name) and target.id not in frames:
+                    frames.add(target.id)
+                    changed = True
+    return frames
+
+
+def referenced_columns(code: str, columns: List[str]) -> Optional[List[str]]:
+    """
+    Columns of the data used by chart code, or None when the code may use other columns.
+
+    :param code: The preprocessed chart code.
+    :param columns: The columns of the dataset.
+    :return: The referenced columns in dataset order, or None to load all columns.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    known = set(columns)
+    frames = _frame_names(tree, known)
+    # functions defined by the code, i.e. plot(data), are analyzed through their bodies
+    local_functions = {x.name for x in ast.walk(tree) if isinstance(x, ast.FunctionDef)}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in WHOLE_FRAME_ATTRIBUTES and \
+                _is_frame(node.value, frames, known):
+            return None
+        if isinstance(node, (ast.For, ast.comprehension)) and _is_frame(node.iter, frames, known):
+            return None
+        if isinstance(node, ast.Call):
+            name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(
+                node.func, "id", None)
+            arguments = node.args + [x.value for x in node.keywords]
+            if name in WHOLE_FRAME_FUNCTIONS and any(
+                    _is_frame(x, frames, known) for x in arguments):
+                return None
+            # e.g. sns.boxplot(data=data) plots every numeric column, while altair charts name
+            # their columns in the encodings chained to alt.Chart(data)
+            if name not in local_functions and name != "Chart" and any(_is_frame(x, frames, known) for x in arguments) and \
+                    not any(_string_columns(x, known) for x in arguments):
+                return None
+            if isinstance(node.func, ast.Attribute) and name not in FRAME_METHODS and \
+                    _is_frame(node.func.value, frames, known) and \
+                    not any(_string_columns(x, known) for x in arguments):
+                return None
+
+    found = _string_columns(tree, known)
+    found.update(x.attr for x in ast.walk(tree) if isinstance(x, ast.Attribute) and
+                 x.attr in known and _frame_root(x.value, known)[0] in frames)
+    if not found:
+        return None
+    return [x for x in columns if x in found]
+
+
+def _column_name(node: ast.AST, columns: Set[str]) -> Optional[str]:
+    """Column of data['a'] or data.a"""
+    if isinstance(node, ast.Name) or not _is_column_selection(node, columns) or \
+            not isinstance(node.value, ast.Name) or node.value.id != DATA_NAME:
+        return None
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return node.slice.value if isinstance(node.slice, ast.Constant) else None
+
+
+def _uses_data(node: ast.AST) -> bool:
+    return any(isinstance(x, ast.Name) and x.id == DATA_NAME for x in ast.walk(node))
+
+
+def _literal(node: ast.AST) -> Any:
+    value = ast.literal_eval(node)
+    if not isinstance(value, (int, float, str, bool, list, tuple)):
+        raise ValueError(f"Unsupported filter value {value}")
+    return value
+
+
+def _parse_filter(node: ast.AST, columns: Set[str]) -> List[Tuple[str, str, Any]]:
+    """Filters of a row mask such as (data['a'] > 1) & data['b'].isin(['x', 'y'])"""
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+        return _parse_filter(node.left, columns) + _parse_filter(node.right, columns)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1 and \
+            type(node.ops[0]) in PUSHDOWN_OPERATORS:
+        left, right = node.left, node.comparators[0]
+        operator = PUSHDOWN_OPERATORS[type(node.ops[0])]
+        if _column_name(left, columns) is None:
+            # 1 < data['a'] is data['a'] > 1
+            left, right = right, left
+            operator = {"<": ">", "<=": ">=", ">": "<", ">=": "<="}.get(operator, operator)
+        column = _column_name(left, columns)
+        if column is not None:
+            return [(column, operator, _literal(right))]
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+            node.func.attr == "isin" and len(node.args) == 1 and not node.keywords:
+        column = _column_name(node.func.value, columns)
+        if column is not None:
+            return [(column, "in", list(_literal(node.args[0])))]
+    raise ValueError("Unsupported filter")
+
+
+def pushdown_filters(code: str, columns: List[str]) -> Optional[List[Tuple[str, str, Any]]]:
+    """
+    Row filters every use of the data goes through, in the format of pandas.read_parquet filters.
+
+    Only a leading `data = data[<mask>]` statement is pushed down, where the mask combines
+    comparisons of columns with constants and isin calls with &.
+
+    :param code: The preprocessed chart code.
+    :param columns: The columns of the dataset.
+    :return: A list of (column, operator, value) filters, or None when there is nothing to push down.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    body = tree.body
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and [x.arg for x in node.args.args] == [DATA_NAME]:
+            # outside of the plot function, the data may only be passed to it
+            for statement in tree.body:
+                if statement is node or not _uses_data(statement):
+                    continue
+                if not (isinstance(statement, ast.Assign) and isinstance(statement.value, ast.Call) and
+                        getattr(statement.value.func, "id", None) == node.name and
+                        not _uses_data(statement.targets[0])):
+                    return None
+            body = node.body
+            break
+
+    for statement in body:
+        if not _uses_data(statement):
+            continue
+        # the first statement using the data must filter it in place
+        if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+            return None
+        target, value = statement.targets[0], statement.value
+        if not (isinstance(target, ast.Name) and target.id == DATA_NAME and
+                isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name) and
+                value.value.id == DATA_NAME):
+            return None
+        try:
+            return _parse_filter(value.slice, set(columns)) or None
+        except (ValueError, TypeError, SyntaxError):
+            return None
+    return None
@@ -1,7 +1,14 @@
+import re
 from dataclasses import asdict
 
 from lida.datamodel import Goal
 
+# execution backends. With "duckdb" generated code aggregates the full dataset in sql with
+# query() and plots the result, instead of transforming a sample of the rows in pandas
+BACKENDS = ["pandas", "duckdb"]
+
+sql_instructions = " The variable data only holds a SAMPLE of the rows of the dataset. ALWAYS compute the values to plot (aggregates, counts, bins, filters, top k) over the FULL dataset with the function query(sql), which runs a DuckDB SQL query over a table named data with the columns in field_names (for a collection of tables, each table is a sql table of the same name) and returns a pandas DataFrame. Replace <query> in the template with that query, quote column names with double quotes, and plot the DataFrame it returns (df) instead of data. "
+
 
 # if len(plt.xticks()[0])) > 20 assuming plot is made with plt or
 # len(ax.get_xticks()) > 20 assuming plot is made with ax, set a max of 20
@@ -12,9 +19,12 @@ class ChartScaffold(object):
 
     def __init__(
         self,
+        backend: str = "pandas",
     ) -> None:
 
-        pass
+        if backend not in BACKENDS:
+            raise ValueError(f"Unsupported backend {backend}. Choose from {', '.join(BACKENDS)}.")
+        self.backend = backend
 
     def get_template(self, goal: Goal, library: str):
 
@@ -112,4 +122,12 @@ chart = plot(data) # variable data already contains the data to be plotted and s
                 "Unsupported library. Choose from 'matplotlib', 'seaborn', 'plotly', 'bokeh', 'ggplot', 'altair'."
             )
 
+        if self.backend == "duckdb":
+            # the query line goes right above the stub, with the same indentation
+            template = re.sub(
+                r"^([ \t]*)(.*<stub>.*)$",
+                lambda match: f'{match.group(1)}df = query("""<query>""")  # only modify the sql query, it runs over the full dataset\n{match.group(1)}{match.group(2)}',
+                template, count=1, flags=re.MULTILINE)
+            instructions = {**instructions, "content": instructions["content"] + sql_instructions}
+
         return template, instructions
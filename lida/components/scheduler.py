@@ -0,0 +1,189 @@
+# Rate limit aware scheduling of llm calls. Calls wait in a priority queue until the
+# requests-per-minute and tokens-per-minute budgets allow them, and transient provider errors
+# (rate limits, timeouts) are retried with jittered exponential backoff.
+
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Union
+
+from llmx import TextGenerator, TextGenerationConfig
+from llmx.datamodel import TextGenerationResponse
+
+from lida.utils import num_tokens_from_messages
+from .textgen import TextGeneratorWrapper, is_transient_error, stream_text
+
+logger = logging.getLogger("lida")
+
+# lower values are scheduled first
+INTERACTIVE_PRIORITY = 0
+BACKGROUND_PRIORITY = 10
+
+_current_priority = contextvars.ContextVar("lida_llm_priority", default=INTERACTIVE_PRIORITY)
+
+
+@contextmanager
+def llm_priority(priority: int) -> Iterator[None]:
+    """Set the scheduling priority of llm calls made in this context"""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def get_priority() -> int:
+    return _current_priority.get()
+
+
+class LLMScheduler:
+    """Admit llm calls in priority order within request and token per minute budgets.
+
+    Args:
+        requests_per_minute (int, optional): Maximum number of calls started per minute. Defaults to None (no limit).
+        tokens_per_minute (int, optional): Maximum number of estimated tokens per minute. Defaults to None (no limit).
+        max_concurrency (int, optional): Maximum number of calls in flight. Defaults to None (no limit).
+        max_retries (int, optional): Retries for rate limits, timeouts and other transient errors. Defaults to 3.
+        backoff_base (float, optional): Delay in seconds before the first retry, doubled on each retry. Defaults to 1.
+        backoff_max (float, optional): Maximum delay in seconds between retries. Defaults to 30.
+    """
+
+    window = 60.0
+
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None,
+                 max_concurrency: int = None, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._history = deque()  # (start time, tokens) of calls admitted within the window
+        self._waiting: List[tuple] = []
+        self._counter = itertools.count()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens: int) -> float:
+        """Seconds until a call with this many tokens fits the budgets, 0 if it fits now"""
+        now = time.monotonic()
+        while self._history and now - self._history[0][0] >= self.window:
+            self._history.popleft()
+        if self.max_concurrency and self._in_flight >= self.max_concurrency:
+            return float("inf")
+        wait = 0.0
+        if self.requests_per_minute and len(self._history) >= self.requests_per_minute:
+            oldest = self._history[len(self._history) - self.requests_per_minute][0]
+            wait = max(wait, oldest + self.window - now)
+        if self.tokens_per_minute and self._history:
+            # a single call larger than the budget is admitted once the window is empty
+            used = sum(x[1] for x in self._history)
+            for start, used_tokens in self._history:
+                if used + tokens <= self.tokens_per_minute:
+                    break
+                used -= used_tokens
+                wait = max(wait, start + self.window - now)
+        return wait
+
+    def acquire(self, tokens: int = 0, priority: int = INTERACTIVE_PRIORITY) -> None:
+        """Block until the call is first in the queue and fits the budgets"""
+        with self._condition:
+            ticket = (priority, next(self._counter))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    if self._waiting[0] == ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            heapq.heappop(self._waiting)
+                            self._history.append((time.monotonic(), tokens))
+                            self._in_flight += 1
+                            self._condition.notify_all()
+                            return
+                        self._condition.wait(timeout=None if wait == float("inf") else wait)
+                    else:
+                        self._condition.wait()
+            except BaseException:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+
+    def release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def run(self, func: Callable[[], Any], tokens: int = 0,
+            priority: int = INTERACTIVE_PRIORITY) -> Any:
+        """Run func once admitted, retrying transient errors with backoff"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens=tokens, priority=priority)
+            try:
+                return func()
+            except Exception as exception_error:
+                if attempt == self.max_retries or not is_transient_error(exception_error):
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning("llm call failed with %s, retrying in %.2f seconds",
+                               type(exception_error).__name__, delay)
+            finally:
+                self.release()
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "waiting": len(self._waiting),
+                "in_flight": self._in_flight,
+                "requests_in_window": len(self._history),
+                "tokens_in_window": sum(x[1] for x in self._history),
+            }
+
+
+class ScheduledTextGenerator(TextGeneratorWrapper):
+    """Send every llm call through an LLMScheduler at the priority of the current context"""
+
+    def __init__(self, text_gen: TextGenerator, scheduler: LLMScheduler) -> None:
+        super().__init__(text_gen)
+        self.scheduler = scheduler
+
+    def estimate_tokens(self, messages: Union[List[Dict], str],
+                        config: TextGenerationConfig) -> int:
+        """Estimate prompt plus completion tokens of a call"""
+        prompt_tokens = num_tokens_from_messages(
+            messages, model=config.model or getattr(self.text_gen, "model_name", None))
+        return prompt_tokens + (config.max_tokens or 0)
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        return self.scheduler.run(
+            lambda: self.text_gen.generate(messages=messages, config=config, **kwargs),
+            tokens=self.estimate_tokens(messages, config),
+            priority=get_priority())
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        # the slot is held until the stream is consumed or closed. A stream is not retried, its
+        # chunks may already have been used
+        self.scheduler.acquire(tokens=self.estimate_tokens(messages, config), priority=get_priority())
+        try:
+            yield from stream_text(self.text_gen, messages=messages, config=config, **kwargs)
+        finally:
+            self.scheduler.release()
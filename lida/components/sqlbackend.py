@@ -0,0 +1,88 @@
+# SQL execution backend. Charts generated for the "duckdb" backend aggregate the data with
+# query(sql) instead of pandas, and the query runs in an embedded DuckDB database directly over
+# the data file, so charts show exact aggregates over every row while only the (small) query
+# results are loaded in python. Requires the optional duckdb package.
+
+import hashlib
+import os
+import threading
+from typing import Union
+
+import pandas as pd
+
+from lida.utils import read_dataframe
+from .tables import TableCollection
+
+# duckdb table functions by file extension. Other files are read with pandas and registered
+SQL_READERS = {
+    "parquet": "read_parquet",
+    "csv": "read_csv_auto",
+    "tsv": "read_csv_auto",
+    "json": "read_json_auto",
+}
+
+
+def _quote(value: str, quote: str = "'") -> str:
+    return quote + value.replace(quote, quote * 2) + quote
+
+
+class DuckDBBackend:
+    """Run sql queries over a data file, a DataFrame or a collection of tables with DuckDB"""
+
+    def __init__(self, source: Union[str, pd.DataFrame, TableCollection],
+                 table_name: str = "data") -> None:
+        """
+        :param source: A file path, a DataFrame, or a TableCollection whose tables are queried by their names.
+        :param table_name: Name of the sql table of a file or DataFrame source.
+        """
+        self.source = source
+        self.table_name = table_name
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _register(self, connection, name: str, source: Union[str, pd.DataFrame]) -> None:
+        if isinstance(source, str) and source.split(".")[-1] in SQL_READERS:
+            reader = SQL_READERS[source.split(".")[-1]]
+            connection.execute(
+                f"CREATE VIEW {_quote(name, chr(34))} AS SELECT * FROM {reader}({_quote(os.path.abspath(source))})")
+            return
+        if isinstance(source, str):
+            source = read_dataframe(source, sample=False)
+        connection.register(name, source)
+
+    @property
+    def connection(self):
+        """The database connection, created with a view of the data on first use"""
+        with self._lock:
+            if self._connection is None:
+                try:
+                    import duckdb
+                except ImportError as exc:
+                    raise ImportError(
+                        "Please install duckdb to use the duckdb backend. pip install lida[duckdb]") from exc
+
+                connection = duckdb.connect()
+                if isinstance(self.source, TableCollection):
+                    for name, source in self.source.sources.items():
+                        self._register(connection, name, source)
+                else:
+                    self._register(connection, self.table_name, self.source)
+                self._connection = connection
+            return self._connection
+
+    def query(self, sql: str) -> pd.DataFrame:
+        """Run a query and return its result as a DataFrame. Safe to call from multiple threads"""
+        # each thread queries through its own cursor, duckdb connections are not thread safe
+        cursor = self.connection.cursor()
+        try:
+            return cursor.execute(sql).df()
+        finally:
+            cursor.close()
+
+    def fingerprint(self) -> str:
+        """Fingerprint of the queried data, part of the chart cache key"""
+        from .chartcache import data_fingerprint
+
+        digest = hashlib.md5(f"duckdb:{self.table_name}:".encode("utf-8"))
+        digest.update(str(data_fingerprint(self.source)).encode("utf-8"))
+        return digest.hexdigest()
@@ -0,0 +1,113 @@
+# Mergeable per-column statistics stored with a summary. Statistics of appended rows are merged
+# into the stored ones (count, mean and M2 for the standard deviation, min, max, and a k minimum
+# values sketch for the number of distinct values), so a summary can be updated without
+# reading the full dataset again.
+
+import math
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# number of hashes kept by the distinct value sketch. Counts are exact up to this many
+# distinct values and have a relative error of about 1/sqrt(k) above it
+DISTINCT_SKETCH_SIZE = 256
+# hashes are truncated to 52 bits so they survive a round trip through javascript numbers
+HASH_BITS = 52
+HASH_SPACE = float(2 ** HASH_BITS)
+
+
+def hash_values(series: pd.Series) -> np.ndarray:
+    """Stable 52 bit hashes of the non null values of a series"""
+    values = series.dropna()
+    if len(values) == 0:
+        return np.array([], dtype=np.uint64)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+    return hashes >> np.uint64(64 - HASH_BITS)
+
+
+def merge_sketches(*sketches: List[int], k: int = DISTINCT_SKETCH_SIZE) -> List[int]:
+    """Union of k minimum values sketches"""
+    merged = np.unique(np.concatenate([np.asarray(x, dtype=np.uint64) for x in sketches]))
+    return [int(x) for x in merged[:k]]
+
+
+def estimate_distinct(sketch: List[int], k: int = DISTINCT_SKETCH_SIZE) -> int:
+    """Estimate the number of distinct values from a k minimum values sketch"""
+    if len(sketch) < k:
+        return len(sketch)
+    return int(round((k - 1) / ((sketch[-1] + 1) / HASH_SPACE)))
+
+
+def compute_column_stats(series: pd.Series, dtype: str = None,
+                         k: int = DISTINCT_SKETCH_SIZE) -> Dict[str, Any]:
+    """Compute the mergeable statistics of a column. dtype is the summary dtype of the column"""
+    stats = {
+        "rows": int(len(series)),
+        "count": int(series.count()),
+        "distinct": merge_sketches(hash_values(series), k=k),
+    }
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        values = series.dropna().astype(float)
+        stats["integer"] = bool(pd.api.types.is_integer_dtype(series))
+        stats["mean"] = float(values.mean()) if len(values) else 0.0
+        stats["m2"] = float(((values - stats["mean"]) ** 2).sum()) if len(values) else 0.0
+        stats["min"] = float(values.min()) if len(values) else None
+        stats["max"] = float(values.max()) if len(values) else None
+    elif pd.api.types.is_datetime64_any_dtype(series) or dtype == "date":
+        values = pd.to_datetime(series, errors="coerce").dropna()
+        stats["min"] = str(values.min()) if len(values) else None
+        stats["max"] = str(values.max()) if len(values) else None
+    return stats
+
+
+def _merge_extreme(left, right, pick):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if isinstance(left, str):
+        return str(pick(pd.Timestamp(left), pd.Timestamp(right)))
+    return pick(left, right)
+
+
+def merge_column_stats(left: Dict[str, Any], right: Dict[str, Any],
+                       k: int = DISTINCT_SKETCH_SIZE) -> Dict[str, Any]:
+    """Merge the statistics of two sets of rows of the same column"""
+    merged = {
+        "rows": left["rows"] + right["rows"],
+        "count": left["count"] + right["count"],
+        "distinct": merge_sketches(left["distinct"], right["distinct"], k=k),
+    }
+    if "mean" in left and "mean" in right:
+        # parallel variance merge (Chan et al.)
+        n_left, n_right = left["count"], right["count"]
+        n = n_left + n_right
+        delta = right["mean"] - left["mean"]
+        merged["integer"] = left["integer"] and right["integer"]
+        merged["mean"] = left["mean"] + delta * n_right / n if n else 0.0
+        merged["m2"] = left["m2"] + right["m2"] + (delta ** 2 * n_left * n_right / n if n else 0.0)
+    if "min" in left or "min" in right:
+        merged["min"] = _merge_extreme(left.get("min"), right.get("min"), min)
+        merged["max"] = _merge_extreme(left.get("max"), right.get("max"), max)
+    return merged
+
+
+def stats_std(stats: Dict[str, Any]) -> Optional[float]:
+    """Sample standard deviation (ddof=1, as pandas) from merged statistics"""
+    if "m2" not in stats or stats["count"] < 2:
+        return None
+    return math.sqrt(stats["m2"] / (stats["count"] - 1))
+
+
+def stats_drifted(old: Dict[str, Any], new: Dict[str, Any], threshold: float = 0.5) -> bool:
+    """Check if the rows summarized by new shift the mean of a numeric column noticeably.
+
+    The shift is measured in standard deviations of the old rows.
+    """
+    if "mean" not in old or "mean" not in new or not new["count"]:
+        return False
+    std = stats_std(old)
+    if not old["count"] or not std:
+        return new["mean"] != old.get("mean")
+    return abs(new["mean"] - old["mean"]) > threshold * std
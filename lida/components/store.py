@@ -0,0 +1,135 @@
+# Key value stores for state shared between the processes of the web app. With several uvicorn
+# workers (or several nodes behind a load balancer) each request can land on a different
+# process, so uploaded files, summaries, executed charts, cubes and prefetched charts are kept in
+# a store that all of them reach: a local disk cache by default, or a Redis compatible server.
+
+import os
+import pickle
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from diskcache import Cache
+
+
+class Store(ABC):
+    """Interface of the stores. Values are any picklable python objects"""
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, expire: float = None) -> None:
+        """Store a value, expiring after expire seconds when given"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def __contains__(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        pass
+
+
+class DiskStore(Store):
+    """Store in a disk cache directory, shared by the processes of a host"""
+
+    def __init__(self, directory: str = None, size_limit: int = 2 ** 32) -> None:
+        """
+        :param directory: Directory of the cache, defaults to the lida user cache directory.
+        :param size_limit: Size in bytes above which least recently used values are evicted.
+        """
+        self.directory = directory
+        self.size_limit = size_limit
+        self._cache = None
+
+    @property
+    def cache(self) -> Cache:
+        """The underlying disk cache, created on first use"""
+        if self._cache is None:
+            if self.directory is None:
+                from llmx.utils import get_user_cache_dir
+                self.directory = os.path.join(get_user_cache_dir("lida"), "store")
+            self._cache = Cache(self.directory, size_limit=self.size_limit,
+                                eviction_policy="least-recently-used")
+        return self._cache
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.cache.get(key, default)
+
+    def set(self, key: str, value: Any, expire: float = None) -> None:
+        self.cache.set(key, value, expire=expire)
+
+    def delete(self, key: str) -> None:
+        self.cache.delete(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.cache
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def __repr__(self) -> str:
+        return f"DiskStore({self.directory})"
+
+
+class RedisStore(Store):
+    """Store in a Redis compatible server, shared by processes on any host. Requires redis"""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "lida:") -> None:
+        """
+        :param url: Url of the server, e.g. redis://localhost:6379/0.
+        :param prefix: Prefix of the keys, so several apps can share a server.
+        """
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+
+    @property
+    def client(self):
+        """The redis client, connected on first use"""
+        if self._client is None:
+            try:
+                import redis
+            except ImportError as exc:
+                raise ImportError(
+                    "Please install redis to use a redis store. pip install lida[redis]") from exc
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.client.get(self.prefix + key)
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key: str, value: Any, expire: float = None) -> None:
+        px = int(expire * 1000) if expire is not None else None
+        self.client.set(self.prefix + key, pickle.dumps(value), px=px)
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.client.exists(self.prefix + key))
+
+    def clear(self) -> None:
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+    def __repr__(self) -> str:
+        return f"RedisStore({self.url})"
+
+
+def get_store(url: Optional[str] = None) -> Store:
+    """
+    The store at a url.
+
+    :param url: redis://, rediss:// or unix:// urls of a Redis compatible server, or a directory for a disk store. Defaults to a disk store in the lida user cache directory.
+    :return: The store.
+    """
+    if url and url.split("://")[0] in ["redis", "rediss", "unix"]:
+        return RedisStore(url)
+    return DiskStore(url or None)
@@ -1,10 +1,21 @@
+import contextvars
+import dataclasses
+import hashlib
 import json
 import logging
-from typing import Union
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
 import pandas as pd
-from lida.utils import clean_code_snippet, read_dataframe
+from diskcache import Cache
+from lida.utils import clean_code_snippet, prompt_summary, read_dataframe
 from lida.datamodel import TextGenerationConfig
+from lida.instrumentation import instrumented, record_cache
 from llmx import TextGenerator
+from llmx.utils import get_user_cache_dir
+from .tables import TableCollection
+from .stats import (compute_column_stats, estimate_distinct, merge_column_stats, stats_drifted,
+                    stats_std)
 import warnings
 
 system_prompt = """
@@ -19,14 +30,22 @@ logger = logging.getLogger("lida")
 
 
 class Summarizer():
-    def __init__(self) -> None:
+    def __init__(self, cache_dir: str = None, max_batch_tokens: int = 2000,
+                 max_workers: int = 4, max_retries: int = 2) -> None:
         self.summary = None
+        # column annotations cache, defaults to the lida user cache directory
+        self.cache_dir = cache_dir
+        self._cache = None
+        # wide tables are enriched in concurrent batches of columns
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
 
     def check_type(self, dtype: str, value):
         """Cast value to right type to ensure it is JSON serializable"""
-        if "float" in str(dtype):
+        if "float" in str(dtype).lower():
             return float(value)
-        elif "int" in str(dtype):
+        elif "int" in str(dtype).lower():
             return int(value)
         else:
             return value
@@ -37,41 +56,44 @@ class Summarizer():
         for column in df.columns:
             dtype = df[column].dtype
             properties = {}
-            if dtype in [int, float, complex]:
+            # dtype checks cover compact dtypes (int8, float32, category, pyarrow strings)
+            # and the pandas 3 string dtype, not only int64, float64 and object
+            if pd.api.types.is_bool_dtype(dtype):
+                properties["dtype"] = "boolean"
+            elif pd.api.types.is_numeric_dtype(dtype):
                 properties["dtype"] = "number"
                 properties["std"] = self.check_type(dtype, df[column].std())
                 properties["min"] = self.check_type(dtype, df[column].min())
                 properties["max"] = self.check_type(dtype, df[column].max())
-
-            elif dtype == bool:
-                properties["dtype"] = "boolean"
-            elif dtype == object:
+            elif pd.api.types.is_datetime64_any_dtype(dtype):
+                properties["dtype"] = "date"
+            elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) or \
+                    isinstance(dtype, pd.CategoricalDtype):
                 # Check if the string column can be cast to a valid datetime
                 try:
                     with warnings.catch_warnings():
                         warnings.simplefilter("ignore")
                         pd.to_datetime(df[column], errors='raise')
                         properties["dtype"] = "date"
-                except ValueError:
+                except (ValueError, TypeError):
                     # Check if the string column has a limited number of values
                     if df[column].nunique() / len(df[column]) < 0.5:
                         properties["dtype"] = "category"
                     else:
                         properties["dtype"] = "string"
-            elif pd.api.types.is_categorical_dtype(df[column]):
-                properties["dtype"] = "category"
-            elif pd.api.types.is_datetime64_any_dtype(df[column]):
-                properties["dtype"] = "date"
             else:
                 properties["dtype"] = str(dtype)
 
             # add min max if dtype is date
             if properties["dtype"] == "date":
+                values = df[column]
+                if isinstance(dtype, pd.CategoricalDtype):
+                    values = values.astype(dtype.categories.dtype)
                 try:
-                    properties["min"] = df[column].min()
-                    properties["max"] = df[column].max()
+                    properties["min"] = values.min()
+                    properties["max"] = values.max()
                 except TypeError:
-                    cast_date_col = pd.to_datetime(df[column], errors='coerce')
+                    cast_date_col = pd.to_datetime(values, errors='coerce')
                     properties["min"] = cast_date_col.min()
                     properties["max"] = cast_date_col.max()
             # Add additional properties to the output dictionary
@@ -90,30 +112,148 @@ class Summarizer():
 
         return properties_list
 
-    def enrich(self, base_summary: dict, text_gen: TextGenerator,
-               textgen_config: TextGenerationConfig) -> dict:
-        """Enrich the data summary with descriptions"""
-        logger.info(f"Enriching the data summary with descriptions")
+    @property
+    def cache(self) -> Cache:
+        """Cache of column annotations, created on first use"""
+        if self._cache is None:
+            self._cache = Cache(self.cache_dir or os.path.join(
+                get_user_cache_dir("lida"), "enrichment"))
+        return self._cache
+
+    def column_cache_key(self, field: dict) -> str:
+        """Cache key of a column annotation: column name, dtype and a fingerprint of the samples"""
+        properties = field.get("properties", {})
+        samples = sorted(str(x) for x in properties.get("samples", []))
+        params = {"column": str(field.get("column")), "dtype": properties.get("dtype"),
+                  "samples": samples}
+        return hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
 
+    def _generate_annotations(self, base_summary: dict, text_gen: TextGenerator,
+                              textgen_config: TextGenerationConfig) -> dict:
+        """Ask the llm to annotate a (partial) summary and return its JSON output"""
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "assistant", "content": f"""
         Annotate the dictionary below. Only return a JSON object.
-        {base_summary}
+        {prompt_summary(base_summary)}
         """},
         ]
 
         response = text_gen.generate(messages=messages, config=textgen_config)
-        enriched_summary = base_summary
         try:
             json_string = clean_code_snippet(response.text[0]["content"])
-            enriched_summary = json.loads(json_string)
+            return json.loads(json_string)
         except json.decoder.JSONDecodeError:
             error_msg = f"The model did not return a valid JSON object while attempting to generate an enriched data summary. Consider using a default summary or  a larger model with higher max token length. | {response.text[0]['content']}"
             logger.info(error_msg)
             print(response.text[0]["content"])
-            raise ValueError(error_msg + "" + response.usage)
-        return enriched_summary
+            raise ValueError(error_msg + "" + str(response.usage))
+
+    @instrumented("summarizer")
+    def enrich(self, base_summary: dict, text_gen: TextGenerator,
+               textgen_config: TextGenerationConfig) -> dict:
+        """Enrich the data summary with descriptions.
+
+        Column annotations (semantic_type, description) are cached by column name, dtype and
+        samples, so the llm is only asked about columns it has not annotated before.
+        """
+        logger.info(f"Enriching the data summary with descriptions")
+
+        fields = base_summary.get("fields", [])
+        keys = [self.column_cache_key(field) for field in fields]
+        dataset_key = hashlib.md5(json.dumps(
+            [base_summary.get("name", "")] + keys).encode("utf-8")).hexdigest()
+        annotations = {}
+        dataset_info = None
+        if textgen_config.use_cache:
+            annotations = {key: self.cache.get(key) for key in keys}
+            annotations = {key: value for key, value in annotations.items() if value}
+            dataset_info = self.cache.get(dataset_key)
+
+        missing = [field for field, key in zip(fields, keys) if key not in annotations]
+        record_cache("enrichment", hit=not missing and dataset_info is not None)
+        if missing or dataset_info is None:
+            logger.info(f"Annotating {len(missing)} of {len(fields)} columns")
+            batches = self.batch_fields(missing)
+            results = self._annotate_batches(base_summary, batches, text_gen, textgen_config)
+            for batch, enriched in zip(batches, results):
+                if enriched is None:
+                    continue
+                generated = {str(x.get("column")): x.get("properties", {})
+                             for x in enriched.get("fields", []) if isinstance(x, dict)}
+                for field in batch:
+                    properties = generated.get(str(field["column"]))
+                    if not properties:
+                        continue
+                    annotation = {"semantic_type": properties.get("semantic_type", ""),
+                                  "description": properties.get("description", "")}
+                    key = self.column_cache_key(field)
+                    annotations[key] = annotation
+                    self.cache.set(key, annotation)
+                if dataset_info is None:
+                    dataset_info = {
+                        "name": enriched.get("name") or base_summary.get("name", ""),
+                        "dataset_description": enriched.get("dataset_description", ""),
+                    }
+                    self.cache.set(dataset_key, dataset_info)
+
+        enriched_fields = []
+        for field, key in zip(fields, keys):
+            properties = dict(field.get("properties", {}))
+            properties.update(annotations.get(key, {}))
+            enriched_fields.append({**field, "properties": properties})
+        return {**base_summary, **(dataset_info or {}), "fields": enriched_fields}
+
+    def batch_fields(self, fields: List[dict]) -> List[List[dict]]:
+        """Split fields into batches of at most max_batch_tokens (estimated) each"""
+        batches, batch, batch_tokens = [], [], 0
+        for field in fields:
+            # rough estimate of 4 characters per token
+            tokens = len(json.dumps(field, default=str)) // 4
+            if batch and batch_tokens + tokens > self.max_batch_tokens:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(field)
+            batch_tokens += tokens
+        batches.append(batch)
+        return batches
+
+    def _annotate_batch(self, base_summary: dict, batch: List[dict], text_gen: TextGenerator,
+                        textgen_config: TextGenerationConfig) -> dict:
+        """Annotate one batch of fields, retrying it on its own when the output does not parse"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._generate_annotations(
+                    {**base_summary, "fields": batch}, text_gen=text_gen,
+                    textgen_config=textgen_config)
+            except ValueError:
+                if attempt == self.max_retries:
+                    raise
+                logger.info(f"Retrying enrichment of a batch of {len(batch)} columns")
+
+    def _annotate_batches(self, base_summary: dict, batches: List[List[dict]],
+                          text_gen: TextGenerator,
+                          textgen_config: TextGenerationConfig) -> List[Optional[dict]]:
+        """Annotate batches concurrently. Failed batches are None, unless all of them fail"""
+        if len(batches) == 1:
+            return [self._annotate_batch(base_summary, batches[0], text_gen, textgen_config)]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, self._annotate_batch,
+                                   base_summary, batch, text_gen, textgen_config)
+                       for batch in batches]
+        results, errors = [], []
+        for batch, future in zip(batches, futures):
+            try:
+                results.append(future.result())
+            except Exception as exception_error:
+                logger.error(
+                    f"Could not enrich columns {[x['column'] for x in batch]}: {str(exception_error)}")
+                results.append(None)
+                errors.append(exception_error)
+        if len(errors) == len(batches):
+            raise errors[0]
+        return results
 
     def summarize(
             self, data: Union[pd.DataFrame, str],
@@ -155,5 +295,142 @@ class Summarizer():
 
         data_summary["field_names"] = data.columns.tolist()
         data_summary["file_name"] = file_name
+        if summary_method != "columns":
+            # mergeable statistics used by update() when rows are appended to the dataset
+            data_summary["stats"] = {
+                str(x["column"]): compute_column_stats(data[x["column"]], x["properties"]["dtype"])
+                for x in data_properties}
 
         return data_summary
+
+    def summarize_tables(
+            self, tables: TableCollection, text_gen: TextGenerator, n_samples: int = 3,
+            textgen_config=TextGenerationConfig(n=1),
+            summary_method: str = "default") -> dict:
+        """Summarize a collection of tables.
+
+        Each table is summarized on its own (see summarize) and kept under "tables". The fields
+        of all tables are listed with table qualified names, e.g. orders.amount, along with the
+        relationships of the collection.
+        """
+        table_summaries = []
+        fields = []
+        for name in tables.names:
+            table_summary = self.summarize(
+                tables.read(name), text_gen=text_gen, file_name=tables.file_name(name),
+                n_samples=n_samples, textgen_config=textgen_config, summary_method=summary_method)
+            table_summary["name"] = name
+            table_summaries.append(table_summary)
+            fields.extend({**x, "column": f"{name}.{x['column']}", "table": name}
+                          for x in table_summary.get("fields", []))
+
+        descriptions = [f"{x['name']}: {x['dataset_description']}" for x in table_summaries
+                        if x.get("dataset_description")]
+        return {
+            "name": tables.name,
+            "file_name": "",
+            "dataset_description": f"A collection of {len(tables)} related tables. " + " ".join(descriptions),
+            "fields": fields,
+            "field_names": [f"{x['name']}.{column}" for x in table_summaries for column in x["field_names"]],
+            "tables": table_summaries,
+            "relationships": [dataclasses.asdict(x) for x in tables.relationships],
+        }
+
+    def _merge_properties(self, properties: dict, new_properties: dict, stats: dict,
+                          n_samples: int) -> dict:
+        """Column properties of the combined rows, from their merged statistics"""
+        merged = dict(properties)
+        dtype = properties["dtype"]
+        if dtype != new_properties["dtype"] and {dtype, new_properties["dtype"]} - {"category", "string"}:
+            dtype = new_properties["dtype"]
+        if dtype in ["category", "string"]:
+            ratio = estimate_distinct(stats["distinct"]) / max(stats["rows"], 1)
+            dtype = "category" if ratio < 0.5 else "string"
+        merged["dtype"] = dtype
+
+        if dtype == "number" and "mean" in stats:
+            cast = int if stats["integer"] else float
+            std = stats_std(stats)
+            merged["std"] = cast(std) if std is not None else None
+            merged["min"] = cast(stats["min"]) if stats["min"] is not None else None
+            merged["max"] = cast(stats["max"]) if stats["max"] is not None else None
+        elif dtype == "date" and "min" in stats:
+            merged["min"] = stats["min"]
+            merged["max"] = stats["max"]
+
+        samples = list(properties.get("samples", []))
+        for sample in new_properties.get("samples", []):
+            if len(samples) >= n_samples:
+                break
+            if sample not in samples:
+                samples.append(sample)
+        merged["samples"] = samples
+        merged["num_unique_values"] = estimate_distinct(stats["distinct"])
+        return merged
+
+    def update(
+            self, summary: dict, data: pd.DataFrame,
+            text_gen: TextGenerator = None, n_samples: int = 3,
+            textgen_config=TextGenerationConfig(n=1),
+            drift_threshold: float = 0.5) -> dict:
+        """Update a summary with rows appended to the summarized dataset.
+
+        Statistics are merged from the stats stored with the summary and the appended rows only.
+        When the summary was enriched and a text_gen is given, enrichment is re-run for the
+        columns whose dtype changed or whose mean shifted by more than drift_threshold standard
+        deviations (category columns: whose number of distinct values grew by that fraction).
+        """
+        if not isinstance(summary, dict):
+            summary = dataclasses.asdict(summary)
+        if not summary.get("stats") or not summary.get("fields"):
+            raise ValueError(
+                "The summary has no statistics to update. Summarize the full dataset again.")
+        columns = [x["column"] for x in summary["fields"]]
+        if list(data.columns) != columns:
+            raise ValueError(
+                "The appended rows do not have the columns of the summary. Summarize the full dataset again.")
+
+        new_properties = {x["column"]: x["properties"]
+                          for x in self.get_column_properties(data, n_samples)}
+        fields = []
+        stats = {}
+        changed: List[dict] = []
+        for field in summary["fields"]:
+            column = field["column"]
+            old_stats = summary["stats"][str(column)]
+            new_stats = compute_column_stats(data[column], field["properties"]["dtype"])
+            stats[str(column)] = merge_column_stats(old_stats, new_stats)
+            properties = self._merge_properties(
+                field["properties"], new_properties[column], stats[str(column)], n_samples)
+            fields.append({**field, "properties": properties})
+
+            if properties["dtype"] != field["properties"]["dtype"]:
+                changed.append(fields[-1])
+            elif stats_drifted(old_stats, new_stats, drift_threshold):
+                changed.append(fields[-1])
+            elif properties["dtype"] == "category" and properties["num_unique_values"] > \
+                    (1 + drift_threshold) * field["properties"].get("num_unique_values", 0):
+                changed.append(fields[-1])
+
+        updated = {**summary, "fields": fields, "stats": stats}
+        enriched = any(x["properties"].get("description") for x in summary["fields"])
+        if changed and enriched and text_gen is not None:
+            logger.info("Enriching changed columns %s", [x["column"] for x in changed])
+            partial_summary = {
+                "name": summary.get("name", ""),
+                "file_name": summary.get("file_name", ""),
+                "dataset_description": summary.get("dataset_description", ""),
+                "fields": [{**x, "properties": {**x["properties"], "semantic_type": "", "description": ""}}
+                           for x in changed],
+            }
+            # the changed columns may keep their samples, bypass the cached annotations
+            enriched_fields = self.enrich(
+                partial_summary, text_gen=text_gen,
+                textgen_config=dataclasses.replace(textgen_config, use_cache=False)).get("fields", [])
+            annotations = {x.get("column"): x.get("properties", {}) for x in enriched_fields}
+            for field in fields:
+                annotation = annotations.get(field["column"])
+                if annotation and annotation.get("description"):
+                    field["properties"]["semantic_type"] = annotation.get("semantic_type", "")
+                    field["properties"]["description"] = annotation.get("description", "")
+        return updated
@@ -0,0 +1,158 @@
+# Named collections of tables with key relationships (e.g. a star schema). Instead of a single
+# pre-joined file, charts receive the collection as `data`: data['orders'] loads one table and
+# data.join('orders', 'customers') joins tables along their relationships, on first use, so
+# only the tables a chart touches are read.
+
+import hashlib
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from lida.datamodel import TableRelationship
+from lida.utils import read_dataframe
+
+# added to the summary in prompts, so generated code knows how to access the tables
+TABLES_INSTRUCTION = (
+    "The data variable is a collection of tables, not a DataFrame. data['<table>'] returns a "
+    "table as a pandas DataFrame with the columns of its fields (without the table prefix), and "
+    "data.join('<table>', '<table>', ...) returns a DataFrame of the tables left joined along "
+    "their relationships, starting from the first table. Colliding column names of joined "
+    "tables get a _<table> suffix. Only use or join the tables the chart needs.")
+
+
+class TableCollection:
+    """A named collection of tables with key relationships, loaded and joined on demand"""
+
+    def __init__(self, tables: Dict[str, Union[pd.DataFrame, str]],
+                 relationships: List[Union[TableRelationship, dict]] = None,
+                 name: str = "", encoding: str = "utf-8") -> None:
+        """
+        :param tables: DataFrames or file paths by table name.
+        :param relationships: Key relationships between the tables.
+        :param name: Name of the collection, used as the name of its summary.
+        :param encoding: Encoding of the table files.
+        """
+        self.sources = dict(tables)
+        self.relationships = [x if isinstance(x, TableRelationship) else TableRelationship(**x)
+                              for x in relationships or []]
+        for relationship in self.relationships:
+            for table in [relationship.left, relationship.right]:
+                if table not in self.sources:
+                    raise ValueError(f"Relationship refers to unknown table {table}")
+        self.name = name
+        self.encoding = encoding
+        self._tables = {}
+        self._joins = {}
+        self._lock = threading.RLock()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.sources)
+
+    @property
+    def loaded(self) -> List[str]:
+        """Names of the tables loaded so far"""
+        return list(self._tables)
+
+    def file_name(self, name: str) -> str:
+        source = self.sources[name]
+        return source.split("/")[-1] if isinstance(source, str) else name
+
+    def read(self, name: str, sample: bool = True) -> pd.DataFrame:
+        """Read a table without keeping it in the collection, e.g. to summarize it"""
+        source = self.sources[name]
+        if isinstance(source, pd.DataFrame):
+            return source
+        return read_dataframe(source, encoding=self.encoding, sample=sample)
+
+    def __getitem__(self, name: str) -> pd.DataFrame:
+        """A table, loaded with all its rows on first access so that joins find every key"""
+        if name not in self.sources:
+            raise KeyError(f"Unknown table {name}. Tables are {', '.join(self.sources)}")
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = self.read(name, sample=False)
+            return self._tables[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sources
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def _join_path(self, joined: List[str], target: str) -> List[Tuple[str, TableRelationship]]:
+        """Relationships leading from the joined tables to target, found by breadth first search"""
+        previous = {name: None for name in joined}
+        queue = deque(joined)
+        while queue:
+            name = queue.popleft()
+            if name == target:
+                break
+            for relationship in self.relationships:
+                for left, right in [(relationship.left, relationship.right),
+                                    (relationship.right, relationship.left)]:
+                    if left == name and right not in previous:
+                        previous[right] = (name, relationship)
+                        queue.append(right)
+        if target not in previous:
+            raise ValueError(f"No relationship connects {target} to {', '.join(joined)}")
+        path = []
+        while previous[target] is not None:
+            name, relationship = previous[target]
+            path.append((target, relationship))
+            target = name
+        return path[::-1]
+
+    def join(self, *names: str) -> pd.DataFrame:
+        """
+        Left join tables along their relationships, starting from the first table.
+
+        Tables between the requested ones on the relationship path are joined too.
+
+        :param names: Names of the tables to join.
+        :return: The joined DataFrame, cached for later calls with the same names.
+        """
+        if not names:
+            raise ValueError("join needs at least one table")
+        if len(names) == 1:
+            return self[names[0]]
+        with self._lock:
+            if names in self._joins:
+                return self._joins[names]
+            joined_tables = [names[0]]
+            result = self[names[0]]
+            for target in names[1:]:
+                if target in joined_tables:
+                    continue
+                for table, relationship in self._join_path(joined_tables, target):
+                    if relationship.right == table:
+                        left_on, right_on = relationship.left_on, relationship.right_on
+                    else:
+                        left_on, right_on = relationship.right_on, relationship.left_on
+                    result = result.merge(self[table], how="left", left_on=left_on,
+                                          right_on=right_on, suffixes=("", f"_{table}"))
+                    joined_tables.append(table)
+            self._joins[names] = result
+            return result
+
+    def fingerprint(self) -> Optional[str]:
+        """Fingerprint of the tables and relationships, see chartcache.data_fingerprint"""
+        from .chartcache import data_fingerprint
+
+        digest = hashlib.md5()
+        for name, source in self.sources.items():
+            fingerprint = data_fingerprint(source)
+            if fingerprint is None:
+                return None
+            digest.update(f"{name}:{fingerprint};".encode("utf-8"))
+        for relationship in self.relationships:
+            digest.update(str(relationship).encode("utf-8"))
+        return digest.hexdigest()
+
+    def __repr__(self) -> str:
+        return f"TableCollection({', '.join(self.sources)})"
@@ -0,0 +1,342 @@
+# Wrappers around llmx text generators that add behaviour (instrumentation, ...) to every
+# llm call made by the lida components, without changing the components themselves.
+
+import dataclasses
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterator, List, Tuple, Union
+
+from llmx import TextGenerator, TextGenerationConfig, llm
+from llmx.datamodel import TextGenerationResponse
+
+from lida.instrumentation import StageRecord, get_instrumentation, get_stage, record_cache, track
+from lida.utils import check_prompt_size
+
+logger = logging.getLogger("lida")
+
+TRANSIENT_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Check if an llm error is a timeout, rate limit or temporary provider failure"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    if status_code in TRANSIENT_STATUS_CODES:
+        return True
+    name = type(error).__name__.lower()
+    return any(x in name for x in ["ratelimit", "timeout", "connection", "unavailable", "overloaded"])
+
+
+class TextGeneratorWrapper(TextGenerator):
+    """Delegate to a wrapped text generator. Subclasses override generate()"""
+
+    def __init__(self, text_gen: TextGenerator) -> None:
+        # the wrapped generator owns the provider client and cache
+        self.text_gen = text_gen
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper e.g. provider, model_name, cache
+        if name == "text_gen":
+            raise AttributeError(name)
+        return getattr(self.text_gen, name)
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        return self.text_gen.generate(messages=messages, config=config, **kwargs)
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        return stream_text(self.text_gen, messages=messages, config=config, **kwargs)
+
+    def count_tokens(self, text) -> int:
+        return self.text_gen.count_tokens(text)
+
+
+def stream_text(
+        text_gen: TextGenerator, messages: Union[List[Dict], str],
+        config: TextGenerationConfig = TextGenerationConfig(),
+        **kwargs) -> Iterator[str]:
+    """Yield the text of a single completion in chunks as they arrive.
+
+    Uses the generator's own generate_stream method when it has one and the streaming api of
+    openai clients. Other providers do not stream, the full completion is yielded at once.
+    A stream is one completion whatever config.n, and it is neither cached nor coalesced with
+    identical concurrent calls. config.max_tokens limits its length as for other calls.
+    """
+    if hasattr(text_gen, "generate_stream"):
+        yield from text_gen.generate_stream(messages=messages, config=config, **kwargs)
+        return
+
+    client = getattr(text_gen, "client", None)
+    if client is not None and hasattr(client, "chat"):
+        options = {"max_tokens": config.max_tokens} if config.max_tokens else {}
+        stream = client.chat.completions.create(
+            model=config.model or text_gen.model_name,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            frequency_penalty=config.frequency_penalty,
+            presence_penalty=config.presence_penalty,
+            messages=messages,
+            n=1,
+            stream=True,
+            **options,
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        return
+
+    response = text_gen.generate(messages=messages, config=config, **kwargs)
+    yield response.text[0]["content"]
+
+
+class InstrumentedTextGenerator(TextGeneratorWrapper):
+    """Record latency and token usage of every llm call as an `llm` stage"""
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        with track("llm") as record:
+            response = self.text_gen.generate(messages=messages, config=config, **kwargs)
+            if record is not None:
+                usage = response.usage if isinstance(response.usage, dict) else {}
+                record.prompt_tokens = usage.get("prompt_tokens")
+                record.completion_tokens = usage.get("completion_tokens")
+                record.attributes["provider"] = str(getattr(self.text_gen, "provider", ""))
+                record.attributes["model"] = str(config.model or getattr(self.text_gen, "model_name", ""))
+            return response
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        # a stage context cannot span the yields of a generator, the record is added directly
+        instrumentation = get_instrumentation()
+        stage = get_stage()
+        record = StageRecord(stage=f"{stage}.llm" if stage else "llm")
+        record.attributes["stream"] = True
+        start = time.perf_counter()
+        try:
+            yield from stream_text(self.text_gen, messages=messages, config=config, **kwargs)
+        except BaseException:
+            record.status = False
+            raise
+        finally:
+            record.duration = time.perf_counter() - start
+            if instrumentation is not None:
+                instrumentation.record(record)
+
+
+class ContextCheckedTextGenerator(TextGeneratorWrapper):
+    """Check that prompts fit in the context length of the model before calling the provider.
+
+    Prompts that are too long raise a ContextLengthError locally, instead of after queueing and
+    a network round trip. Models without a known context length are not checked.
+    """
+
+    def _check(self, messages: Union[List[Dict], str], config: TextGenerationConfig) -> None:
+        check_prompt_size(messages, provider=getattr(self.text_gen, "provider", None),
+                          model=config.model or getattr(self.text_gen, "model_name", None),
+                          max_tokens=config.max_tokens)
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        self._check(messages, config)
+        return self.text_gen.generate(messages=messages, config=config, **kwargs)
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        self._check(messages, config)
+        return stream_text(self.text_gen, messages=messages, config=config, **kwargs)
+
+
+class CoalescingTextGenerator(TextGeneratorWrapper):
+    """Share a single upstream call between concurrent identical requests.
+
+    Requests are identical when they have the same messages, config, provider and model. The
+    first caller makes the upstream call, callers that arrive while it is in flight wait for
+    it and receive the same response (or exception).
+    """
+
+    def __init__(self, text_gen: TextGenerator) -> None:
+        super().__init__(text_gen)
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _request_key(self, messages: Union[List[Dict], str], config: TextGenerationConfig) -> str:
+        params = {
+            "provider": getattr(self.text_gen, "provider", None),
+            "model": getattr(self.text_gen, "model_name", None),
+            "messages": messages,
+            "config": dict(config),
+        }
+        return hashlib.md5(json.dumps(
+            params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        key = self._request_key(messages, config)
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+        record_cache("coalesce", hit=not is_leader)
+        if not is_leader:
+            logger.info("Joining in-flight llm request %s", key)
+            return future.result()
+
+        try:
+            response = self.text_gen.generate(messages=messages, config=config, **kwargs)
+            future.set_result(response)
+            return response
+        except BaseException as exception_error:
+            future.set_exception(exception_error)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+class TextGeneratorPool:
+    """Create text generator clients once per provider and model, and reuse them.
+
+    A request for a model that has no client of its own is served by the provider's first
+    client, since the model is passed to the client with every call.
+    """
+
+    def __init__(self) -> None:
+        self._clients: Dict[Tuple[str, str], TextGenerator] = {}
+        self._lock = threading.Lock()
+
+    def add(self, text_gen: TextGenerator, model: str = None) -> TextGenerator:
+        """Register an existing client for its provider (and model)"""
+        key = (text_gen.provider, model)
+        with self._lock:
+            self._clients.setdefault(key, text_gen)
+            self._clients.setdefault((text_gen.provider, None), text_gen)
+            return self._clients[key]
+
+    def replace(self, text_gen: TextGenerator) -> TextGenerator:
+        """Make a client the one of its provider, for every model"""
+        with self._lock:
+            for key in [x for x in self._clients if x[0] == text_gen.provider]:
+                del self._clients[key]
+            self._clients[(text_gen.provider, None)] = text_gen
+            return text_gen
+
+    def get(self, provider: str, model: str = None) -> TextGenerator:
+        with self._lock:
+            text_gen = self._clients.get((provider, model)) or self._clients.get((provider, None))
+            if text_gen is not None:
+                return text_gen
+            logger.info("Creating text generator for provider %s, model %s", provider, model)
+            text_gen = llm(provider=provider, model=model) if model else llm(provider=provider)
+            self._clients[(provider, model)] = text_gen
+            self._clients.setdefault((provider, None), text_gen)
+            # llmx sanitizes provider aliases e.g. azureopenai -> openai
+            self._clients.setdefault((text_gen.provider, None), text_gen)
+            return text_gen
+
+
+class RoutingTextGenerator(TextGeneratorWrapper):
+    """Route llm calls across several text generators, falling back on transient errors.
+
+    With routing="priority" the generators are tried in the order given. With
+    routing="latency" the generator with the lowest moving average latency is tried first.
+    Timeouts and rate limits move on to the next generator, other errors are raised.
+    """
+
+    def __init__(self, text_gens: List[TextGenerator], routing: str = "priority",
+                 smoothing: float = 0.3) -> None:
+        if routing not in ["priority", "latency"]:
+            raise ValueError(f"Unsupported routing '{routing}'. Choose from 'priority', 'latency'.")
+        super().__init__(text_gens[0])
+        self.text_gens = text_gens
+        self.routing = routing
+        self.smoothing = smoothing
+        self.latency: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def ordered(self) -> List[TextGenerator]:
+        if self.routing == "priority":
+            return list(self.text_gens)
+        with self._lock:
+            # generators without measurements sort first so each one gets tried
+            return sorted(self.text_gens, key=lambda x: self.latency.get(id(x), 0.0))
+
+    def _observe(self, text_gen: TextGenerator, latency: float) -> None:
+        with self._lock:
+            previous = self.latency.get(id(text_gen))
+            self.latency[id(text_gen)] = latency if previous is None else \
+                self.smoothing * latency + (1 - self.smoothing) * previous
+
+    def _attempt_config(self, text_gen: TextGenerator,
+                        config: TextGenerationConfig) -> TextGenerationConfig:
+        # models are provider specific, fallback providers use their own default model
+        return config if text_gen is self.text_gen or not config.model else \
+            dataclasses.replace(config, model=None, provider=text_gen.provider)
+
+    def generate(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> TextGenerationResponse:
+        last_error = None
+        for text_gen in self.ordered():
+            attempt_config = self._attempt_config(text_gen, config)
+            start = time.perf_counter()
+            try:
+                response = text_gen.generate(messages=messages, config=attempt_config, **kwargs)
+                self._observe(text_gen, time.perf_counter() - start)
+                return response
+            except Exception as exception_error:
+                if not is_transient_error(exception_error):
+                    raise
+                # penalize the generator so latency routing prefers the others for a while
+                self._observe(text_gen, (time.perf_counter() - start) * 10 + 10)
+                logger.warning("Text generator %s failed with %s, trying next provider",
+                               text_gen.provider, type(exception_error).__name__)
+                last_error = exception_error
+        raise last_error
+
+    def generate_stream(
+            self, messages: Union[List[Dict], str],
+            config: TextGenerationConfig = TextGenerationConfig(),
+            **kwargs) -> Iterator[str]:
+        # falls back only until the first chunk, after that the caller has part of a completion
+        last_error = None
+        for text_gen in self.ordered():
+            attempt_config = self._attempt_config(text_gen, config)
+            start = time.perf_counter()
+            started = False
+            try:
+                for chunk in stream_text(text_gen, messages=messages, config=attempt_config, **kwargs):
+                    started = True
+                    yield chunk
+                self._observe(text_gen, time.perf_counter() - start)
+                return
+            except Exception as exception_error:
+                if started or not is_transient_error(exception_error):
+                    raise
+                self._observe(text_gen, (time.perf_counter() - start) * 10 + 10)
+                logger.warning("Text generator %s failed with %s, trying next provider",
+                               text_gen.provider, type(exception_error).__name__)
+                last_error = exception_error
+        raise last_error
@@ -2,5 +2,6 @@ from .vizeditor import *
 from .vizexplainer import *
 from .vizgenerator import *
 from .vizevaluator import *
+from .vizanalyzer import *
 from .vizrepairer import *
 from .vizrecommender import *
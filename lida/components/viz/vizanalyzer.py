@@ -0,0 +1,153 @@
+import json
+import logging
+import re
+from typing import Dict, List, Optional
+
+from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
+
+from lida.datamodel import Goal
+from lida.instrumentation import instrumented
+from ...utils import clean_code_snippet
+
+logger = logging.getLogger("lida")
+
+system_prompt = """
+You are a helpful assistant highly skilled in explaining and evaluating visualization code. For the plot(data: pd.DataFrame) method in the provided code you produce two things in a single response.
+
+1. explanation: divide the code into sections and explain each one across the following 3 dimensions, with no repetition
+- accessibility: the physical appearance of the chart (colors, chart type etc), the goal of the chart, as well the main insights from the chart. The code for this section is "None".
+- transformation: the section of the code that applies any kind of data transformation (filtering, aggregation, grouping, null value handling etc)
+- visualization: step by step description of the code that creates or modifies the presented visualization.
+
+2. evaluation: score the quality of the code from 1 (bad) - 10 (good) with clear rationale, CONSIDERING VISUALIZATION BEST PRACTICES, across the following dimensions
+- bugs (bugs): are there bugs, logic errors, syntax error or typos? Are there any reasons why the code may fail to compile? If ANY bug exists, the bug score MUST be less than 5.
+- Data transformation (transformation): Is the data transformed appropriately for the visualization type?
+- Goal compliance (compliance): how well the code meets the specified visualization goals?
+- Visualization type (type): is the visualization type appropriate for the data and intent? If a different visualization type is more appropriate, the score MUST be less than 5.
+- Data encoding (encoding): Is the data encoded appropriately for the visualization type?
+- aesthetics (aesthetics): Are the aesthetics of the visualization appropriate for the visualization type and the data?
+
+Assume that data in chart = plot(data) contains a valid dataframe for the dataset.
+"""
+
+format_instructions = """
+Your output MUST be a perfect JSON OBJECT WITH PROPERLY ESCAPED SPECIAL CHARACTERS and exactly two keys, "explanation" (a list of 3 objects) and "evaluation" (a list of 6 objects) e.g.,
+
+```{
+"explanation": [{"section": "accessibility", "code": "None", "explanation": ".."}, {"section": "transformation", "code": "..", "explanation": ".."}, {"section": "visualization", "code": "..", "explanation": ".."}],
+"evaluation": [{"dimension": "bugs", "score": x, "rationale": ".."}, {"dimension": "transformation", "score": x, "rationale": ".."}, {"dimension": "compliance", "score": x, "rationale": ".."}, {"dimension": "type", "score": x, "rationale": ".."}, {"dimension": "encoding", "score": x, "rationale": ".."}, {"dimension": "aesthetics", "score": x, "rationale": ".."}]
+}```
+"""
+
+
+def _match_bracket(text: str, start: int) -> int:
+    """Return the index of the bracket closing the one at start, or -1 if it is not closed"""
+    pairs = {"[": "]", "{": "}"}
+    stack = []
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in pairs:
+            stack.append(pairs[char])
+        elif char in "]}":
+            if not stack or stack.pop() != char:
+                return -1
+            if not stack:
+                return i
+    return -1
+
+
+def parse_section(completion: str, key: str) -> Optional[List[Dict]]:
+    """Parse the list under key from a completion, even if the rest of the JSON is malformed.
+
+    When the list itself does not parse, each object in it that does parse is kept. Returns
+    None when the section is missing.
+    """
+    match = re.search(r'"%s"\s*:\s*\[' % re.escape(key), completion)
+    if not match:
+        return None
+    start = match.end() - 1
+    end = _match_bracket(completion, start)
+    span = completion[start:end + 1] if end != -1 else completion[start:]
+    try:
+        return json.loads(span)
+    except json.JSONDecodeError:
+        pass
+
+    items = []
+    position = 1
+    while True:
+        position = span.find("{", position)
+        if position == -1:
+            break
+        item_end = _match_bracket(span, position)
+        if item_end == -1:
+            break
+        try:
+            items.append(json.loads(span[position:item_end + 1]))
+        except json.JSONDecodeError:
+            pass
+        position = item_end + 1
+    return items
+
+
+class VizAnalyzer(object):
+    """Generate an explanation and an evaluation of visualization code in a single llm call"""
+
+    def __init__(
+        self,
+    ) -> None:
+        pass
+
+    @instrumented("analyzer")
+    def generate(self, code: str, goal: Goal,
+                 textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='seaborn'):
+        """Generate explanations and evaluations given some code and the goal it addresses"""
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "assistant",
+             "content": f"The code to be analyzed is written in {library}. The specified goal is \n\n {goal.question} \n\n and the visualization code is \n\n {code} \n\n=======\n"},
+            {"role": "user",
+             "content": f"{format_instructions}. \n\n THE SCORE YOU ASSIGN MUST BE MEANINGFUL AND BACKED BY CLEAR RATIONALE. The structured explanation and evaluation for the code above is \n\n"}
+        ]
+
+        completions: TextGenerationResponse = text_gen.generate(
+            messages=messages, config=textgen_config)
+
+        analysis = {"explanations": [], "evaluations": []}
+        for completion in completions.text:
+            content = clean_code_snippet(completion["content"])
+            explanation = evaluation = None
+            try:
+                result = json.loads(content)
+                if isinstance(result, dict):
+                    explanation = result.get("explanation")
+                    evaluation = result.get("evaluation")
+            except json.JSONDecodeError:
+                pass
+            # parse each section on its own so a malformed one does not lose the other
+            if not isinstance(explanation, list):
+                explanation = parse_section(completion["content"], "explanation")
+            if not isinstance(evaluation, list):
+                evaluation = parse_section(completion["content"], "evaluation")
+
+            if explanation:
+                analysis["explanations"].append(explanation)
+            else:
+                logger.error("Error parsing explanation %s", content)
+            if evaluation:
+                analysis["evaluations"].append(evaluation)
+            else:
+                logger.error("Error parsing evaluation %s", content)
+        return analysis
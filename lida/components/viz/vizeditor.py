@@ -1,6 +1,10 @@
+from typing import Iterator
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
 from ..scaffold import ChartScaffold
 from lida.datamodel import Goal, Summary
+from lida.instrumentation import instrumented
+from lida.utils import prompt_summary
+from ..textgen import stream_text
 
 
 system_prompt = """
@@ -13,13 +17,12 @@ class VizEditor(object):
 
     def __init__(
         self,
+        backend: str = "pandas",
     ) -> None:
-        self.scaffold = ChartScaffold()
+        self.scaffold = ChartScaffold(backend=backend)
 
-    def generate(
-            self, code: str, summary: Summary, instructions: list[str],
-            textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='altair'):
-        """Edit a code spec based on instructions"""
+    def get_messages(self, code: str, summary: Summary, instructions: list[str], library='altair'):
+        """Build the prompt for editing a code spec"""
 
         instruction_string = ""
         for i, instruction in enumerate(instructions):
@@ -32,13 +35,29 @@ class VizEditor(object):
             rationale=""), library)
         # print("instructions", instructions)
 
-        messages = [
+        return [
             {
                 "role": "system", "content": system_prompt}, {
-                "role": "system", "content": f"The dataset summary is : \n\n {summary} \n\n"}, {
+                "role": "system", "content": f"The dataset summary is : \n\n {prompt_summary(summary)} \n\n"}, {
                 "role": "system", "content": f"The modifications you make MUST BE CORRECT and  based on the '{library}' library and also follow these instructions \n\n{library_instructions} \n\n. The resulting code MUST use the following template \n\n {library_template} \n\n "}, {
                     "role": "user", "content": f"ALL ADDITIONAL LIBRARIES USED MUST BE IMPORTED.\n The code to be modified is: \n\n{code} \n\n. YOU MUST THINK STEP BY STEP, AND CAREFULLY MODIFY ONLY the content of the plot(..) method TO MEET EACH OF THE FOLLOWING INSTRUCTIONS: \n\n {instruction_string} \n\n. The completed modified code THAT FOLLOWS THE TEMPLATE above is. \n"}]
 
+    @instrumented("vizeditor")
+    def generate(
+            self, code: str, summary: Summary, instructions: list[str],
+            textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='altair'):
+        """Edit a code spec based on instructions"""
+
+        messages = self.get_messages(code, summary, instructions, library)
         completions: TextGenerationResponse = text_gen.generate(
             messages=messages, config=textgen_config)
         return [x['content'] for x in completions.text]
+
+    def generate_stream(
+            self, code: str, summary: Summary, instructions: list[str],
+            textgen_config: TextGenerationConfig, text_gen: TextGenerator,
+            library='altair') -> Iterator[str]:
+        """Stream the edited code spec, yielding text chunks as they arrive"""
+
+        messages = self.get_messages(code, summary, instructions, library)
+        yield from stream_text(text_gen, messages=messages, config=textgen_config)
@@ -4,6 +4,7 @@ from ...utils import clean_code_snippet
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
 
 from lida.datamodel import Goal
+from lida.instrumentation import instrumented
 
 system_prompt = """
 You are a helpful assistant highly skilled in evaluating the quality of a given visualization code by providing a score from 1 (bad) - 10 (good) while providing clear rationale. YOU MUST CONSIDER VISUALIZATION BEST PRACTICES for each evaluation. Specifically, you can carefully evaluate the code across the following dimensions
@@ -33,6 +34,7 @@ class VizEvaluator(object):
     ) -> None:
         pass
 
+    @instrumented("evaluator")
     def generate(self, code: str, goal: Goal,
                  textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='altair'):
         """Generate a visualization explanation given some code"""
@@ -2,6 +2,7 @@
 import json
 from lida.utils import clean_code_snippet
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
+from lida.instrumentation import instrumented
 from ..scaffold import ChartScaffold
 
 
@@ -33,6 +34,7 @@ class VizExplainer(object):
     ) -> None:
         self.scaffold = ChartScaffold()
 
+    @instrumented("explainer")
     def generate(
             self, code: str,
             textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='seaborn'):
@@ -1,9 +1,12 @@
 from dataclasses import asdict
-from typing import Dict
+from typing import Dict, Iterator
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
 
 from ..scaffold import ChartScaffold
 from lida.datamodel import Goal
+from lida.instrumentation import instrumented
+from lida.utils import prompt_summary
+from ..textgen import stream_text
 
 
 system_prompt = """
@@ -15,26 +18,39 @@ class VizGenerator(object):
     """Generate visualizations from prompt"""
 
     def __init__(
-        self
+        self,
+        backend: str = "pandas",
     ) -> None:
+        self.scaffold = ChartScaffold(backend=backend)
 
-        self.scaffold = ChartScaffold()
-
-    def generate(self, summary: Dict, goal: Goal,
-                 textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='altair'):
-        """Generate visualization code given a summary and a goal"""
+    def get_messages(self, summary: Dict, goal: Goal, library='altair'):
+        """Build the prompt for generating visualization code"""
 
         library_template, library_instructions = self.scaffold.get_template(goal, library)
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"The dataset summary is : {summary} \n\n"},
+            {"role": "system", "content": f"The dataset summary is : {prompt_summary(summary)} \n\n"},
             library_instructions,
             {"role": "user",
              "content":
              f"Always add a legend with various colors where appropriate. The visualization code MUST only use data fields that exist in the dataset (field_names) or fields that are transformations based on existing field_names). Only use variables that have been defined in the code or are in the dataset summary. You MUST return a FULL PYTHON PROGRAM ENCLOSED IN BACKTICKS ``` that starts with an import statement. DO NOT add any explanation. \n\n THE GENERATED CODE SOLUTION SHOULD BE CREATED BY MODIFYING THE SPECIFIED PARTS OF THE TEMPLATE BELOW \n\n {library_template} \n\n.The FINAL COMPLETED CODE BASED ON THE TEMPLATE above is ... \n\n"}]
 
+    @instrumented("vizgen")
+    def generate(self, summary: Dict, goal: Goal,
+                 textgen_config: TextGenerationConfig, text_gen: TextGenerator, library='altair'):
+        """Generate visualization code given a summary and a goal"""
+
+        messages = self.get_messages(summary, goal, library)
         completions: TextGenerationResponse = text_gen.generate(
             messages=messages, config=textgen_config)
         response = [x['content'] for x in completions.text]
 
         return response
+
+    def generate_stream(self, summary: Dict, goal: Goal,
+                        textgen_config: TextGenerationConfig, text_gen: TextGenerator,
+                        library='altair') -> Iterator[str]:
+        """Stream the visualization code for a goal, yielding text chunks as they arrive"""
+
+        messages = self.get_messages(summary, goal, library)
+        yield from stream_text(text_gen, messages=messages, config=textgen_config)
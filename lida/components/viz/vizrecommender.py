@@ -1,10 +1,14 @@
 import logging
 import json
-from lida.utils import clean_code_snippet
+import re
+from typing import Iterator, List, Tuple
+from lida.utils import clean_code_snippet, prompt_summary
 from ..scaffold import ChartScaffold
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
 # from lida.modules.scaffold import ChartScaffold
 from lida.datamodel import Goal, Summary
+from lida.instrumentation import instrumented
+from ..textgen import stream_text
 
 
 system_prompt = """
@@ -37,22 +41,42 @@ import ...
 
 logger = logging.getLogger("lida")
 
+SNIPPET_SEPARATOR = "*****"
+FENCED_CODE = re.compile(r'```(?:\w+)?\s*([\s\S]*?)\s*```')
+
+
+def pop_snippets(buffer: str) -> Tuple[List[str], str]:
+    """Split the completed code snippets off the front of a partial completion.
+
+    A snippet is complete once its closing fence appears, or once a separator follows
+    unfenced code. Returns the completed snippets and the remaining text.
+    """
+    snippets = []
+    while True:
+        fence = FENCED_CODE.search(buffer)
+        separator = buffer.find(SNIPPET_SEPARATOR)
+        if fence and (separator == -1 or fence.start() < separator):
+            snippets.append(fence.group(1))
+            buffer = buffer[fence.end():]
+        elif separator != -1 and "```" not in buffer[:separator]:
+            head, buffer = buffer[:separator], buffer[separator + len(SNIPPET_SEPARATOR):]
+            if len(head.strip("*").strip()) > 4:
+                snippets.append(clean_code_snippet(head.strip("*")))
+        else:
+            return snippets, buffer
+
 
 class VizRecommender(object):
     """Generate visualizations from prompt"""
 
     def __init__(
         self,
+        backend: str = "pandas",
     ) -> None:
-        self.scaffold = ChartScaffold()
+        self.scaffold = ChartScaffold(backend=backend)
 
-    def generate(
-            self, code: str, summary: Summary,
-            textgen_config: TextGenerationConfig,
-            text_gen: TextGenerator,
-            n=3,
-            library='seaborn'):
-        """Recommend a code spec based on existing visualization"""
+    def get_messages(self, code: str, summary: Summary, n=3, library='seaborn'):
+        """Build the prompt for recommending visualizations"""
 
         library_template, library_instructions = self.scaffold.get_template(Goal(
             index=0,
@@ -64,23 +88,53 @@ class VizRecommender(object):
         EACH CODE SNIPPET MUST BE A FULL PROGRAM (IT MUST IMPORT ALL THE LIBRARIES THAT ARE USED AND MUST CONTAIN plot(data) method). IT MUST FOLLOW THE STRUCTURE BELOW AND ONLY MODIFY THE INDICATED SECTIONS. \n\n {library_template} \n\n.
         """
 
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "system", "content": structure_instruction},
-            {"role": "system", "content": f"The dataset summary is : \n\n {summary} \n\n"},
+            {"role": "system", "content": f"The dataset summary is : \n\n {prompt_summary(summary)} \n\n"},
             {"role": "system",
              "content":
              f"An example visualization code is: \n\n ```{code}``` \n\n. You MUST use only the {library} library. \n"},
             {"role": "user", "content": f"Recommend {n} (n=({n})) visualizations in the format specified. \n."}]
 
+    @instrumented("recommender")
+    def generate(
+            self, code: str, summary: Summary,
+            textgen_config: TextGenerationConfig,
+            text_gen: TextGenerator,
+            n=3,
+            library='seaborn'):
+        """Recommend a code spec based on existing visualization"""
+
+        messages = self.get_messages(code, summary, n, library)
         textgen_config.messages = messages
         result: TextGenerationResponse = text_gen.generate(
             messages=messages, config=textgen_config)
         output = []
-        snippets = result.text[0]["content"].split("*****")
+        snippets = result.text[0]["content"].split(SNIPPET_SEPARATOR)
         for snippet in snippets:
             cleaned_snippet = clean_code_snippet(snippet)
             if len(cleaned_snippet) > 4:
                 output.append(cleaned_snippet)
 
         return output
+
+    def generate_stream(
+            self, code: str, summary: Summary,
+            textgen_config: TextGenerationConfig,
+            text_gen: TextGenerator,
+            n=3,
+            library='seaborn') -> Iterator[str]:
+        """Recommend code specs, yielding each one as soon as it is complete in the stream"""
+
+        messages = self.get_messages(code, summary, n, library)
+        buffer = ""
+        for chunk in stream_text(text_gen, messages=messages, config=textgen_config):
+            buffer += chunk
+            snippets, buffer = pop_snippets(buffer)
+            yield from snippets
+
+        # trailing unfenced code, skipping any closing prose after the last snippet
+        cleaned_snippet = clean_code_snippet(buffer.strip().strip("*"))
+        if "plot(" in cleaned_snippet:
+            yield cleaned_snippet
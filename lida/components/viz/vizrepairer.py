@@ -1,8 +1,11 @@
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Union
 from llmx import TextGenerator, TextGenerationConfig, TextGenerationResponse
 
 from ..scaffold import ChartScaffold
 from lida.datamodel import Goal, Summary
+from lida.instrumentation import instrumented
+from lida.utils import prompt_summary
+from ..textgen import stream_text
 
 system_prompt = """
 You are a helpful assistant highly skilled in revising visualization code to improve the quality of the code and visualization based on feedback.  Assume that data in plot(data) contains a valid dataframe.
@@ -15,29 +18,45 @@ class VizRepairer(object):
 
     def __init__(
         self,
+        backend: str = "pandas",
     ) -> None:
-        self.scaffold = ChartScaffold()
+        self.scaffold = ChartScaffold(backend=backend)
 
-    def generate(
+    def get_messages(
             self, code: str, feedback: Union[str, Dict, List[Dict]],
-            goal: Goal, summary: Summary, textgen_config: TextGenerationConfig,
-            text_gen: TextGenerator, library='altair',):
-        """Fix a code spec based on feedback"""
+            goal: Goal, summary: Summary, library='altair'):
+        """Build the prompt for fixing a code spec"""
         library_template, library_instructions = self.scaffold.get_template(Goal(
             index=0,
             question="",
             visualization="",
             rationale=""), library)
-        messages = [
+        # library with the following instructions {library_instructions}
+        return [
             {"role": "system", "content": system_prompt},
-            {"role": "system", "content": f"The dataset summary is : {summary}. \n . The original goal was: {goal}."},
+            {"role": "system", "content": f"The dataset summary is : {prompt_summary(summary)}. \n . The original goal was: {goal}."},
             {"role": "system",
              "content":
              f"You MUST use only the {library}. The resulting code MUST use the following template {library_template}. Only use variables that have been defined in the code or are in the dataset summary"},
             {"role": "user", "content": f"The existing code to be fixed is: {code}. \n Fix the code above to address the feedback: {feedback}. ONLY apply feedback that are CORRECT."}]
 
-        # library with the following instructions {library_instructions}
+    @instrumented("repairer")
+    def generate(
+            self, code: str, feedback: Union[str, Dict, List[Dict]],
+            goal: Goal, summary: Summary, textgen_config: TextGenerationConfig,
+            text_gen: TextGenerator, library='altair',):
+        """Fix a code spec based on feedback"""
 
+        messages = self.get_messages(code, feedback, goal, summary, library)
         completions: TextGenerationResponse = text_gen.generate(
             messages=messages, config=textgen_config)
         return [x['content'] for x in completions.text]
+
+    def generate_stream(
+            self, code: str, feedback: Union[str, Dict, List[Dict]],
+            goal: Goal, summary: Summary, textgen_config: TextGenerationConfig,
+            text_gen: TextGenerator, library='altair') -> Iterator[str]:
+        """Stream the fixed code spec, yielding text chunks as they arrive"""
+
+        messages = self.get_messages(code, feedback, goal, summary, library)
+        yield from stream_text(text_gen, messages=messages, config=textgen_config)
@@ -51,6 +51,16 @@ class Goal:
 """
 
 
+@dataclass
+class TableRelationship:
+    """A key relationship between two tables, e.g. orders.customer_id -> customers.id"""
+
+    left: str
+    left_on: str
+    right: str
+    right_on: str
+
+
 @dataclass
 class Summary:
     """A summary of a dataset"""
@@ -60,6 +70,12 @@ class Summary:
     dataset_description: str
     field_names: List[Any]
     fields: Optional[List[Any]] = None
+    stats: Optional[Dict[str, Any]] = None
+    # summaries of the tables of a TableCollection and the relationships between them
+    tables: Optional[List[Any]] = None
+    relationships: Optional[List[Any]] = None
+    # description of the cubes aggregated over the full dataset, see CubeBuilder
+    cubes: Optional[Dict[str, Any]] = None
 
     def _repr_markdown_(self):
         field_lines = "\n".join([f"- **{name}:** {field}" for name,
@@ -109,6 +125,7 @@ class GoalWebRequest:
         default_factory=TextGenerationConfig
     )
     n: int = 5
+    session_id: Optional[str] = None
 
 
 @dataclass
@@ -121,6 +138,8 @@ class VisualizeWebRequest:
     textgen_config: Optional[TextGenerationConfig] = field(
         default_factory=TextGenerationConfig
     )
+    max_repairs: int = 0
+    session_id: Optional[str] = None
 
 
 @dataclass
@@ -133,6 +152,7 @@ class VisualizeRecommendRequest:
     textgen_config: Optional[TextGenerationConfig] = field(
         default_factory=TextGenerationConfig
     )
+    max_repairs: int = 0
 
 
 @dataclass
@@ -146,6 +166,7 @@ class VisualizeEditWebRequest:
     textgen_config: Optional[TextGenerationConfig] = field(
         default_factory=TextGenerationConfig
     )
+    max_repairs: int = 0
 
 
 @dataclass
@@ -185,6 +206,18 @@ class VisualizeEvalWebRequest:
     )
 
 
+@dataclass
+class VisualizeAnalyzeWebRequest:
+    """A Visualize Analyze Web Request, explains and evaluates code in a single llm call"""
+
+    code: str
+    goal: Goal
+    library: str = "seaborn"
+    textgen_config: Optional[TextGenerationConfig] = field(
+        default_factory=TextGenerationConfig
+    )
+
+
 @dataclass
 class ChartExecutorResponse:
     """Response from a visualization execution"""
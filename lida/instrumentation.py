@@ -0,0 +1,286 @@
+# Instrumentation of lida stages (Manager methods, component generate calls, llm calls,
+# chart execution and encoding). Records latency, token usage and cache hits into per-stage
+# histograms, and forwards each stage to pluggable hooks (e.g. OpenTelemetry spans).
+
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("lida")
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DEFAULT_TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+_current_instrumentation = contextvars.ContextVar("lida_instrumentation", default=None)
+_current_stage = contextvars.ContextVar("lida_stage", default=None)
+
+
+@dataclass
+class StageRecord:
+    """Measurements for a single execution of a stage"""
+
+    stage: str
+    duration: float = 0.0
+    status: bool = True
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds (prometheus style)"""
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": dict(zip(self.buckets, self.counts)),
+        }
+
+
+class InstrumentationHook:
+    """Base class for hooks notified at the start and end of every stage"""
+
+    def start(self, stage: str) -> Any:
+        """Called when a stage starts. The return value is passed back to end()"""
+        return None
+
+    def end(self, handle: Any, record: StageRecord) -> None:
+        """Called when a stage ends with its measurements"""
+
+
+class OpenTelemetryHook(InstrumentationHook):
+    """Emit an OpenTelemetry span per stage. Nested stages become child spans."""
+
+    def __init__(self, tracer: Any = None) -> None:
+        try:
+            from opentelemetry import context, trace
+        except ImportError as exc:
+            raise ImportError(
+                "Please install opentelemetry to use the OpenTelemetryHook. pip install opentelemetry-api") from exc
+        self._context = context
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("lida")
+
+    def start(self, stage: str) -> Any:
+        span = self.tracer.start_span(f"lida.{stage}")
+        token = self._context.attach(self._trace.set_span_in_context(span))
+        return span, token
+
+    def end(self, handle: Any, record: StageRecord) -> None:
+        span, token = handle
+        span.set_attribute("lida.duration", record.duration)
+        span.set_attribute("lida.status", record.status)
+        if record.prompt_tokens is not None:
+            span.set_attribute("lida.prompt_tokens", record.prompt_tokens)
+        if record.completion_tokens is not None:
+            span.set_attribute("lida.completion_tokens", record.completion_tokens)
+        for key, value in record.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                span.set_attribute(f"lida.{key}", value)
+        self._context.detach(token)
+        span.end()
+
+
+class Instrumentation:
+    """Collect per-stage latency, token and cache hit metrics.
+
+    Stages nest: an llm call made while visualizing is recorded as `visualize.vizgen.llm`.
+    """
+
+    def __init__(
+            self, hooks: List[InstrumentationHook] = None,
+            latency_buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+            token_buckets: Tuple[float, ...] = DEFAULT_TOKEN_BUCKETS,
+            max_records: int = 1000) -> None:
+        self.hooks = list(hooks or [])
+        self.latency_buckets = latency_buckets
+        self.token_buckets = token_buckets
+        self.records = deque(maxlen=max_records)
+        self.latency: Dict[str, Histogram] = {}
+        self.prompt_tokens: Dict[str, Histogram] = {}
+        self.completion_tokens: Dict[str, Histogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.cache_hits: Dict[str, int] = {}
+        self.cache_misses: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: InstrumentationHook) -> None:
+        self.hooks.append(hook)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageRecord]:
+        """Measure a stage. The yielded record can be annotated with token counts or attributes"""
+        parent = _current_stage.get()
+        record = StageRecord(stage=f"{parent}.{name}" if parent else name)
+        instrumentation_token = _current_instrumentation.set(self)
+        stage_token = _current_stage.set(record.stage)
+        handles = []
+        for hook in self.hooks:
+            try:
+                handles.append((hook, hook.start(record.stage)))
+            except Exception as exception_error:
+                logger.error(f"Instrumentation hook failed to start: {str(exception_error)}")
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record.status = False
+            raise
+        finally:
+            record.duration = time.perf_counter() - start
+            _current_stage.reset(stage_token)
+            _current_instrumentation.reset(instrumentation_token)
+            self.record(record)
+            for hook, handle in reversed(handles):
+                try:
+                    hook.end(handle, record)
+                except Exception as exception_error:
+                    logger.error(f"Instrumentation hook failed to end: {str(exception_error)}")
+
+    def record(self, record: StageRecord) -> None:
+        """Add a finished stage record to the histograms"""
+        with self._lock:
+            self.records.append(record)
+            self._histogram(self.latency, record.stage, self.latency_buckets).observe(
+                record.duration)
+            if record.prompt_tokens is not None:
+                self._histogram(self.prompt_tokens, record.stage, self.token_buckets).observe(
+                    record.prompt_tokens)
+            if record.completion_tokens is not None:
+                self._histogram(self.completion_tokens, record.stage, self.token_buckets).observe(
+                    record.completion_tokens)
+            if not record.status:
+                self.errors[record.stage] = self.errors.get(record.stage, 0) + 1
+
+    def record_cache(self, name: str, hit: bool) -> None:
+        """Count a hit or miss for the named cache in the current stage"""
+        parent = _current_stage.get()
+        key = f"{parent}.{name}" if parent else name
+        with self._lock:
+            counter = self.cache_hits if hit else self.cache_misses
+            counter[key] = counter.get(key, 0) + 1
+
+    def _histogram(self, histograms: Dict[str, Histogram], stage: str, buckets) -> Histogram:
+        if stage not in histograms:
+            histograms[stage] = Histogram(buckets)
+        return histograms[stage]
+
+    def summary(self) -> dict:
+        """Return per-stage metrics as a dictionary"""
+        with self._lock:
+            stages = sorted(set(self.latency) | set(self.cache_hits) | set(self.cache_misses))
+            result = {}
+            for stage in stages:
+                result[stage] = {
+                    "latency": self.latency[stage].to_dict() if stage in self.latency else None,
+                    "prompt_tokens": self.prompt_tokens[stage].to_dict() if stage in self.prompt_tokens else None,
+                    "completion_tokens": self.completion_tokens[stage].to_dict() if stage in self.completion_tokens else None,
+                    "errors": self.errors.get(stage, 0),
+                    "cache_hits": self.cache_hits.get(stage, 0),
+                    "cache_misses": self.cache_misses.get(stage, 0),
+                }
+            return result
+
+    def to_prometheus(self, prefix: str = "lida") -> str:
+        """Render all metrics in the prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric, histograms, help_text in [
+                ("stage_duration_seconds", self.latency, "Stage latency in seconds"),
+                ("stage_prompt_tokens", self.prompt_tokens, "Prompt tokens per llm call"),
+                ("stage_completion_tokens", self.completion_tokens, "Completion tokens per llm call"),
+            ]:
+                name = f"{prefix}_{metric}"
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for stage, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            for metric, counters, help_text in [
+                ("stage_errors_total", self.errors, "Number of failed stages"),
+                ("cache_hits_total", self.cache_hits, "Number of cache hits"),
+                ("cache_misses_total", self.cache_misses, "Number of cache misses"),
+            ]:
+                name = f"{prefix}_{metric}"
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for stage, count in sorted(counters.items()):
+                    lines.append(f'{name}{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def get_instrumentation() -> Optional[Instrumentation]:
+    """Return the instrumentation active in the current context, if any"""
+    return _current_instrumentation.get()
+
+
+def get_stage() -> Optional[str]:
+    """Return the full name of the stage active in the current context, if any"""
+    return _current_stage.get()
+
+
+@contextmanager
+def track(name: str) -> Iterator[Optional[StageRecord]]:
+    """Measure a stage with the active instrumentation. A no-op when none is active"""
+    instrumentation = _current_instrumentation.get()
+    if instrumentation is None:
+        yield None
+        return
+    with instrumentation.stage(name) as record:
+        yield record
+
+
+def record_cache(name: str, hit: bool) -> None:
+    """Count a cache hit or miss with the active instrumentation, if any"""
+    instrumentation = _current_instrumentation.get()
+    if instrumentation is not None:
+        instrumentation.record_cache(name, hit)
+
+
+def instrumented(name: str = None):
+    """Decorator that records a method as a stage.
+
+    The instrumentation is taken from the `instrumentation` attribute of the object the
+    method is bound to (e.g. Manager), or else from the active context.
+    """
+
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            instrumentation = getattr(args[0], "instrumentation", None) if args else None
+            if not isinstance(instrumentation, Instrumentation):
+                instrumentation = _current_instrumentation.get()
+            if instrumentation is None:
+                return func(*args, **kwargs)
+            with instrumentation.stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,14 +1,18 @@
 import base64
+import dataclasses
+import functools
+import importlib.util
 import json
 import logging
-from typing import Any, List, Tuple, Union
+from typing import Any, Iterator, List, Optional, Tuple, Union
 import os
 import io
 import numpy as np
 import pandas as pd
 import re
-import matplotlib.pyplot as plt
-import tiktoken
+import threading
+import time
+from collections import OrderedDict
 from diskcache import Cache
 import hashlib
 import io
@@ -42,25 +46,82 @@ def clean_column_names(df: pd.DataFrame) -> pd.DataFrame:
     return cleaned_df
 
 
-def read_dataframe(file_location: str, encoding: str = 'utf-8') -> pd.DataFrame:
+def has_pyarrow() -> bool:
+    """Check if the optional pyarrow dependency is installed, without importing it"""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def compact_dtypes(df: pd.DataFrame, category_threshold: float = 0.5) -> pd.DataFrame:
+    """
+    Convert the columns of a DataFrame to compact dtypes.
+
+    Integers are downcast to the smallest integer type that holds them and floats to float32
+    when that loses no precision. String columns with few distinct values become categorical,
+    other string columns are stored in pyarrow backed strings when pyarrow is installed.
+
+    :param df: The DataFrame to convert.
+    :param category_threshold: Maximum ratio of distinct values to rows of categorical columns.
+    :return: A DataFrame with compact dtypes.
+    """
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+            columns[column] = series
+        elif pd.api.types.is_integer_dtype(series) and series.dtype.kind in "iu":
+            columns[column] = pd.to_numeric(series, downcast="integer")
+        elif pd.api.types.is_float_dtype(series) and series.dtype.kind == "f":
+            downcast = series.astype(np.float32)
+            lossless = np.array_equal(downcast.to_numpy(dtype=np.float64), series.to_numpy(),
+                                      equal_nan=True)
+            columns[column] = downcast if lossless else series
+        elif (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)) and \
+                pd.api.types.infer_dtype(series, skipna=True) == "string":
+            if len(series) and series.nunique() / len(series) < category_threshold:
+                columns[column] = series.astype("category")
+            elif has_pyarrow():
+                columns[column] = series.astype("string[pyarrow]")
+            else:
+                columns[column] = series
+        else:
+            columns[column] = series
+    return pd.DataFrame(columns, index=df.index)
+
+
+def read_dataframe(file_location: str, encoding: str = 'utf-8',
+                   optimize: bool = False, columns: List[str] = None,
+                   filters: List[Tuple] = None, sample: bool = True) -> pd.DataFrame:
     """
     Read a dataframe from a given file location and clean its column names.
-    It also samples down to 4500 rows if the data exceeds that limit.
+    It also samples down to 4500 rows if the data exceeds that limit. A file with dirty column
+    names is rewritten with the clean names and all of its rows.
 
     :param file_location: The path to the file containing the data.
     :param encoding: Encoding to use for the file reading.
+    :param optimize: Read csv files with the pyarrow engine (when installed) and convert columns to compact dtypes, see compact_dtypes.
+    :param columns: Only read these columns of parquet and feather files. Their names must already be clean.
+    :param filters: Only read the rows of parquet files that match these filters, see pandas.read_parquet.
+    :param sample: Sample down to 4500 rows. Tables that are joined later are read with all their rows.
     :return: A cleaned DataFrame.
     """
     file_extension = file_location.split('.')[-1]
 
+    def read_csv(**kwargs):
+        if optimize and has_pyarrow():
+            try:
+                return pd.read_csv(file_location, encoding=encoding, engine="pyarrow", **kwargs)
+            except (ValueError, ImportError) as e:
+                logger.info(f"Reading {file_location} with the default csv engine. {e}")
+        return pd.read_csv(file_location, encoding=encoding, **kwargs)
+
     read_funcs = {
         'json': lambda: pd.read_json(file_location, orient='records', encoding=encoding),
-        'csv': lambda: pd.read_csv(file_location, encoding=encoding),
+        'csv': read_csv,
         'xls': lambda: pd.read_excel(file_location, encoding=encoding),
         'xlsx': lambda: pd.read_excel(file_location, encoding=encoding),
-        'parquet': pd.read_parquet,
-        'feather': pd.read_feather,
-        'tsv': lambda: pd.read_csv(file_location, sep="\t", encoding=encoding)
+        'parquet': lambda: pd.read_parquet(file_location, columns=columns, filters=filters),
+        'feather': lambda: pd.read_feather(file_location, columns=columns),
+        'tsv': lambda: read_csv(sep="\t")
     }
 
     if file_extension not in read_funcs:
@@ -74,22 +135,29 @@ def read_dataframe(file_location: str, encoding: str = 'utf-8') -> pd.DataFrame:
 
     # Clean column names
     cleaned_df = clean_column_names(df)
+    # the file is rewritten with all the rows, backends and cubes aggregate the full dataset
+    full_df = cleaned_df
 
     # Sample down to 4500 rows if necessary
-    if len(cleaned_df) > 4500:
+    if sample and len(cleaned_df) > 4500:
         logger.info(
             "Dataframe has more than 4500 rows. We will sample 4500 rows.")
-        cleaned_df = cleaned_df.sample(4500)
+        # the same rows on every call, so processes serving one dataset execute charts on the same sample
+        cleaned_df = cleaned_df.sample(4500, random_state=42)
 
-    if cleaned_df.columns.tolist() != df.columns.tolist():
+    if optimize:
+        cleaned_df = compact_dtypes(cleaned_df)
+
+    # only a full read may overwrite the file, a subset of its columns or rows would lose data
+    if columns is None and filters is None and cleaned_df.columns.tolist() != df.columns.tolist():
         write_funcs = {
-            'csv': lambda: cleaned_df.to_csv(file_location, index=False, encoding=encoding),
-            'xls': lambda: cleaned_df.to_excel(file_location, index=False),
-            'xlsx': lambda: cleaned_df.to_excel(file_location, index=False),
-            'parquet': lambda: cleaned_df.to_parquet(file_location, index=False),
-            'feather': lambda: cleaned_df.to_feather(file_location, index=False),
-            'json': lambda: cleaned_df.to_json(file_location, orient='records', index=False, default_handler=str),
-            'tsv': lambda: cleaned_df.to_csv(file_location, index=False, sep='\t', encoding=encoding)
+            'csv': lambda: full_df.to_csv(file_location, index=False, encoding=encoding),
+            'xls': lambda: full_df.to_excel(file_location, index=False),
+            'xlsx': lambda: full_df.to_excel(file_location, index=False),
+            'parquet': lambda: full_df.to_parquet(file_location, index=False),
+            'feather': lambda: full_df.to_feather(file_location, index=False),
+            'json': lambda: full_df.to_json(file_location, orient='records', index=False, default_handler=str),
+            'tsv': lambda: full_df.to_csv(file_location, index=False, sep='\t', encoding=encoding)
         }
 
         if file_extension not in write_funcs:
@@ -104,6 +172,34 @@ def read_dataframe(file_location: str, encoding: str = 'utf-8') -> pd.DataFrame:
     return cleaned_df
 
 
+def iter_dataframe(file_location: str, encoding: str = 'utf-8',
+                   chunksize: int = 100000) -> Iterator[pd.DataFrame]:
+    """
+    Read all the rows of a file in chunks, with clean column names.
+
+    Csv and tsv files (and parquet files, when pyarrow is installed) are read chunksize rows at
+    a time, other files at once.
+
+    :param file_location: The path to the file containing the data.
+    :param encoding: Encoding to use for the file reading.
+    :param chunksize: Number of rows per chunk.
+    :return: An iterator of DataFrames.
+    """
+    file_extension = file_location.split('.')[-1]
+    if file_extension in ['csv', 'tsv']:
+        chunks = pd.read_csv(file_location, encoding=encoding, chunksize=chunksize,
+                             sep='\t' if file_extension == 'tsv' else ',')
+    elif file_extension == 'parquet' and has_pyarrow():
+        import pyarrow.parquet as pq
+
+        chunks = (batch.to_pandas() for batch in
+                  pq.ParquetFile(file_location).iter_batches(batch_size=chunksize))
+    else:
+        chunks = [read_dataframe(file_location, encoding=encoding, sample=False)]
+    for chunk in chunks:
+        yield clean_column_names(chunk)
+
+
 def file_to_df(file_location: str):
     """ Get summary of data from file location """
     file_name = file_location.split("/")[-1]
@@ -122,77 +218,199 @@ def file_to_df(file_location: str):
     return df
 
 
-def plot_raster(rasters: Union[str, List[str]], figsize: Tuple[int, int] = (10, 10)):
+def resize_image(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    """
+    Resize an image array of shape (height, width, channels) with bilinear interpolation on both axes.
     """
-    Plot a series of base64-encoded raster images in a horizontal layout.
+    in_height, in_width = image.shape[:2]
+    if (in_height, in_width) == (height, width):
+        return image
+    y = np.linspace(0, in_height - 1, height)
+    x = np.linspace(0, in_width - 1, width)
+    y0, x0 = np.floor(y).astype(int), np.floor(x).astype(int)
+    y1, x1 = np.minimum(y0 + 1, in_height - 1), np.minimum(x0 + 1, in_width - 1)
+    wy = (y - y0).astype(image.dtype)[:, None, None]
+    wx = (x - x0).astype(image.dtype)[None, :, None]
+    top = image[np.ix_(y0, x0)] * (1 - wx) + image[np.ix_(y0, x1)] * wx
+    bottom = image[np.ix_(y1, x0)] * (1 - wx) + image[np.ix_(y1, x1)] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def compose_rasters(rasters: Union[str, List[str]], columns: int = None) -> np.ndarray:
+    """
+    Decode base64-encoded png images and lay them out in a grid, resized to a common height.
 
     Args:
         rasters: A single base64 string or a list of base64-encoded strings representing the images.
-        figsize: A tuple indicating the size of the figure to display.
+        columns: Number of images per row. Defaults to all the images in a single row.
+
+    Returns:
+        An RGBA float array of the grid, transparent where a row is narrower than the widest one.
     """
-    plt.figure(figsize=figsize)
+    import matplotlib.pyplot as plt
 
     if isinstance(rasters, str):
         rasters = [rasters]
 
+    # decode each image once, as RGBA
     images = []
-
-    # Find the max height for resizing
-    max_height = 0
     for raster in rasters:
-        decoded_image = base64.b64decode(raster)
-        image = plt.imread(io.BytesIO(decoded_image), format='PNG')
+        image = np.asarray(plt.imread(io.BytesIO(base64.b64decode(raster)), format='PNG'),
+                           dtype=np.float32)
+        if image.ndim == 2:
+            image = np.repeat(image[:, :, None], 3, axis=2)
+        if image.shape[2] == 3:
+            image = np.concatenate(
+                (image, np.ones(image.shape[:2] + (1,), dtype=np.float32)), axis=2)
+        images.append(image)
+
+    # resize to the max height while preserving the aspect ratio
+    height = max(image.shape[0] for image in images)
+    widths = [int(height * image.shape[1] / image.shape[0]) for image in images]
+    columns = columns or len(images)
+    rows = [list(range(i, min(i + columns, len(images)))) for i in range(0, len(images), columns)]
+    grid_width = max(sum(widths[i] for i in row) for row in rows)
+
+    grid = np.zeros((height * len(rows), grid_width, 4), dtype=np.float32)
+    for row_index, row in enumerate(rows):
+        left = 0
+        for i in row:
+            top = row_index * height
+            grid[top:top + height, left:left + widths[i]] = resize_image(images[i], height, widths[i])
+            left += widths[i]
+    return np.clip(grid, 0, 1, out=grid)
+
+
+def plot_raster(rasters: Union[str, List[str]], figsize: Tuple[int, int] = (10, 10),
+                columns: int = None):
+    """
+    Plot a series of base64-encoded raster images in a horizontal layout, or a grid.
 
-        max_height = max(max_height, image.shape[0])
+    Args:
+        rasters: A single base64 string or a list of base64-encoded strings representing the images.
+        figsize: A tuple indicating the size of the figure to display.
+        columns: Number of images per row. Defaults to all the images in a single row.
+    """
+    import matplotlib.pyplot as plt
 
-    # Resize images to max_height while preserving the aspect ratio and alpha channel if it exists
-    for raster in rasters:
-        decoded_image = base64.b64decode(raster)
-        image = plt.imread(io.BytesIO(decoded_image), format='PNG')
+    plt.figure(figsize=figsize)
+    plt.imshow(compose_rasters(rasters, columns=columns))
+    plt.axis('off')
+    plt.show()
 
-        aspect_ratio = image.shape[1] / image.shape[0]
-        new_width = int(max_height * aspect_ratio)
-        image_resized = np.array([np.interp(np.linspace(
-            0, len(row), new_width), np.arange(0, len(row)), row) for row in image])
 
-        if image_resized.shape[2] == 4:  # If RGBA, preserve alpha channel
-            alpha_channel = image_resized[:, :, 3:]
-            # Drop the alpha for visualization
-            image_resized = image_resized[:, :, :3]
-            image_resized = np.clip(image_resized, 0, 1)
-            image_resized = np.concatenate(
-                (image_resized, alpha_channel), axis=2)
+# tokens the llmx openai client reserves for the completion, prompts must leave room for them
+MIN_COMPLETION_TOKENS = 200
 
-        images.append(image_resized)
 
-    # Concatenate images along the width
-    concatenated_image = np.concatenate(images, axis=1)
+class ContextLengthError(ValueError):
+    """A prompt does not fit in the context length of a model"""
 
-    plt.imshow(concatenated_image)
-    plt.axis('off')
-    plt.show()
 
+# seconds before a tokenizer that failed to load is tried again
+ENCODING_RETRY_SECONDS = 300
+_encodings = {}
+_encoding_failures = {}
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+
+def get_encoding(model: str = None):
+    """The tiktoken encoding of a model, cl100k_base for models without their own (an estimate
+    for other providers). None when tiktoken is not installed or its encoding cannot be loaded,
+    e.g. offline on first use. Loaded encodings are cached, failures are retried after
+    ENCODING_RETRY_SECONDS"""
+    if model in _encodings:
+        return _encodings[model]
+    failed = _encoding_failures.get(model)
+    if failed is not None and time.monotonic() - failed < ENCODING_RETRY_SECONDS:
+        return None
     try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += -1  # role is always required and always 1 token
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        return num_tokens
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not presently implemented for model {model}.""")
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except (KeyError, TypeError):
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as exception_error:
+        logger.warning(f"Could not load a tokenizer, estimating token counts: {str(exception_error)}")
+        _encoding_failures[model] = time.monotonic()
+        return None
+    _encodings[model] = encoding
+    return encoding
+
+
+# token counts memoized by digest of the text, prompts themselves are not kept in memory
+TOKEN_COUNT_CACHE_SIZE = 8192
+_token_counts: "OrderedDict[tuple, int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Number of tokens of a text, memoized since the same messages are sent again and again.
+    Estimated from the length of the text while the tokenizer cannot be loaded"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    key = (hashlib.md5(text.encode("utf-8", "surrogatepass")).hexdigest(), encoding)
+    with _token_counts_lock:
+        if key in _token_counts:
+            _token_counts.move_to_end(key)
+            return _token_counts[key]
+    num_tokens = len(encoding.encode(text, disallowed_special=()))
+    with _token_counts_lock:
+        _token_counts[key] = num_tokens
+        if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _token_counts.popitem(last=False)
+    return num_tokens
+
+
+def num_tokens_from_messages(messages: Union[List[dict], str], model: str = "gpt-3.5-turbo-0301") -> int:
+    """Returns the number of tokens used by a list of messages, or a prompt string, for any model."""
+    if isinstance(messages, str):
+        return count_tokens(messages, model)
+    # every message follows <im_start>{role/name}\n{content}<im_end>\n, and every reply is
+    # primed with <im_start>assistant (plus <im_sep> after gpt-3.5-turbo-0301)
+    tokens_per_message, tokens_per_name, reply_tokens = \
+        (4, -1, 2) if model == "gpt-3.5-turbo-0301" else (3, 1, 3)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += count_tokens(str(value), model)
+            if key == "name":
+                num_tokens += tokens_per_name
+    num_tokens += reply_tokens
+    return num_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def get_context_length(provider: str, model: str) -> Optional[int]:
+    """Context length of a model listed in llmx.providers, by model name or api model id"""
+    from llmx import providers
+
+    for model_config in providers.get(provider, {}).get("models", []):
+        parameters = (model_config.get("model") or {}).get("parameters") or {}
+        if model in [model_config.get("name"), parameters.get("model")]:
+            return model_config.get("max_tokens")
+    return None
+
+
+def check_prompt_size(messages: Union[List[dict], str], provider: str, model: str,
+                      max_tokens: int = None) -> int:
+    """
+    Check that a prompt fits in the context length of a model before it is sent.
+
+    :param max_tokens: Tokens requested for the completion, MIN_COMPLETION_TOKENS when not set.
+    :return: The number of prompt tokens.
+    :raises ContextLengthError: When the prompt and the completion tokens exceed the context length.
+    """
+    num_tokens = num_tokens_from_messages(messages, model)
+    context_length = get_context_length(provider, model) if provider and model else None
+    completion_tokens = max_tokens or MIN_COMPLETION_TOKENS
+    if context_length is not None and num_tokens + completion_tokens > context_length:
+        raise ContextLengthError(
+            f"The prompt has {num_tokens} tokens, which exceeds the context length of {model} "
+            f"({context_length} tokens, including {completion_tokens} for the completion)")
+    return num_tokens
 
 
 def cache_request(cache: Cache, params: Any, values: Any = None) -> Any:
@@ -212,6 +430,43 @@ def cache_request(cache: Cache, params: Any, values: Any = None) -> Any:
     return values
 
 
+def drop_stats(summary: Any) -> Any:
+    """Return the summary without the statistics kept for incremental updates.
+
+    The statistics hold distinct value sketches and moments of every column, only
+    Summarizer.update reads them. Summaries sent to clients or hashed into keys drop them.
+    """
+    if isinstance(summary, dict):
+        return {key: value for key, value in summary.items() if key != "stats"}
+    if getattr(summary, "stats", None) is not None:
+        return dataclasses.replace(summary, stats=None)
+    return summary
+
+
+def prompt_summary(summary: Any) -> Any:
+    """Return the summary without the statistics kept for incremental updates, for use in prompts.
+
+    Summaries of table collections drop their per-table summaries, whose fields are already
+    listed with table qualified names, and explain how code accesses the tables. Summaries
+    with pre-aggregated cubes explain how code accesses the cubes.
+    """
+    if not isinstance(summary, dict) and (getattr(summary, "tables", None) is not None or
+                                          getattr(summary, "cubes", None) is not None):
+        summary = dataclasses.asdict(summary)
+    summary = drop_stats(summary)
+    if isinstance(summary, dict):
+        if summary.get("tables") is not None:
+            from lida.components.tables import TABLES_INSTRUCTION
+
+            del summary["tables"]
+            summary["data_access"] = TABLES_INSTRUCTION
+        if summary.get("cubes") is not None:
+            from lida.components.cubes import CUBES_INSTRUCTION
+
+            summary["cubes_access"] = CUBES_INSTRUCTION
+    return summary
+
+
 def clean_code_snippet(code_string):
     # Extract code snippet using regex
     cleaned_snippet = re.search(r'```(?:\w+)?\s*([\s\S]*?)\s*```', code_string)
@@ -1,24 +1,83 @@
+import hashlib
 import json
 import os
 import logging
+import threading
+from collections import OrderedDict
 import requests
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 import traceback
 
-from llmx import llm, providers
-from ..datamodel import GoalWebRequest, SummaryUrlRequest, TextGenerationConfig, UploadUrl, VisualizeEditWebRequest, VisualizeEvalWebRequest, VisualizeExplainWebRequest, VisualizeRecommendRequest, VisualizeRepairWebRequest, VisualizeWebRequest, InfographicsRequest
+from llmx import providers
+from ..datamodel import GoalWebRequest, SummaryUrlRequest, TextGenerationConfig, UploadUrl, VisualizeAnalyzeWebRequest, VisualizeEditWebRequest, VisualizeEvalWebRequest, VisualizeExplainWebRequest, VisualizeRecommendRequest, VisualizeRepairWebRequest, VisualizeWebRequest, InfographicsRequest
 from ..components import Manager
+from ..components.chartcache import ChartCache
+from ..components.cubes import CubeBuilder
+from ..components.executor import COLUMNAR_EXTENSIONS
+from ..components.jobs import FINISHED_STATUSES, JobQueue
+from ..components.prefetcher import ChartPrefetcher
+from ..components.scheduler import LLMScheduler
+from ..components.sqlbackend import DuckDBBackend
+from ..components.store import get_store
+from ..instrumentation import Instrumentation
+from ..utils import drop_stats, read_dataframe
 
 
-# instantiate model and generator
-textgen = llm()
 logger = logging.getLogger("lida")
 api_docs = os.environ.get("LIDA_API_DOCS", "False") == "True"
-
-
-lida = Manager(text_gen=textgen)
+# read uploaded csv files with pyarrow (when installed) and keep them in compact dtypes
+optimize_dtypes = os.environ.get("LIDA_OPTIMIZE_DTYPES", "False") == "True"
+
+
+# state shared by the workers of the server: uploaded files, summaries, executed charts, cubes
+# and prefetched charts. LIDA_STORE is the url of a Redis compatible server (redis://...) to
+# share them between hosts, or a directory. Defaults to a disk cache shared by the local workers
+store = get_store(os.environ.get("LIDA_STORE"))
+
+instrumentation = Instrumentation()
+# comma separated providers to fall back to on timeouts or rate limits e.g. "cohere,palm"
+fallback_providers = [x for x in os.environ.get("LIDA_FALLBACK_PROVIDERS", "").split(",") if x]
+# llm call budgets, 0 means no limit. /visualize and /visualize/edit calls are scheduled ahead
+# of /visualize/explain and /visualize/evaluate calls
+scheduler = LLMScheduler(
+    requests_per_minute=int(os.environ.get("LIDA_REQUESTS_PER_MINUTE", "0")) or None,
+    tokens_per_minute=int(os.environ.get("LIDA_TOKENS_PER_MINUTE", "0")) or None,
+    max_retries=int(os.environ.get("LIDA_MAX_RETRIES", "3")))
+# charts for the top k goals are generated in the background after /goal, 0 disables prefetching
+prefetch_top_k = int(os.environ.get("LIDA_PREFETCH_TOP_K", "0"))
+prefetcher = ChartPrefetcher(
+    top_k=prefetch_top_k, library=os.environ.get("LIDA_PREFETCH_LIBRARY", "seaborn"),
+    max_cost=int(os.environ.get("LIDA_PREFETCH_MAX_COST", "10")),
+    store=store) if prefetch_top_k > 0 else None
+# executed charts are cached on disk, so replayed code on unchanged data is not rendered again
+chart_cache = ChartCache(size_limit=int(os.environ.get("LIDA_CHART_CACHE_SIZE", str(2 ** 30))),
+                         store=store) if os.environ.get("LIDA_CHART_CACHE", "True") == "True" else None
+# LIDA_DEDUPE_GOALS=True drops near duplicate goals, so charts are not generated for the same
+# goal twice. /goal may then return fewer than the n goals requested
+dedupe_goals = os.environ.get("LIDA_DEDUPE_GOALS", "False") == "True"
+# LIDA_CUBES=True aggregates uploaded files into group by cubes over all their rows
+cube_builder = CubeBuilder(store=store) if os.environ.get("LIDA_CUBES", "False") == "True" else None
+# LIDA_BACKEND=duckdb generates charts that aggregate the full uploaded file in sql
+# handlers are sync functions run in a threadpool, so concurrent identical llm requests from
+# several users can share a single upstream call
+# the default llm client is created by the manager on the first request, not at import time.
+# Requests name their dataset in the summary, see request_data, so any worker can serve them
+lida = Manager(instrumentation=instrumentation, coalesce_requests=True,
+               fallback_providers=fallback_providers,
+               routing=os.environ.get("LIDA_ROUTING", "priority"), scheduler=scheduler,
+               prefetcher=prefetcher, chart_cache=chart_cache,
+               backend=os.environ.get("LIDA_BACKEND", "pandas"), cube_builder=cube_builder)
+# long running operations are also available as background jobs under /jobs, which return a job
+# id at once. Results are kept for LIDA_JOB_TTL seconds, jobs of a worker that stopped are failed
+# after LIDA_JOB_LEASE seconds without a heartbeat
+jobs = JobQueue(max_workers=int(os.environ.get("LIDA_JOB_WORKERS", "4")),
+                max_pending=int(os.environ.get("LIDA_MAX_PENDING_JOBS", "100")),
+                ttl=float(os.environ.get("LIDA_JOB_TTL", "3600")), store=store,
+                lease=float(os.environ.get("LIDA_JOB_LEASE", "60")))
 app = FastAPI()
 # allow cross origin requests for testing on localhost:800* ports only
 app.add_middleware(
@@ -41,6 +100,85 @@ os.makedirs(files_static_root, exist_ok=True)
 os.makedirs(static_folder_root, exist_ok=True)
 
 
+# md5 of the uploaded files in the data folder of this process
+local_files = {}
+
+
+def save_file(file_name: str, content: bytes) -> str:
+    """Write an uploaded file to the data folder and the store, so that every worker can read it"""
+    file_location = os.path.join(data_folder, file_name)
+    # open file without deleting existing contents
+    with open(file_location, "wb+") as file_object:
+        file_object.write(content)
+    digest = hashlib.md5(content).hexdigest()
+    store.set(f"file:{file_name}", content)
+    store.set(f"file_md5:{file_name}", digest)
+    local_files[file_name] = digest
+    return file_location
+
+
+def local_file(file_name: str) -> str:
+    """Path of an uploaded file, copied from the store when it was uploaded to another worker or host"""
+    file_name = os.path.basename(file_name)
+    file_location = os.path.join(data_folder, file_name)
+    digest = store.get(f"file_md5:{file_name}")
+    if digest is None or (os.path.exists(file_location) and local_files.get(file_name) == digest):
+        return file_location
+    content = store.get(f"file:{file_name}")
+    if content is None:
+        return file_location
+    # written to a temporary file first, other requests may be reading the previous version
+    temporary_location = f"{file_location}.{os.getpid()}.{threading.get_ident()}"
+    with open(temporary_location, "wb") as file_object:
+        file_object.write(content)
+    os.replace(temporary_location, file_location)
+    local_files[file_name] = digest
+    return file_location
+
+
+# datasets loaded by this process, least recently used are discarded first
+loaded_data = OrderedDict()
+loaded_data_lock = threading.Lock()
+max_loaded_data = int(os.environ.get("LIDA_MAX_LOADED_DATA", "8"))
+
+
+def request_data(summary):
+    """
+    Use the dataset of a summary for the charts of a request, instead of the data last summarized
+    by this process. Returns a context manager, see Manager.use_data.
+    """
+    file_location = local_file(summary.file_name)
+    if not os.path.exists(file_location):
+        raise FileNotFoundError(f"Data file {summary.file_name} not found, please upload it again")
+    key = (file_location, os.stat(file_location).st_mtime_ns)
+    with loaded_data_lock:
+        state = loaded_data.get(key)
+        if state is not None:
+            loaded_data.move_to_end(key)
+    if state is None:
+        # the executor reads the columns each chart uses from columnar files
+        data = file_location if file_location.split(".")[-1] in COLUMNAR_EXTENSIONS else \
+            read_dataframe(file_location, optimize=optimize_dtypes)
+        sql = DuckDBBackend(file_location) if lida.backend == "duckdb" else None
+        cubes = cube_builder.build(file_location, summary.fields) \
+            if cube_builder is not None and summary.cubes and summary.fields else None
+        state = (data, sql, cubes)
+        with loaded_data_lock:
+            loaded_data[key] = state
+            while len(loaded_data) > max_loaded_data:
+                loaded_data.popitem(last=False)
+    return lida.use_data(*state)
+
+
+@api.get("/files/data/{file_name}")
+def get_data_file(file_name: str) -> FileResponse:
+    """An uploaded file, e.g. the data of altair charts, from any worker"""
+    file_location = local_file(file_name)
+    if not os.path.isfile(file_location):
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(file_location)
+
+
 # mount lida front end UI files
 app.mount("/", StaticFiles(directory=static_folder_root, html=True), name="ui")
 api.mount("/files", StaticFiles(directory=files_static_root, html=True), name="files")
@@ -49,15 +187,17 @@ api.mount("/files", StaticFiles(directory=files_static_root, html=True), name="f
 # def check_model
 
 @api.post("/visualize")
-async def visualize_data(req: VisualizeWebRequest) -> dict:
+def visualize_data(req: VisualizeWebRequest) -> dict:
     """Generate goals given a dataset summary"""
     try:
         # print(req.textgen_config)
-        charts = lida.visualize(
-            summary=req.summary,
-            goal=req.goal,
-            textgen_config=req.textgen_config if req.textgen_config else TextGenerationConfig(),
-            library=req.library, return_error=True)
+        with request_data(req.summary):
+            charts = lida.visualize(
+                summary=req.summary,
+                goal=req.goal,
+                textgen_config=req.textgen_config if req.textgen_config else TextGenerationConfig(),
+                library=req.library, return_error=True, max_repairs=req.max_repairs,
+                session=req.session_id)
         print("found charts: ", len(charts), " for goal: ")
         if len(charts) == 0:
             return {"status": False, "message": "No charts generated"}
@@ -71,16 +211,17 @@ async def visualize_data(req: VisualizeWebRequest) -> dict:
 
 
 @api.post("/visualize/edit")
-async def edit_visualization(req: VisualizeEditWebRequest) -> dict:
+def edit_visualization(req: VisualizeEditWebRequest) -> dict:
     """Given a visualization code, and a goal, generate a new visualization"""
     try:
         textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig()
-        charts = lida.edit(
-            code=req.code,
-            summary=req.summary,
-            instructions=req.instructions,
-            textgen_config=textgen_config,
-            library=req.library, return_error=True)
+        with request_data(req.summary):
+            charts = lida.edit(
+                code=req.code,
+                summary=req.summary,
+                instructions=req.instructions,
+                textgen_config=textgen_config,
+                library=req.library, return_error=True, max_repairs=req.max_repairs)
 
         # charts = [asdict(chart) for chart in charts]
         if len(charts) == 0:
@@ -96,20 +237,21 @@ async def edit_visualization(req: VisualizeEditWebRequest) -> dict:
 
 
 @api.post("/visualize/repair")
-async def repair_visualization(req: VisualizeRepairWebRequest) -> dict:
+def repair_visualization(req: VisualizeRepairWebRequest) -> dict:
     """ Given a visualization goal and some feedback, generate a new visualization that addresses the feedback"""
 
     try:
 
-        charts = lida.repair(
-            code=req.code,
-            feedback=req.feedback,
-            goal=req.goal,
-            summary=req.summary,
-            textgen_config=req.textgen_config if req.textgen_config else TextGenerationConfig(),
-            library=req.library,
-            return_error=True
-        )
+        with request_data(req.summary):
+            charts = lida.repair(
+                code=req.code,
+                feedback=req.feedback,
+                goal=req.goal,
+                summary=req.summary,
+                textgen_config=req.textgen_config if req.textgen_config else TextGenerationConfig(),
+                library=req.library,
+                return_error=True
+            )
 
         if len(charts) == 0:
             return {"status": False, "message": "No charts generated"}
@@ -123,7 +265,7 @@ async def repair_visualization(req: VisualizeRepairWebRequest) -> dict:
 
 
 @api.post("/visualize/explain")
-async def explain_visualization(req: VisualizeExplainWebRequest) -> dict:
+def explain_visualization(req: VisualizeExplainWebRequest) -> dict:
     """Given a visualization code, provide an explanation of the code"""
     textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig(
         n=1,
@@ -144,7 +286,7 @@ async def explain_visualization(req: VisualizeExplainWebRequest) -> dict:
 
 
 @api.post("/visualize/evaluate")
-async def evaluate_visualization(req: VisualizeEvalWebRequest) -> dict:
+def evaluate_visualization(req: VisualizeEvalWebRequest) -> dict:
     """Given a visualization code, provide an evaluation of the code"""
 
     try:
@@ -164,18 +306,46 @@ async def evaluate_visualization(req: VisualizeEvalWebRequest) -> dict:
                 "message": f"Error generating visualization evaluation. {str(exception_error)}"}
 
 
+@api.post("/visualize/analyze")
+def analyze_visualization(req: VisualizeAnalyzeWebRequest) -> dict:
+    """Given a visualization code, provide an explanation and an evaluation from a single llm call"""
+
+    try:
+        analysis = lida.analyze(
+            code=req.code,
+            goal=req.goal,
+            textgen_config=req.textgen_config if req.textgen_config else TextGenerationConfig(
+                n=1,
+                temperature=0),
+            library=req.library)
+        if not analysis["explanations"] and not analysis["evaluations"]:
+            return {"status": False,
+                    "message": "Error parsing visualization analysis."}
+        return {"status": True,
+                "explanations": analysis["explanations"][0] if analysis["explanations"] else None,
+                "evaluations": analysis["evaluations"][0] if analysis["evaluations"] else None,
+                "message": "Successfully generated analysis"}
+
+    except Exception as exception_error:
+        logger.error(f"Error generating visualization analysis: {str(exception_error)}")
+        return {"status": False,
+                "message": f"Error generating visualization analysis. {str(exception_error)}"}
+
+
 @api.post("/visualize/recommend")
-async def recommend_visualization(req: VisualizeRecommendRequest) -> dict:
+def recommend_visualization(req: VisualizeRecommendRequest) -> dict:
     """Given a dataset summary, generate a visualization recommendations"""
 
     try:
         textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig()
-        charts = lida.recommend(
-            summary=req.summary,
-            code=req.code,
-            textgen_config=textgen_config,
-            library=req.library,
-            return_error=True)
+        with request_data(req.summary):
+            charts = lida.recommend(
+                summary=req.summary,
+                code=req.code,
+                textgen_config=textgen_config,
+                library=req.library,
+                return_error=True,
+                max_repairs=req.max_repairs)
 
         if len(charts) == 0:
             return {"status": False, "message": "No charts generated"}
@@ -188,12 +358,42 @@ async def recommend_visualization(req: VisualizeRecommendRequest) -> dict:
                 "message": f"Error generating visualization recommendation."}
 
 
+@api.post("/visualize/recommend/stream")
+def recommend_visualization_stream(req: VisualizeRecommendRequest) -> StreamingResponse:
+    """Given a dataset summary, stream visualization recommendations as newline delimited json, one chart per line"""
+
+    textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig()
+
+    def chart_stream():
+        try:
+            charts = lida.recommend_stream(
+                summary=req.summary,
+                code=req.code,
+                textgen_config=textgen_config,
+                library=req.library,
+                return_error=True)
+            while True:
+                # each chunk of a streaming response may run in another context, so the data
+                # is set around each chart rather than around the stream
+                with request_data(req.summary):
+                    chart = next(charts, None)
+                if chart is None:
+                    break
+                yield json.dumps({"status": True, "chart": jsonable_encoder(chart)}) + "\n"
+        except Exception as exception_error:
+            logger.error(f"Error streaming visualization recommendation: {str(exception_error)}")
+            yield json.dumps({"status": False,
+                              "message": "Error generating visualization recommendation."}) + "\n"
+
+    return StreamingResponse(chart_stream(), media_type="application/x-ndjson")
+
+
 @api.post("/text/generate")
-async def generate_text(textgen_config: TextGenerationConfig) -> dict:
+def generate_text(textgen_config: TextGenerationConfig) -> dict:
     """Generate text given some prompt"""
 
     try:
-        completions = textgen.generate(textgen_config)
+        completions = lida.text_gen.generate(textgen_config)
         return {"status": True, "completions": completions.text}
     except Exception as exception_error:
         logger.error(f"Error generating text: {str(exception_error)}")
@@ -201,11 +401,14 @@ async def generate_text(textgen_config: TextGenerationConfig) -> dict:
 
 
 @api.post("/goal")
-async def generate_goal(req: GoalWebRequest) -> dict:
+def generate_goal(req: GoalWebRequest) -> dict:
     """Generate goals given a dataset summary"""
     try:
         textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig()
-        goals = lida.goals(req.summary, n=req.n, textgen_config=textgen_config)
+        # prefetches started by goals execute their charts on the data of the request
+        with request_data(req.summary):
+            goals = lida.goals(req.summary, n=req.n, textgen_config=textgen_config,
+                               session=req.session_id, dedupe=dedupe_goals)
         return {"status": True, "data": goals,
                 "message": f"Successfully generated {len(goals)} goals"}
     except Exception as exception_error:
@@ -224,11 +427,36 @@ async def generate_goal(req: GoalWebRequest) -> dict:
         }
 
 
+def summarize_file(file_location: str, textgen_config: TextGenerationConfig):
+    """Summarize an uploaded file, or return its summary from the store when the same file was
+    summarized with the same settings, by any worker"""
+    with open(file_location, "rb") as file_object:
+        digest = hashlib.md5(file_object.read()).hexdigest()
+    key = "summary:" + hashlib.md5(json.dumps(
+        [digest, os.path.basename(file_location), dict(textgen_config), lida.backend,
+         cube_builder is not None, optimize_dtypes], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    summary = store.get(key)
+    if summary is None:
+        summary = lida.summarize(
+            data=file_location,
+            file_name=os.path.basename(file_location),
+            summary_method="llm",
+            textgen_config=textgen_config,
+            optimize_dtypes=optimize_dtypes)
+        # the statistics for incremental updates stay out of the responses, the api does not
+        # update summaries
+        summary = drop_stats(summary)
+        store.set(key, summary)
+    return summary
+
+
+# allow csv, excel, json
+allowed_types = ["text/csv", "application/vnd.ms-excel", "application/json"]
+
+
 @api.post("/summarize")
-async def upload_file(file: UploadFile):
+def upload_file(file: UploadFile):
     """ Upload a file and return a summary of the data """
-    # allow csv, excel, json
-    allowed_types = ["text/csv", "application/vnd.ms-excel", "application/json"]
 
     # print("file: ", file)
     # check file type
@@ -239,18 +467,11 @@ async def upload_file(file: UploadFile):
     try:
 
         # save file to files folder
-        file_location = os.path.join(data_folder, file.filename)
-        # open file without deleting existing contents
-        with open(file_location, "wb+") as file_object:
-            file_object.write(file.file.read())
+        file_location = save_file(file.filename, file.file.read())
 
         # summarize
         textgen_config = TextGenerationConfig(n=1, temperature=0)
-        summary = lida.summarize(
-            data=file_location,
-            file_name=file.filename,
-            summary_method="llm",
-            textgen_config=textgen_config)
+        summary = summarize_file(file_location, textgen_config)
         return {"status": True, "summary": summary, "data_filename": file.filename}
     except Exception as exception_error:
         logger.error(f"Error processing file: {str(exception_error)}")
@@ -259,24 +480,19 @@ async def upload_file(file: UploadFile):
 
 # upload via url
 @api.post("/summarize/url")
-async def upload_file_via_url(req: SummaryUrlRequest) -> dict:
+def upload_file_via_url(req: SummaryUrlRequest) -> dict:
     """ Upload a file from a url and return a summary of the data """
     url = req.url
     textgen_config = req.textgen_config if req.textgen_config else TextGenerationConfig(
         n=1, temperature=0)
     file_name = url.split("/")[-1]
-    file_location = os.path.join(data_folder, file_name)
 
     # download file
     url_response = requests.get(url, allow_redirects=True, timeout=1000)
-    open(file_location, "wb").write(url_response.content)
+    file_location = save_file(file_name, url_response.content)
     try:
 
-        summary = lida.summarize(
-            data=file_location,
-            file_name=file_name,
-            summary_method="llm",
-            textgen_config=textgen_config)
+        summary = summarize_file(file_location, textgen_config)
         return {"status": True, "summary": summary, "data_filename": file_name}
     except Exception as exception_error:
         # traceback.print_exc()
@@ -287,7 +503,7 @@ async def upload_file_via_url(req: SummaryUrlRequest) -> dict:
 
 
 @api.post("/infographer")
-async def generate_infographics(req: InfographicsRequest) -> dict:
+def generate_infographics(req: InfographicsRequest) -> dict:
     """Generate infographics using the peacasso package"""
     try:
         result = lida.infographics(
@@ -302,9 +518,111 @@ async def generate_infographics(req: InfographicsRequest) -> dict:
         return {"status": False,
                 "message": f"Error generating infographics. {str(exception_error)}"}
 
+# background jobs
+
+
+def submit_job(operation: str, fn, *args) -> dict:
+    try:
+        job_id = jobs.submit(operation, fn, *args)
+    except RuntimeError as exception_error:
+        return {"status": False, "message": str(exception_error)}
+    return {"status": True, "job_id": job_id, "message": f"Submitted {operation} job"}
+
+
+def summarize_uploaded_file(file_location: str) -> dict:
+    try:
+        summary = summarize_file(file_location, TextGenerationConfig(n=1, temperature=0))
+        return {"status": True, "summary": summary,
+                "data_filename": os.path.basename(file_location)}
+    except Exception as exception_error:
+        logger.error(f"Error processing file: {str(exception_error)}")
+        return {"status": False, "message": f"Error processing file."}
+
+
+@api.post("/jobs/summarize")
+def submit_summarize_job(file: UploadFile) -> dict:
+    """Upload a file and summarize it in the background. The job result is the /summarize response"""
+    if file.content_type not in allowed_types:
+        return {"status": False,
+                "message": f"Uploaded file type ({file.content_type}) not allowed. Allowed types are: csv, excel, json"}
+    # the upload is read now, it is closed when this request ends
+    file_location = save_file(file.filename, file.file.read())
+    return submit_job("summarize", summarize_uploaded_file, file_location)
+
+
+@api.post("/jobs/summarize/url")
+def submit_summarize_url_job(req: SummaryUrlRequest) -> dict:
+    """Download and summarize a file in the background"""
+    return submit_job("summarize/url", upload_file_via_url, req)
+
+
+@api.post("/jobs/visualize")
+def submit_visualize_job(req: VisualizeWebRequest) -> dict:
+    """Generate charts for a goal in the background"""
+    return submit_job("visualize", visualize_data, req)
+
+
+@api.post("/jobs/visualize/recommend")
+def submit_recommend_job(req: VisualizeRecommendRequest) -> dict:
+    """Generate chart recommendations in the background"""
+    return submit_job("visualize/recommend", recommend_visualization, req)
+
+
+@api.post("/jobs/infographer")
+def submit_infographics_job(req: InfographicsRequest) -> dict:
+    """Generate infographics in the background"""
+    return submit_job("infographer", generate_infographics, req)
+
+
+@api.get("/jobs/{job_id}")
+def get_job(job_id: str) -> dict:
+    """Status of a job, with the response of its operation once it has succeeded"""
+    job = jobs.get(job_id)
+    if job is None:
+        return {"status": False, "message": "Job not found or expired"}
+    return {"status": True, "job": jsonable_encoder(job)}
+
+
+@api.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str) -> StreamingResponse:
+    """Server sent events with the job on each status change, until it finishes"""
+
+    def job_events():
+        status = None
+        while True:
+            job = jobs.wait(job_id, status=status, timeout=15)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'message': 'Job not found or expired'})}\n\n"
+                return
+            if job["status"] == status:
+                # keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            status = job["status"]
+            yield f"event: {status}\ndata: {json.dumps(jsonable_encoder(job))}\n\n"
+            if status in FINISHED_STATUSES:
+                return
+
+    return StreamingResponse(job_events(), media_type="text/event-stream")
+
+
+@api.delete("/jobs/{job_id}")
+def cancel_job(job_id: str) -> dict:
+    """Cancel a job. A running job completes, but its result is discarded"""
+    if not jobs.cancel(job_id):
+        return {"status": False, "message": "Job not found or already finished"}
+    return {"status": True, "message": "Cancelled job"}
+
 # list supported models
 
 
 @api.get("/models")
 def list_models() -> dict:
     return {"status": True, "data": providers, "message": "Successfully listed models"}
+
+
+@api.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    """Per-stage latency, token and cache metrics in the prometheus text format"""
+    return PlainTextResponse(instrumentation.to_prometheus(),
+                             media_type="text/plain; version=0.0.4")
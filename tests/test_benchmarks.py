@@ -0,0 +1,43 @@
+import copy
+
+from lida.benchmarks import FakeTextGenerator, compare_reports, make_datasets, run_benchmark, time_startup
+
+
+def test_fake_textgen_replays_responses():
+    text_gen = FakeTextGenerator(responses={"unknown": ["first", "second"]})
+    messages = [{"role": "system", "content": "hello"}]
+    assert text_gen.generate(messages).text[0]["content"] == "first"
+    assert text_gen.generate(messages).text[0]["content"] == "second"
+    assert text_gen.generate(messages).text[0]["content"] == "second"
+
+
+def test_run_benchmark(tmp_path):
+    datasets = {name: df for name, df in make_datasets(scale=0.01).items() if name in ["wide", "dates"]}
+    report = run_benchmark(datasets=datasets, libraries=["matplotlib"], repeat=1,
+                           directory=str(tmp_path))
+    stages = {(result["dataset"], result["stage"]) for result in report["results"]}
+    assert ("wide", "summarize") in stages and ("dates", "recommend") in stages
+    assert all(result.get("charts", 1) > 0 for result in report["results"])
+
+    assert compare_reports(report, report) == []
+    slower = copy.deepcopy(report)
+    for result in slower["results"]:
+        result["median"] = result["median"] * 2 + 1
+    assert len(compare_reports(report, slower)) == len(report["results"])
+
+
+def test_lazy_imports():
+    statement = "import sys, lida, lida.cli; " \
+        "assert not {'llmx', 'pandas', 'matplotlib', 'plotly'} & set(sys.modules)"
+    timings = time_startup(statement, repeat=1)
+    assert len(timings) == 1
+
+
+def test_components_star_import():
+    import lida.components
+
+    namespace = {}
+    exec("from lida.components import *", namespace)
+    assert {"Manager", "Summarizer", "VizGenerator", "preprocess_code"} <= set(namespace)
+    assert "importlib" not in namespace
+    assert set(lida.components.__all__) <= set(dir(lida.components))
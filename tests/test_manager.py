@@ -0,0 +1,875 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+from llmx import TextGenerationConfig
+
+from lida.benchmarks import FakeTextGenerator
+from lida.datamodel import Goal
+from lida.components import Manager
+from lida.components.chartcache import ChartCache
+from lida.components.cubes import CubeBuilder
+from lida.components.executor import preprocess_code
+from lida.components.goal import goal_chart_type
+from lida.components.jobs import JobQueue
+from lida.components.prefetcher import ChartPrefetcher
+from lida.components.projection import pushdown_filters, referenced_columns
+from lida.components.summarizer import Summarizer
+from lida.components.tables import TableCollection
+from lida.components.store import DiskStore, Store, get_store
+from lida.components.scheduler import BACKGROUND_PRIORITY, INTERACTIVE_PRIORITY, LLMScheduler
+from lida.components.viz.vizgenerator import system_prompt as vizgen_prompt
+from lida.instrumentation import Instrumentation
+from lida.utils import (ContextLengthError, compose_rasters, drop_stats, num_tokens_from_messages,
+                        resize_image)
+
+
+BROKEN_CODE = """
+import matplotlib.pyplot as plt
+import pandas as pd
+def plot(data: pd.DataFrame):
+    plt.bar(data['missing_column'], data['y'])
+    return plt;
+
+chart = plot(data)"""
+
+FIXED_CODE = """```
+import matplotlib.pyplot as plt
+import pandas as pd
+def plot(data: pd.DataFrame):
+    plt.bar(data['x'], data['y'])
+    return plt;
+
+chart = plot(data)```"""
+
+
+SUMMARY = {"name": "", "file_name": "", "dataset_description": "", "field_names": ["x", "y"]}
+REPAIR_RESPONSES = {"vizgen": BROKEN_CODE, "repairer": FIXED_CODE}
+
+
+def get_manager():
+    manager = Manager(text_gen=FakeTextGenerator(REPAIR_RESPONSES))
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    return manager
+
+
+def test_visualize_without_repair():
+    manager = get_manager()
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib")
+    assert charts == []
+
+
+def test_visualize_with_repair():
+    manager = get_manager()
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib",
+                               max_repairs=2)
+    assert len(charts) == 1
+    assert charts[0].status is True
+    assert manager.text_gen.calls == ["vizgen", "repairer"]
+
+
+def test_repair_stops_when_budget_expires():
+    def slow_repair(messages):
+        time.sleep(0.3)
+        return FIXED_CODE
+
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": BROKEN_CODE, "repairer": slow_repair}))
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    executed = []
+    execute = manager.execute
+    manager.execute = lambda *args, **kwargs: executed.append(kwargs["code_specs"]) or execute(*args, **kwargs)
+
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib",
+                               max_repairs=3, repair_timeout=0.1, return_error=True)
+    assert charts[0].status is False
+    time.sleep(0.5)
+    # the repair in flight finished its llm call, but did not execute its code nor start another
+    assert manager.text_gen.calls == ["vizgen", "repairer"]
+    assert len(executed) == 1
+
+
+def test_instrumentation():
+    manager = Manager(text_gen=FakeTextGenerator(REPAIR_RESPONSES), instrumentation=Instrumentation())
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib",
+                      max_repairs=1)
+    stages = manager.instrumentation.summary()
+    assert stages["visualize"]["latency"]["count"] == 1
+    assert stages["visualize.vizgen.llm"]["latency"]["count"] == 1
+    assert "visualize.repair_failed._repair_chart" not in stages
+    assert stages["visualize.repair_failed.repairer.llm"]["latency"]["count"] == 1
+    assert stages["visualize.repair_failed.execute.encode"]["latency"]["count"] == 1
+    assert 'lida_stage_duration_seconds_count{stage="visualize"} 1' in \
+        manager.instrumentation.to_prometheus()
+
+
+def test_coalesce_identical_requests():
+    text_gen = FakeTextGenerator({"vizgen": FIXED_CODE}, latency=0.2)
+    manager = Manager(text_gen=text_gen, coalesce_requests=True)
+    messages = [{"role": "system", "content": vizgen_prompt}]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(lambda _: manager.text_gen.generate(messages), range(4)))
+    assert text_gen.calls == ["vizgen"]
+    assert all(response.text[0]["content"] == FIXED_CODE for response in responses)
+
+
+def test_recommend_stream():
+    code = FIXED_CODE.strip("`")
+    completion = f"```python\n{code}\n```\n*****\n```python\n{code}\n```\nThese are the charts."
+    text_gen = FakeTextGenerator({"recommender": completion}, chunk_size=7)
+    manager = Manager(text_gen=text_gen)
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+
+    snippets = list(manager.recommender.generate_stream(
+        code=code, summary={}, textgen_config=TextGenerationConfig(), text_gen=text_gen))
+    assert len(snippets) == 2 and all("chart = plot(data)" in x for x in snippets)
+
+    charts = list(manager.recommend_stream(code=code, summary=SUMMARY, library="matplotlib"))
+    assert len(charts) == 2 and all(chart.status for chart in charts)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+def test_textgen_reused_across_providers():
+    manager = get_manager()
+    config = TextGenerationConfig(provider="openai")
+    assert manager.check_textgen(config) is manager.check_textgen(TextGenerationConfig())
+    assert manager.check_textgen(config) is manager.text_gen
+
+
+def test_assigned_textgen_serves_later_calls():
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": "```\nbroken\n```"}))
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib")
+
+    text_gen = FakeTextGenerator({"vizgen": FIXED_CODE})
+    manager.text_gen = text_gen
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib",
+                               textgen_config=TextGenerationConfig(model="gpt-4"))
+    assert text_gen.calls == ["vizgen"] and charts[0].status
+    assert manager.text_gen.text_gen is text_gen
+
+
+def test_fallback_provider_on_rate_limit():
+    def rate_limited(messages):
+        raise RateLimitError("rate limit exceeded")
+
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": rate_limited}), fallback_providers=["cohere"])
+    manager.pool.add(FakeTextGenerator({"vizgen": FIXED_CODE}, provider="cohere"))
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib",
+                               textgen_config=TextGenerationConfig(model="gpt-4"))
+    assert len(charts) == 1 and charts[0].status
+
+
+def test_stream_text_passes_max_tokens():
+    import types
+    from lida.components.textgen import stream_text
+
+    requests = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        delta = types.SimpleNamespace(content="chunk")
+        return [types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])]
+
+    completions = types.SimpleNamespace(create=create)
+    text_gen = types.SimpleNamespace(model_name="gpt-3.5-turbo", client=types.SimpleNamespace(
+        chat=types.SimpleNamespace(completions=completions)))
+    config = TextGenerationConfig(max_tokens=300, n=3)
+    assert list(stream_text(text_gen, messages=[], config=config)) == ["chunk"]
+    assert requests[0]["max_tokens"] == 300 and requests[0]["n"] == 1 and requests[0]["stream"]
+
+
+def test_fallback_provider_on_rate_limit_while_streaming():
+    def rate_limited(messages):
+        raise RateLimitError("rate limit exceeded")
+
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": rate_limited}), fallback_providers=["cohere"])
+    fallback = FakeTextGenerator({"vizgen": FIXED_CODE}, provider="cohere", chunk_size=7)
+    manager.pool.add(fallback)
+    text_gen = manager.check_textgen(TextGenerationConfig(model="gpt-4"))
+    stream = manager.vizgen.generate_stream(SUMMARY, Goal(question="q", visualization="v", rationale=""),
+                                            textgen_config=TextGenerationConfig(model="gpt-4"),
+                                            text_gen=text_gen)
+    assert "".join(stream) == FIXED_CODE
+    assert fallback.calls == ["vizgen"]
+
+
+def test_scheduler_retries_rate_limits():
+    responses = [RateLimitError("rate limit exceeded"), FIXED_CODE]
+
+    def flaky(messages):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    scheduler = LLMScheduler(max_retries=2, backoff_base=0.01)
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": flaky}), scheduler=scheduler)
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    charts = manager.visualize(summary=SUMMARY, goal="bar chart of y by x", library="matplotlib")
+    assert len(charts) == 1 and charts[0].status
+    assert scheduler.stats()["requests_in_window"] == 2
+
+
+def test_scheduler_runs_interactive_calls_first():
+    scheduler = LLMScheduler(max_concurrency=1)
+    order = []
+    scheduler.acquire()
+
+    def call(name, priority):
+        scheduler.run(lambda: order.append(name), priority=priority)
+
+    background = threading.Thread(target=call, args=("background", BACKGROUND_PRIORITY))
+    interactive = threading.Thread(target=call, args=("interactive", INTERACTIVE_PRIORITY))
+    background.start()
+    time.sleep(0.05)
+    interactive.start()
+    time.sleep(0.05)
+    scheduler.release()
+    background.join()
+    interactive.join()
+    assert order == ["interactive", "background"]
+
+
+def test_scheduler_holds_a_slot_while_streaming():
+    scheduler = LLMScheduler(max_concurrency=1)
+    manager = Manager(text_gen=FakeTextGenerator({"vizgen": FIXED_CODE}, chunk_size=7),
+                      scheduler=scheduler)
+    stream = manager.vizgen.generate_stream(SUMMARY, Goal(question="q", visualization="v", rationale=""),
+                                            textgen_config=TextGenerationConfig(), text_gen=manager.text_gen)
+    first = next(stream)
+    assert scheduler.stats()["in_flight"] == 1
+    assert first + "".join(stream) == FIXED_CODE
+    assert scheduler.stats()["in_flight"] == 0 and scheduler.stats()["requests_in_window"] == 1
+
+
+def test_analyze_single_call():
+    completion = """```{
+"explanation": [{"section": "accessibility", "code": "None", "explanation": "A bar chart"},
+                {"section": "visualization", "code": "plt.bar(data['x'], data['y'])", "explanation": "Bars"}],
+"evaluation": [{"dimension": "bugs", "score": 9, "rationale": "No bugs"},
+               {"dimension": "type", "score": 8, "rationale": "Fits [the] data"},
+               {"dimension": "aesthetics", "score": 7, "rationale": "Plain" ,},]
+```"""
+    text_gen = FakeTextGenerator({"analyzer": completion})
+    manager = Manager(text_gen=text_gen)
+    analysis = manager.analyze(code=FIXED_CODE, goal=Goal(question="bar chart of y by x",
+                                                         visualization="", rationale=""))
+    assert text_gen.calls == ["analyzer"]
+    assert [x["section"] for x in analysis["explanations"][0]] == ["accessibility", "visualization"]
+    # the malformed last object is dropped, the rest of the evaluation is kept
+    assert [x["dimension"] for x in analysis["evaluations"][0]] == ["bugs", "type"]
+
+
+def test_prefetch_top_goals():
+    goals = [{"index": i, "question": f"question {i}", "visualization": f"bar chart {i}",
+              "rationale": ""} for i in range(4)]
+    text_gen = FakeTextGenerator({"goal": json.dumps(goals), "vizgen": FIXED_CODE})
+    manager = Manager(text_gen=text_gen, prefetcher=ChartPrefetcher(top_k=2, library="matplotlib"))
+    manager.data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    config = TextGenerationConfig()
+
+    generated = manager.goals(SUMMARY, n=4, textgen_config=config, session="s1")
+    for goal in generated[:2]:
+        charts = manager.visualize(summary=SUMMARY, goal=goal, textgen_config=config,
+                                   library="matplotlib", session="s1")
+        assert len(charts) == 1 and charts[0].status
+    assert text_gen.calls == ["goal", "vizgen", "vizgen"]
+
+    # goals below the top k, other sessions and other libraries are generated on demand
+    manager.visualize(summary=SUMMARY, goal=generated[2], textgen_config=config,
+                      library="matplotlib", session="s1")
+    manager.visualize(summary=SUMMARY, goal=generated[0], textgen_config=config,
+                      library="matplotlib", session="s2")
+    assert text_gen.calls.count("vizgen") == 4
+
+
+def test_prefetch_cost_cap_and_cancel():
+    prefetcher = ChartPrefetcher(top_k=3, max_cost=2)
+    started = threading.Event()
+
+    def generate(summary, goal, textgen_config, library, cancelled):
+        started.set()
+        cancelled.wait(1)
+        return None if cancelled.is_set() else []
+
+    goals = [Goal(question=f"question {i}", visualization="", rationale="") for i in range(3)]
+    assert prefetcher.prefetch(goals, summary=SUMMARY, textgen_config=TextGenerationConfig(),
+                               generate=generate) == 2
+    started.wait(1)
+    prefetcher.cancel()
+    assert prefetcher.get(goals[0], summary=SUMMARY, textgen_config=TextGenerationConfig(),
+                          library="seaborn") is None
+    prefetcher.shutdown()
+
+
+def test_update_summary_with_appended_rows():
+    data = pd.DataFrame({"price": [float(x % 50) for x in range(400)],
+                         "units": [x % 7 for x in range(400)],
+                         "store": [f"s{x % 5}" for x in range(400)]})
+    manager = Manager(text_gen=FakeTextGenerator())
+    full = manager.summarize(data)
+    summary = manager.summarize(data.iloc[:300])
+    updated = manager.update_summary(summary, data.iloc[300:])
+
+    for field, expected in zip(updated["fields"], full["fields"]):
+        for key in ["dtype", "min", "max", "num_unique_values"]:
+            assert field["properties"].get(key) == expected["properties"].get(key)
+        if "std" in expected["properties"]:
+            assert abs(field["properties"]["std"] - expected["properties"]["std"]) < 1e-6
+    assert "stats" not in manager.vizgen.get_messages(updated, Goal(
+        question="", visualization="", rationale=""))[1]["content"]
+    # the statistics do not change the charts, prefetched charts are shared across updates
+    goal = Goal(question="q", visualization="", rationale="")
+    assert ChartPrefetcher.make_key(updated, goal, TextGenerationConfig(), "seaborn") == \
+        ChartPrefetcher.make_key(drop_stats(updated), goal, TextGenerationConfig(), "seaborn")
+    assert "stats" not in drop_stats(updated) and "stats" in updated
+
+
+def test_update_summary_enriches_changed_columns(tmp_path):
+    def annotate(messages):
+        fields = json.loads(messages[1]["content"].split("JSON object.")[1].replace("'", '"'))["fields"]
+        for field in fields:
+            field["properties"]["description"] = f"updated {field['column']}"
+        return json.dumps({"fields": fields})
+
+    text_gen = FakeTextGenerator({"summarizer": annotate})
+    manager = Manager(text_gen=text_gen)
+    manager.summarizer = Summarizer(cache_dir=str(tmp_path))
+    data = pd.DataFrame({"price": [10.0, 11.0, 12.0, 10.5], "units": [1, 2, 3, 4]})
+    summary = manager.summarize(data)
+    for field in summary["fields"]:
+        field["properties"]["description"] = f"original {field['column']}"
+
+    updated = manager.update_summary(summary, pd.DataFrame({"price": [90.0, 95.0], "units": [2, 3]}))
+    descriptions = [x["properties"]["description"] for x in updated["fields"]]
+    assert descriptions == ["updated price", "original units"]
+    assert text_gen.calls == ["summarizer"]
+
+
+def test_enrich_only_unseen_columns(tmp_path):
+    def annotate(messages):
+        fields = json.loads(messages[1]["content"].split("JSON object.")[1].replace("'", '"'))["fields"]
+        for field in fields:
+            field["properties"]["semantic_type"] = "id" if field["column"].endswith("_id") else "country"
+            field["properties"]["description"] = field["column"]
+        return json.dumps({"name": "orders", "dataset_description": "orders", "fields": fields})
+
+    prompts = []
+    text_gen = FakeTextGenerator({"summarizer": lambda messages: prompts.append(messages) or annotate(messages)})
+    manager = Manager(text_gen=text_gen)
+    manager.summarizer = Summarizer(cache_dir=str(tmp_path))
+
+    orders = pd.DataFrame({"customer_id": ["c1", "c2", "c3"], "country": ["DE", "FR", "DE"]})
+    summary = manager.summarize(orders, summary_method="llm")
+    assert [x["properties"]["semantic_type"] for x in summary["fields"]] == ["id", "country"]
+
+    # a second table sharing the customer_id column only asks about the new column
+    returns = pd.DataFrame({"customer_id": ["c1", "c2", "c3"], "return_id": ["r1", "r2", "r3"]})
+    summary = manager.summarize(returns, summary_method="llm")
+    assert "'customer_id'" not in prompts[-1][1]["content"]
+    assert [x["properties"]["description"] for x in summary["fields"]] == ["customer_id", "return_id"]
+
+    manager.summarize(orders, summary_method="llm")
+    assert len(prompts) == 2
+
+
+def test_enrich_wide_table_in_batches(tmp_path):
+    failed = set()
+
+    def annotate(messages):
+        fields = json.loads(messages[1]["content"].split("JSON object.")[1].replace("'", '"'))["fields"]
+        columns = [field["column"] for field in fields]
+        # the batch with c0 returns broken JSON once, the batch with c39 always does
+        if "c39" in columns or ("c0" in columns and "c0" not in failed):
+            failed.add("c0")
+            return "{ not json"
+        for field in fields:
+            field["properties"]["description"] = f"column {field['column']}"
+        return json.dumps({"name": "wide", "dataset_description": "wide", "fields": fields})
+
+    text_gen = FakeTextGenerator({"summarizer": annotate})
+    manager = Manager(text_gen=text_gen)
+    manager.summarizer = Summarizer(cache_dir=str(tmp_path), max_batch_tokens=300, max_retries=1)
+    data = pd.DataFrame({f"c{i}": [i, i + 1, i + 2] for i in range(40)})
+
+    summary = manager.summarize(data, summary_method="llm")
+    batches = manager.summarizer.batch_fields(manager.summarizer.get_column_properties(data))
+    assert len(batches) > 2
+    descriptions = {x["column"]: x["properties"]["description"] for x in summary["fields"]}
+    assert descriptions["c0"] == "column c0"
+    assert descriptions["c39"] == ""
+    assert summary["dataset_description"] == "wide"
+    # every batch once, one retry for the c0 batch, two attempts for the c39 batch
+    assert len(text_gen.calls) == len(batches) + 2
+
+
+def test_summarize_with_compact_dtypes(tmp_path):
+    file_location = str(tmp_path / "sales.csv")
+    pd.DataFrame({"units": [x % 7 for x in range(200)],
+                  "price": [x % 4 + 0.5 for x in range(200)],
+                  "store": [f"s{x % 5}" for x in range(200)],
+                  "order": [f"order {x}" for x in range(200)],
+                  "day": [f"2023-01-{x % 28 + 1:02d}" for x in range(200)]}).to_csv(file_location, index=False)
+    manager = Manager(text_gen=FakeTextGenerator())
+    summary = manager.summarize(file_location)
+    data = manager.data
+    optimized = manager.summarize(file_location, optimize_dtypes=True)
+
+    assert manager.data["units"].dtype == "int8"
+    assert manager.data["price"].dtype == "float32"
+    assert isinstance(manager.data["store"].dtype, pd.CategoricalDtype)
+    assert manager.data.memory_usage(deep=True).sum() < data.memory_usage(deep=True).sum()
+    for field, expected in zip(optimized["fields"], summary["fields"]):
+        assert field["properties"]["dtype"] == expected["properties"]["dtype"]
+        assert field["properties"].get("max") == expected["properties"].get("max")
+
+    code = FIXED_CODE.strip("`").replace("data['x'], data['y']", "data['store'], data['units']")
+    charts = manager.execute([code], data=manager.data, summary=optimized, library="matplotlib")
+    assert charts[0].status is True
+
+
+def test_referenced_columns_and_filters():
+    columns = ["region", "year", "sales", "profit", "notes"]
+    code = preprocess_code(
+        "import seaborn as sns\ndef plot(data):\n"
+        "    data = data[(data['year'] >= 2020) & data['region'].isin(['north', 'south'])]\n"
+        "    return sns.barplot(data=data, x='region', y='sales')\nchart = plot(data)")
+    assert referenced_columns(code, columns) == ["region", "year", "sales"]
+    assert pushdown_filters(code, columns) == [("year", ">=", 2020), ("region", "in", ["north", "south"])]
+
+    code = "import altair as alt\ndef plot(data):\n    return alt.Chart(data).mark_bar().encode(x='region:N', y='mean(profit):Q')"
+    assert referenced_columns(code, columns) == ["region", "profit"]
+    assert pushdown_filters(code, columns) is None
+    # code that may use every column is executed on the full dataset
+    for code in ["sns.heatmap(data.corr())", "sns.pairplot(data, hue='region')",
+                 "data.groupby('region').mean().plot()", "sns.boxplot(data=data)"]:
+        assert referenced_columns(code, columns) is None
+    # != keeps missing values in pandas but not in parquet filters
+    assert pushdown_filters("data = data[data['year'] != 2020]", columns) is None
+
+
+def test_projected_execution_falls_back_to_all_columns(monkeypatch):
+    import lida.components.executor
+    from lida.components.executor import ChartExecutor
+
+    data = pd.DataFrame({"store": ["a", "b"], "units": [1, 2], "notes": ["", ""]})
+    reads = []
+
+    def read_dataframe(file_location, columns=None, filters=None):
+        reads.append(columns)
+        return data[columns] if columns else data
+
+    monkeypatch.setattr(lida.components.executor, "read_dataframe", read_dataframe)
+    # the column is named in an f-string, the projection only reads store
+    code = FIXED_CODE.replace("plt.bar(data['x'], data['y'])",
+                              "prefix = 'un'\n    plt.bar(data['store'], data[f'{prefix}its'])")
+    summary = dict(SUMMARY, file_name="sales.parquet", field_names=["store", "units", "notes"], fields=[])
+    charts = ChartExecutor().execute([code], data="sales.parquet", summary=summary,
+                                     library="matplotlib", return_error=True)
+    assert charts[0].status is True
+    assert reads == [["store"], None]
+
+
+def test_filtered_read_keeps_file_with_dirty_columns(tmp_path):
+    pytest.importorskip("pyarrow")
+    from lida.utils import read_dataframe
+
+    file_location = str(tmp_path / "sales.parquet")
+    pd.DataFrame({"Store Name": ["a", "b", "c"] * 2000, "Units": range(6000)}).to_parquet(file_location)
+    data = read_dataframe(file_location, filters=[("Units", "<", 10)])
+    assert len(data) == 10
+    assert len(pd.read_parquet(file_location)) == 6000
+
+
+def test_chart_cache_replays_executed_charts(tmp_path):
+    manager = Manager(text_gen=FakeTextGenerator(REPAIR_RESPONSES),
+                      chart_cache=ChartCache(cache_dir=str(tmp_path)),
+                      instrumentation=Instrumentation())
+    data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+    first = manager.execute([FIXED_CODE], data=data, summary=SUMMARY, library="matplotlib")
+    replay = manager.execute([FIXED_CODE], data=data.copy(), summary=SUMMARY, library="matplotlib")
+    assert replay[0].raster == first[0].raster
+    stats = manager.instrumentation.summary()["execute.chart"]
+    assert (stats["cache_hits"], stats["cache_misses"]) == (1, 1)
+
+    # changed data, a different library or failing code are executed again
+    manager.execute([FIXED_CODE], data=data.assign(y=[3, 2, 1]), summary=SUMMARY, library="matplotlib")
+    manager.execute([FIXED_CODE], data=data, summary=SUMMARY, library="seaborn")
+    assert manager.execute([BROKEN_CODE], data=data, summary=SUMMARY, library="matplotlib") == []
+    assert manager.execute([BROKEN_CODE], data=data, summary=SUMMARY, library="matplotlib") == []
+    stats = manager.instrumentation.summary()["execute.chart"]
+    assert (stats["cache_hits"], stats["cache_misses"]) == (1, 5)
+
+
+def test_workers_share_store_and_use_request_data(tmp_path):
+    assert isinstance(get_store(str(tmp_path)), DiskStore)
+
+    class PartialStore(Store):
+        def get(self, key, default=None):
+            return default
+
+    with pytest.raises(TypeError):
+        PartialStore()
+    # two workers with their own managers and stores on the same directory
+    workers = [Manager(text_gen=FakeTextGenerator({"vizgen": FIXED_CODE}),
+                       chart_cache=ChartCache(store=DiskStore(str(tmp_path))),
+                       instrumentation=Instrumentation()) for _ in range(2)]
+    data = pd.DataFrame({"x": ["a", "b", "c"], "y": [1, 2, 3]})
+
+    charts = []
+    for manager in workers:
+        # no summarize call in this process, the request names its data
+        with manager.use_data(data):
+            charts.extend(manager.visualize(summary=SUMMARY, goal="bar chart of y by x",
+                                            library="matplotlib"))
+        assert manager.current_data is None
+    assert len(charts) == 2 and charts[0].raster == charts[1].raster
+    hits = [manager.instrumentation.summary()["visualize.execute.chart"]["cache_hits"]
+            for manager in workers]
+    assert hits == [0, 1]
+
+
+def test_job_queue_runs_cancels_and_expires_jobs(tmp_path):
+    release = threading.Event()
+    jobs = JobQueue(max_workers=1, max_pending=2, ttl=60, store=DiskStore(str(tmp_path)))
+    slow = jobs.submit("slow", lambda: release.wait(5) and "done")
+    queued = jobs.submit("queued", lambda: "never")
+    with pytest.raises(RuntimeError):
+        jobs.submit("refused", lambda: None)
+
+    assert jobs.wait(slow, status="queued", timeout=5)["status"] == "running"
+    assert jobs.cancel(queued) and jobs.get(queued)["status"] == "cancelled"
+    release.set()
+    job = jobs.wait(slow, status="running", timeout=5)
+    assert (job["status"], job["result"]) == ("succeeded", "done")
+    assert not jobs.cancel(slow)
+
+    failed = jobs.submit("failed", lambda: 1 / 0)
+    assert jobs.wait(failed, status="queued", timeout=5)["status"] in ["running", "failed"]
+    assert "division by zero" in jobs.wait(failed, status="running", timeout=5)["error"]
+
+    # another process of the server answers from the store
+    other = JobQueue(store=DiskStore(str(tmp_path)))
+    assert other.get(slow)["result"] == "done"
+    jobs.ttl = 0
+    assert jobs.get(slow)["status"] == "succeeded"  # still in the store
+    assert slow not in jobs._jobs
+
+
+def test_job_queue_fails_jobs_with_expired_leases(tmp_path):
+    release = threading.Event()
+    jobs = JobQueue(max_workers=1, store=DiskStore(str(tmp_path)), lease=0.3)
+    running = jobs.submit("running", release.wait, 5)
+    assert jobs.wait(running, status="queued", timeout=5)["status"] == "running"
+
+    # the heartbeats of the running process keep the lease of its job
+    other = JobQueue(store=DiskStore(str(tmp_path)), lease=0.3)
+    time.sleep(0.6)
+    assert other.get(running)["status"] == "running"
+
+    # a job whose process stopped sending heartbeats fails once its lease expires
+    jobs.shutdown()
+    time.sleep(0.6)
+    job = other.get(running)
+    assert job["status"] == "failed" and "stopped" in job["error"]
+    assert other.wait(running, status="running", timeout=1)["status"] == "failed"
+    release.set()
+
+
+def test_prompt_size_checked_before_llm_call():
+    messages = [{"role": "user", "content": "bar chart of y by x"}]
+    for model in ["gpt-3.5-turbo-0301", "gpt-4", "command", "unknown-model"]:
+        assert 0 < num_tokens_from_messages(messages, model=model) < 50
+
+    manager = Manager(text_gen=FakeTextGenerator({"goal": "[]"}, model_name="gpt-3.5-turbo"))
+    wide = dict(SUMMARY, field_names=[f"column_{i}" for i in range(3000)])
+    with pytest.raises(ContextLengthError, match="context length"):
+        manager.goals(wide, n=2)
+    assert manager.text_gen.calls == []
+    manager.goals(SUMMARY, n=2)
+    assert manager.text_gen.calls == ["goal"]
+    # the requested completion length is reserved too
+    with pytest.raises(ContextLengthError, match="including 16000 for the completion"):
+        manager.goals(SUMMARY, n=2, textgen_config=TextGenerationConfig(max_tokens=16000))
+    assert manager.text_gen.calls == ["goal"]
+
+
+def test_num_tokens_from_messages_overheads(monkeypatch):
+    import lida.utils
+
+    monkeypatch.setattr(lida.utils, "count_tokens", lambda text, model=None: 1)
+    messages = [{"role": "system", "content": "a"}, {"role": "user", "name": "b", "content": "c"}]
+    # per message, per name and reply priming overheads of the openai chat format
+    assert num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301") == 4 + 2 + 4 + 3 - 1 + 2
+    assert num_tokens_from_messages(messages, model="gpt-4") == 3 + 2 + 3 + 3 + 1 + 3
+
+
+def test_failed_tokenizer_loads_are_retried(monkeypatch):
+    import sys
+    import types
+    import lida.utils
+
+    class Encoding:
+        def encode(self, text, disallowed_special=()):
+            return text.split()
+
+    monkeypatch.setitem(sys.modules, "tiktoken", types.SimpleNamespace(
+        encoding_for_model=lambda model: Encoding(), get_encoding=lambda name: Encoding()))
+    monkeypatch.setattr(lida.utils, "_encodings", {})
+    monkeypatch.setattr(lida.utils, "_encoding_failures", {"gpt-4": time.monotonic()})
+    # a recent failure is not retried, token counts are estimated
+    assert lida.utils.get_encoding("gpt-4") is None
+    assert lida.utils.count_tokens("12345678", "gpt-4") == 3 and lida.utils._encodings == {}
+
+    lida.utils._encoding_failures["gpt-4"] -= lida.utils.ENCODING_RETRY_SECONDS
+    assert isinstance(lida.utils.get_encoding("gpt-4"), Encoding)
+    assert lida.utils.count_tokens("one two three", "gpt-4") == 3
+    assert "gpt-4" in lida.utils._encodings
+
+    # counts are memoized by digest, in a bounded cache
+    monkeypatch.setattr(lida.utils, "TOKEN_COUNT_CACHE_SIZE", 2)
+    monkeypatch.setattr(lida.utils, "_token_counts", lida.utils.OrderedDict())
+    for text in ["a", "a b", "a b c"]:
+        lida.utils.count_tokens(text, "gpt-4")
+    assert len(lida.utils._token_counts) == 2
+    assert all("a b" not in str(key) for key in lida.utils._token_counts)
+
+
+def test_dedupe_and_rank_goals():
+    goals = [
+        ("What is the distribution of y?", "histogram of y"),
+        ("How are the values of y distributed?", "Histogram of y values"),
+        ("What is the total y for each x?", "bar chart of y by x"),
+        ("How does the sum of y vary by x?", "bar chart of total y grouped by x"),
+        ("How many rows are there for each x?", "count plot of x"),
+    ]
+    text_gen = FakeTextGenerator({"goal": json.dumps(
+        [{"index": i, "question": q, "visualization": v, "rationale": ""} for i, (q, v) in enumerate(goals)])})
+    manager = Manager(text_gen=text_gen)
+
+    assert len(manager.goals(SUMMARY, n=5)) == 5
+    distinct = manager.goals(SUMMARY, n=5, dedupe=True)
+    assert [x.visualization for x in distinct] == \
+        ["histogram of y", "bar chart of y by x", "count plot of x"]
+    assert [x.index for x in distinct] == [0, 1, 2]
+    assert text_gen.calls == ["goal", "goal"]
+
+
+def test_goal_chart_type_matches_whole_words():
+    def chart_type(visualization):
+        return goal_chart_type(Goal(question="", visualization=visualization, rationale=""))
+
+    assert chart_type("histogram of passengers by embarked port") == "histogram"
+    assert chart_type("count of passengers by embarked port") is None
+    assert chart_type("table mapping fares to classes") is None
+    assert chart_type("bars of fare by class") == "bar"
+    assert chart_type("choropleth map of fares") == "map"
+    assert chart_type("scatterplot of age and fare") == "scatter"
+
+
+def test_summarize_and_execute_table_collection(tmp_path):
+    pd.DataFrame({"order_id": range(6), "customer_id": [1, 2, 1, 3, 2, 1],
+                  "amount": [10.0, 20.0, 5.0, 7.5, 12.0, 3.0]}).to_csv(tmp_path / "orders.csv", index=False)
+    pd.DataFrame({"id": [1, 2, 3], "region": ["north", "south", "north"]}).to_csv(
+        tmp_path / "customers.csv", index=False)
+    pd.DataFrame({"id": [1, 2], "name": ["a", "b"]}).to_csv(tmp_path / "products.csv", index=False)
+    tables = TableCollection(
+        {name: str(tmp_path / f"{name}.csv") for name in ["orders", "customers", "products"]},
+        relationships=[{"left": "orders", "left_on": "customer_id", "right": "customers", "right_on": "id"}],
+        name="sales")
+    manager = Manager(text_gen=FakeTextGenerator())
+    summary = manager.summarize(tables)
+
+    assert [x["name"] for x in summary["tables"]] == ["orders", "customers", "products"]
+    assert "customers.region" in summary["field_names"]
+    prompt = manager.vizgen.get_messages(summary, Goal(question="", visualization="", rationale=""))[1]["content"]
+    assert "data.join(" in prompt and "'tables'" not in prompt
+    assert tables.loaded == []
+
+    code = FIXED_CODE.replace("plt.bar(data['x'], data['y'])",
+                              "totals = data.join('orders', 'customers').groupby('region')['amount'].sum()\n"
+                              "    plt.bar(totals.index, totals.values)")
+    charts = manager.execute([code], data=manager.data, summary=summary, library="matplotlib")
+    assert charts[0].status is True
+    assert sorted(tables.loaded) == ["customers", "orders"]
+    assert tables.join("orders", "customers").groupby("region")["amount"].sum().to_dict() == {
+        "north": 25.5, "south": 32.0}
+
+
+def test_duckdb_backend_prompts_for_sql():
+    manager = Manager(text_gen=FakeTextGenerator(), backend="duckdb")
+    messages = manager.vizgen.get_messages(SUMMARY, Goal(question="q", visualization="v", rationale=""),
+                                           library="seaborn")
+    assert "query(sql)" in messages[2]["content"]
+    assert 'df = query("""<query>""")' in messages[3]["content"]
+    assert "<query>" not in Manager(text_gen=FakeTextGenerator()).vizgen.get_messages(
+        SUMMARY, Goal(question="q", visualization="v", rationale=""), library="seaborn")[3]["content"]
+
+
+def test_duckdb_backend_aggregates_full_file(tmp_path):
+    pytest.importorskip("duckdb")
+    file_location = str(tmp_path / "sales.csv")
+    pd.DataFrame({"store": [f"s{x % 4}" for x in range(10000)],
+                  "units": [1] * 10000}).to_csv(file_location, index=False)
+    manager = Manager(text_gen=FakeTextGenerator(), backend="duckdb")
+    summary = manager.summarize(file_location)
+    assert len(manager.data) == 4500
+
+    code = FIXED_CODE.replace(
+        "plt.bar(data['x'], data['y'])",
+        "df = query('SELECT store, SUM(units) AS units FROM data GROUP BY store')\n"
+        "    assert df['units'].sum() == 10000\n"
+        "    plt.bar(df['store'], df['units'])")
+    charts = manager.execute([code], data=manager.data, summary=summary, library="matplotlib")
+    assert charts[0].status is True
+
+
+def test_duckdb_backend_aggregates_full_file_with_dirty_columns(tmp_path):
+    pytest.importorskip("duckdb")
+    file_location = str(tmp_path / "cars.csv")
+    pd.DataFrame({"Car Type": [f"t{x % 3}" for x in range(10000)],
+                  "Retail Price": [1] * 10000}).to_csv(file_location, index=False)
+    manager = Manager(text_gen=FakeTextGenerator(), backend="duckdb")
+    summary = manager.summarize(file_location)
+    assert len(manager.data) == 4500
+    assert len(manager.sql.query("SELECT * FROM data")) == 10000
+
+    code = FIXED_CODE.replace(
+        "plt.bar(data['x'], data['y'])",
+        "df = query('SELECT Car_Type, SUM(Retail_Price) AS total FROM data GROUP BY Car_Type')\n"
+        "    assert df['total'].sum() == 10000\n"
+        "    plt.bar(df['Car_Type'], df['total'])")
+    charts = manager.execute([code], data=manager.data, summary=summary, library="matplotlib")
+    assert charts[0].status is True
+
+
+def test_cubes_aggregate_full_file(tmp_path):
+    file_location = str(tmp_path / "sales.csv")
+    data = pd.DataFrame({"store": [f"s{x % 4}" for x in range(10000)],
+                         "units": [x % 10 for x in range(10000)]})
+    data.to_csv(file_location, index=False)
+    manager = Manager(text_gen=FakeTextGenerator(),
+                      cube_builder=CubeBuilder(cache_dir=str(tmp_path / "cubes"), chunksize=3000))
+    summary = manager.summarize(file_location)
+    assert len(manager.data) == 4500
+    assert ["store"] in summary["cubes"]["cubes"] and summary["cubes"]["rows"] == 10000
+
+    cube = manager.cubes.get("store")
+    expected = data.groupby("store")["units"].agg(["size", "sum", "max"])
+    assert cube.set_index("store")["count"].to_dict() == expected["size"].to_dict()
+    assert cube.set_index("store")["units_sum"].to_dict() == expected["sum"].to_dict()
+    assert cube.set_index("store")["units_max"].to_dict() == expected["max"].to_dict()
+    assert manager.cubes.get("units")["count"].sum() == 10000
+    assert "cubes.get(" in manager.vizgen.get_messages(summary, Goal(
+        question="", visualization="", rationale=""))[1]["content"]
+
+    code = FIXED_CODE.replace("plt.bar(data['x'], data['y'])",
+                              "totals = cubes.get('store')\n    plt.bar(totals['store'], totals['units_sum'])")
+    charts = manager.execute([code], data=manager.data, summary=summary, library="matplotlib")
+    assert charts[0].status is True
+
+    updated = manager.update_summary(summary, data.iloc[:100])
+    assert updated["cubes"]["rows"] == 10100
+    assert manager.cubes.get("store")["count"].sum() == 10100
+
+
+def test_cubes_aggregate_full_file_with_dirty_columns(tmp_path):
+    file_location = str(tmp_path / "cars.csv")
+    pd.DataFrame({"Car Type": [f"t{x % 3}" for x in range(10000)],
+                  "Retail Price": [x % 7 for x in range(10000)]}).to_csv(file_location, index=False)
+    manager = Manager(text_gen=FakeTextGenerator(),
+                      cube_builder=CubeBuilder(cache_dir=str(tmp_path / "cubes"), chunksize=3000))
+    summary = manager.summarize(file_location)
+    assert len(manager.data) == 4500
+    # the file is rewritten with clean column names, not with the sample
+    assert pd.read_csv(file_location).columns.tolist() == ["Car_Type", "Retail_Price"]
+    assert len(pd.read_csv(file_location)) == 10000
+    assert summary["cubes"]["rows"] == 10000
+    assert manager.cubes.get("Car_Type")["count"].sum() == 10000
+
+
+def test_compose_rasters_resizes_on_both_axes():
+    import base64
+    import io
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    def png(height, width, color):
+        buffer = io.BytesIO()
+        plt.imsave(buffer, np.tile(np.array(color, dtype=np.float32), (height, width, 1)), format="png")
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+    gradient = np.arange(4, dtype=np.float32).reshape(2, 2, 1)
+    assert np.allclose(resize_image(gradient, 3, 3)[:, :, 0],
+                       [[0, 0.5, 1], [1, 1.5, 2], [2, 2.5, 3]])
+
+    rasters = [png(10, 20, [1, 0, 0]), png(20, 10, [0, 0, 1]), png(5, 5, [0, 1, 0])]
+    row = compose_rasters(rasters)
+    # resized to a height of 20, keeping aspect ratios
+    assert row.shape == (20, 40 + 10 + 20, 4)
+    assert np.allclose(row[:, :40, :3], [1, 0, 0], atol=0.01)
+    assert np.allclose(row[:, 50:, :3], [0, 1, 0], atol=0.01)
+
+    grid = compose_rasters(rasters, columns=2)
+    assert grid.shape == (40, 50, 4)
+    # the second row is narrower than the first, the rest is transparent
+    assert np.allclose(grid[20:, 20:, 3], 0)
+
+
+def test_infographer_batches_requests_and_unloads_idle_model(monkeypatch):
+    import sys
+    import types
+    from PIL import Image
+
+    class ImageGenerator:
+        loaded = 0
+        passes = []
+
+        def __init__(self, model_config):
+            ImageGenerator.loaded += 1
+
+        def generate(self, config):
+            ImageGenerator.passes.append(config.prompt)
+            prompts = config.prompt if isinstance(config.prompt, list) else [config.prompt]
+            return {"images": [f"{prompt}-{x}" for prompt in prompts for x in range(config.num_images)]}
+
+    class Config:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    # the diffusion pipeline is stubbed, only the batching and model lifetime are tested
+    stubs = {"torch": types.SimpleNamespace(cuda=types.SimpleNamespace(is_available=lambda: False),
+                                            FloatTensor=object),
+             "peacasso": types.ModuleType("peacasso"),
+             "peacasso.generator": types.SimpleNamespace(ImageGenerator=ImageGenerator),
+             "peacasso.datamodel": types.SimpleNamespace(GeneratorConfig=Config, ModelConfig=Config),
+             "peacasso.utils": types.SimpleNamespace(base64_to_pil=None, pil_to_base64=None)}
+    for name, module in stubs.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    # imported again over the stubs, and dropped from the module cache after the test
+    monkeypatch.setitem(sys.modules, "lida.components.infographer", None)
+    monkeypatch.delitem(sys.modules, "lida.components.infographer")
+    from lida.components.infographer import Infographer
+
+    infographer = Infographer(idle_timeout=0.2, batch_window=0.2)
+    assert infographer.cpu and infographer.model is None
+    image = Image.new("RGB", (8, 8))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda style: infographer.generate(image, n=1, style_prompt=style),
+                                ["pastel", "line art"]))
+    assert ImageGenerator.passes == [["pastel", "line art"]]
+    assert [result["images"] for result in results] == [["pastel-0"], ["line art-0"]]
+    assert ImageGenerator.loaded == 1
+
+    time.sleep(0.5)
+    assert infographer.model is None
+    assert infographer.generate(image, n=2, style_prompt="pastel")["images"] == ["pastel-0", "pastel-1"]
+    assert ImageGenerator.loaded == 2